@@ -0,0 +1,213 @@
+import os
+import time
+import asyncio
+import logging
+import contextvars
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Configuración (bytes por segundo, 0 = sin límite)
+BW_GLOBAL_DOWN = int(os.environ.get('BW_GLOBAL_DOWN', 0))
+BW_GLOBAL_UP = int(os.environ.get('BW_GLOBAL_UP', 0))
+BW_USER_DOWN = int(os.environ.get('BW_USER_DOWN', 0))
+BW_USER_UP = int(os.environ.get('BW_USER_UP', 0))
+BW_BURST_SECONDS = 0.5  # ráfaga permitida por encima del ritmo
+BW_SMALL_FILE_SIZE = int(os.environ.get('BW_SMALL_FILE_SIZE', 100 * 1024 * 1024))
+BW_SMALL_FILE_WEIGHT = float(os.environ.get('BW_SMALL_FILE_WEIGHT', 4))
+
+DIRECTIONS = ('down', 'up')
+
+_current_flows = contextvars.ContextVar('current_bandwidth_flows', default=None)
+
+
+class Flow:
+    """Transferencias de una tarea en un sentido; weight es su parte relativa del ancho de banda"""
+
+    def __init__(self, user_id, direction, weight=1.0):
+        self.user_id = user_id
+        self.direction = direction
+        self.weight = weight
+
+
+class FairLimiter:
+    """Cubeta de tokens compartida con reparto ponderado entre flujos.
+
+    Cuando no hay tokens, se atiende primero al flujo con menor tiempo virtual (bytes
+    recibidos / peso), así una descarga enorme con muchas conexiones no deja sin turno
+    a las pequeñas. Si solo hay un flujo activo recibe todo el ritmo.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.waiting = {}  # Flow -> deque[(bytes, future)]
+        self.flow_vtime = {}  # Flow -> tiempo virtual al terminar su última concesión
+        self.vtime = 0.0  # tiempo virtual del sistema: inicio de la última concesión
+        self.wakeup = None
+        self.task = None
+
+    @property
+    def capacity(self):
+        return self.rate * BW_BURST_SECONDS
+
+    def set_rate(self, rate):
+        self.rate = rate
+        if self.wakeup:
+            self.wakeup.set()
+
+    def forget(self, flow):
+        self.flow_vtime.pop(flow, None)
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, flow, nbytes):
+        if self.rate <= 0 or nbytes <= 0:
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.waiting.setdefault(flow, deque()).append((nbytes, future))
+        if self.task is None or self.task.done():
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.get_running_loop().create_task(self._run())
+        self.wakeup.set()
+        await future
+
+    def _next_flow(self):
+        return min(self.waiting, key=lambda f: max(self.flow_vtime.get(f, self.vtime), self.vtime))
+
+    def _grant(self, flow, nbytes):
+        queue = self.waiting[flow]
+        _, future = queue.popleft()
+        if not queue:
+            del self.waiting[flow]
+        if future.done():
+            return
+        start = max(self.flow_vtime.get(flow, self.vtime), self.vtime)
+        self.vtime = start
+        self.flow_vtime[flow] = start + nbytes / flow.weight
+        # Puede quedar en negativo si el bloque es mayor que la ráfaga: se paga con espera después
+        self.tokens -= nbytes
+        future.set_result(None)
+
+    async def _sleep(self, seconds):
+        self.wakeup.clear()
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _run(self):
+        while True:
+            if not self.waiting:
+                await self._sleep(None)
+                continue
+            flow = self._next_flow()
+            nbytes, future = self.waiting[flow][0]
+            if self.rate <= 0 or future.done():
+                # Límite retirado o tarea cancelada: liberar sin cobrar
+                self._grant(flow, 0)
+                continue
+            self._refill()
+            needed = min(nbytes, self.capacity)
+            if self.tokens < needed:
+                await self._sleep((needed - self.tokens) / self.rate)
+                continue
+            self._grant(flow, nbytes)
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+
+
+class BandwidthManager:
+    """Límites de velocidad global y por usuario, de bajada y de subida, ajustables en caliente"""
+
+    def __init__(self):
+        self.global_limits = {'down': FairLimiter(BW_GLOBAL_DOWN), 'up': FairLimiter(BW_GLOBAL_UP)}
+        self.user_default = {'down': BW_USER_DOWN, 'up': BW_USER_UP}
+        self.user_overrides = {}  # (user_id, sentido) -> bytes/s
+        self.user_limits = {}  # (user_id, sentido) -> FairLimiter, solo mientras el usuario tiene tareas
+        self.user_tasks = {}  # user_id -> tareas activas
+
+    def user_rate(self, user_id, direction):
+        return self.user_overrides.get((user_id, direction), self.user_default[direction])
+
+    @staticmethod
+    def weight_for(size):
+        """Peso de una tarea según su tamaño: los archivos pequeños reciben más parte"""
+        return BW_SMALL_FILE_WEIGHT if 0 < size < BW_SMALL_FILE_SIZE else 1.0
+
+    def begin_task(self, user_id, weight=1.0):
+        """Asocia flujos de bajada y subida a la tarea actual (y a sus subtareas asyncio)"""
+        flows = {direction: Flow(user_id, direction, weight) for direction in DIRECTIONS}
+        self.user_tasks[user_id] = self.user_tasks.get(user_id, 0) + 1
+        for direction in DIRECTIONS:
+            if (user_id, direction) not in self.user_limits:
+                self.user_limits[(user_id, direction)] = FairLimiter(self.user_rate(user_id, direction))
+        _current_flows.set(flows)
+        return flows
+
+    def finish_task(self, flows):
+        user_id = flows['down'].user_id
+        for direction, flow in flows.items():
+            self.global_limits[direction].forget(flow)
+            self.user_limits[(user_id, direction)].forget(flow)
+        self.user_tasks[user_id] -= 1
+        if not self.user_tasks[user_id]:
+            del self.user_tasks[user_id]
+            for direction in DIRECTIONS:
+                limiter = self.user_limits.pop((user_id, direction))
+                if limiter.task:
+                    limiter.task.cancel()
+
+    async def throttle(self, direction, nbytes):
+        """Espera hasta que la tarea actual pueda transferir nbytes más en ese sentido"""
+        flows = _current_flows.get()
+        if flows is None:
+            return
+        flow = flows[direction]
+        user_limiter = self.user_limits.get((flow.user_id, direction))
+        if user_limiter:
+            await user_limiter.acquire(flow, nbytes)
+        await self.global_limits[direction].acquire(flow, nbytes)
+
+    def set_limit(self, direction, target, rate):
+        """target: 'global', 'user' (valor por defecto de cada usuario) o un user_id concreto"""
+        if target == 'global':
+            self.global_limits[direction].set_rate(rate)
+            return
+        if target == 'user':
+            self.user_default[direction] = rate
+            users = [user_id for user_id, d in self.user_limits if d == direction]
+        else:
+            self.user_overrides[(target, direction)] = rate
+            users = [target]
+        for user_id in users:
+            limiter = self.user_limits.get((user_id, direction))
+            if limiter:
+                limiter.set_rate(self.user_rate(user_id, direction))
+
+    def stats(self):
+        return {
+            'global': {d: self.global_limits[d].rate for d in DIRECTIONS},
+            'user': dict(self.user_default),
+            'overrides': dict(self.user_overrides),
+            'active_users': len(self.user_tasks)
+        }
+
+    async def stop(self):
+        for limiter in list(self.global_limits.values()) + list(self.user_limits.values()):
+            await limiter.stop()
+
+
+bandwidth = BandwidthManager()
+
+
+async def throttle(direction, nbytes):
+    await bandwidth.throttle(direction, nbytes)
@@ -0,0 +1,193 @@
+import os
+import re
+import time
+import asyncio
+import logging
+import humanize
+from contextlib import nullcontext
+from status_editor import status_editor, LocalStatus
+from checksum import parse_checksum
+
+logger = logging.getLogger(__name__)
+
+# Configuración
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', 3))  # elementos de un lote a la vez
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', 500))
+PLAYLIST_CONCURRENCY = int(os.environ.get('PLAYLIST_CONCURRENCY', 2))  # videos de una lista a la vez
+BATCH_LIST_MAX_BYTES = 1024 * 1024  # tamaño máximo de una lista .txt
+SUMMARY_MAX_FAILURES = 15  # fallos listados en el resumen (el mensaje tiene un límite de 4096 caracteres)
+
+_URL_PATTERN = re.compile(r'https?://\S+')
+
+
+def parse_links(text):
+    """Extrae los enlaces de un texto: uno por línea con ' | nombre' y ' | sha256:HEX' opcionales,
+    o varios separados por espacios.
+
+    Devuelve una lista de (url, nombre o None, (algoritmo, hash) o None) sin duplicados, en orden.
+    """
+    entries = []
+    seen = set()
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if " | " in line:
+            url, *fields = (part.strip() for part in line.split(" | "))
+            name = checksum = None
+            for field in fields:
+                # El hash esperado puede ir en cualquier campo; el resto es el nombre
+                parsed = parse_checksum(field)
+                if parsed and checksum is None:
+                    checksum = parsed
+                elif field and name is None:
+                    name = field
+            candidates = [(url, name, checksum)] if _URL_PATTERN.fullmatch(url) else []
+        else:
+            candidates = [(url, None, None) for url in _URL_PATTERN.findall(line)]
+        for entry in candidates:
+            if entry[:2] not in seen:
+                seen.add(entry[:2])
+                entries.append(entry)
+    return entries
+
+
+class BatchItem(LocalStatus):
+    """Elemento de un lote: su estado se agrega en el mensaje del lote"""
+
+    def __init__(self, url, name, on_change, checksum=None):
+        super().__init__()
+        self.url = url
+        self.name = name
+        self.checksum = checksum
+        self.on_change = on_change
+        self.outcome = None  # None mientras no termina
+
+    def set_progress(self, current, total, status):
+        # Solo cuenta la descarga: la subida volvería a empezar desde cero
+        if "Descargando" in status:
+            super().set_progress(current, total, status)
+            self.on_change()
+
+    @property
+    def error(self):
+        """Último mensaje de error mostrado por la tarea, sin el identificador"""
+        text = self.text or ""
+        return text.split("❌", 1)[1].strip() if "❌" in text else (self.outcome or "")
+
+
+class Batch:
+    """Lote de enlaces con un único mensaje de progreso agregado"""
+
+    def __init__(self, batch_id, entries, progress_msg):
+        self.batch_id = batch_id
+        self.items = []
+        self.progress_msg = progress_msg
+        self.start_time = time.time()
+        self.running = 0
+        self.expanding = False  # aún llegan elementos (lista de reproducción en extracción)
+        self.expand_error = None
+        for url, name, checksum in entries:
+            self.add(url, name, checksum)
+
+    def add(self, url, name, checksum=None):
+        item = BatchItem(url, name, self.refresh, checksum)
+        self.items.append(item)
+        return item
+
+    def _counts(self):
+        done = sum(1 for item in self.items if item.outcome in ('ok', 'cached'))
+        failed = sum(1 for item in self.items if item.outcome not in (None, 'ok', 'cached'))
+        return done, failed
+
+    def refresh(self):
+        status_editor.push(self.progress_msg, self.render)
+
+    def render(self):
+        done, failed = self._counts()
+        current = sum(item.current for item in self.items)
+        total = sum(item.total for item in self.items)
+        elapsed = time.time() - self.start_time
+        speed = current / elapsed if elapsed > 0 else 0
+        remaining = len(self.items) - done - failed
+        # Estimación por elementos: los tamaños de los pendientes aún no se conocen
+        finished = done + failed
+        eta = elapsed / finished * remaining if finished else 0
+        return (
+            f"[{self.batch_id}] **📦 Lote: {finished}/{len(self.items)}{'+' if self.expanding else ''}**\n"
+            f"✅ {done} · ❌ {failed} · ⏳ {self.running} en curso\n"
+            f"**📚 Descargado**: {humanize.naturalsize(current)}"
+            + (f" de {humanize.naturalsize(total)}" if total else "") + "\n"
+            f"**⚡ Velocidad**: {humanize.naturalsize(speed)}/s\n"
+            f"**⏰ Tiempo restante**: {humanize.naturaldelta(eta) if finished else 'calculando...'}"
+        )
+
+    def summary(self):
+        done, failed = self._counts()
+        elapsed = humanize.naturaldelta(time.time() - self.start_time)
+        lines = [
+            f"[{self.batch_id}] {'✅' if not failed and not self.expand_error else '⚠️'} Lote terminado en {elapsed}",
+            f"Correctos: {done}/{len(self.items)} · Fallidos: {failed}"
+        ]
+        if self.expand_error:
+            lines.append(f"⚠️ La lista no se pudo expandir por completo: {self.expand_error[:150]}")
+        failures = [item for item in self.items if item.outcome not in ('ok', 'cached')]
+        for item in failures[:SUMMARY_MAX_FAILURES]:
+            lines.append(f"• {item.url[:100]} — {item.error[:80]}")
+        if len(failures) > SUMMARY_MAX_FAILURES:
+            lines.append(f"… y {len(failures) - SUMMARY_MAX_FAILURES} más")
+        return "\n".join(lines)
+
+    async def _expand(self, source, workers, worker):
+        """Añade los elementos que entrega source y lanza su procesamiento"""
+        self.expanding = True
+        try:
+            async for url, name in source:
+                if len(self.items) >= BATCH_MAX_ITEMS:
+                    break
+                workers.append(asyncio.create_task(worker(self.add(url, name))))
+                self.refresh()
+        except Exception as e:
+            logger.error(f"Error expandiendo el lote {self.batch_id}: {str(e)}")
+            self.expand_error = str(e)
+        finally:
+            self.expanding = False
+            await source.aclose()
+
+    async def run(self, process_item, concurrency=BATCH_CONCURRENCY, source=None, slot=None):
+        """Procesa los elementos con como máximo concurrency a la vez.
+
+        process_item(item) devuelve el resultado de la tarea ('ok', 'cached', ...).
+        source, opcional, es un iterador asíncrono de (url, nombre) que añade elementos
+        mientras los primeros ya se están procesando.
+        slot, opcional, devuelve el contexto asíncrono que cada elemento ocupa además
+        (el hueco del planificador, para respetar los límites por usuario y globales).
+        """
+        slots = asyncio.Semaphore(concurrency)
+
+        async def worker(item):
+            async with slots, (slot() if slot else nullcontext()):
+                self.running += 1
+                self.refresh()
+                try:
+                    item.outcome = await process_item(item)
+                except Exception as e:
+                    logger.error(f"Error en elemento del lote {item.url}: {str(e)}")
+                    item.outcome = 'error'
+                    item.set_text(f"❌ {str(e)}")
+                finally:
+                    self.running -= 1
+                    if item.outcome in ('ok', 'cached'):
+                        item.current = item.total
+                self.refresh()
+
+        self.refresh()
+        workers = [asyncio.create_task(worker(item)) for item in self.items]
+        try:
+            if source is not None:
+                await self._expand(source, workers, worker)
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+        status_editor.push(self.progress_msg, self.summary())
@@ -0,0 +1,410 @@
+"""Benchmark offline de las rutas de transferencia.
+
+Levanta un origen HTTP local (aiohttp) que sirve archivos sintéticos y ejecuta
+download_content, split_and_upload y la subida por volúmenes contra un Client
+simulado que registra los envíos y limita el ancho de banda de subida. No hace
+falta Telegram ni conexión a internet:
+
+    python benchmark.py --size 256 --json bench_output.json
+
+Cada escenario informa MB/s, tiempo total, pico de RSS y pico de disco.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+import threading
+from types import SimpleNamespace
+from aiohttp import web
+
+os.environ.setdefault('API_ID', '1')
+
+import bot
+import split_upload
+from http_session import close_session
+from status_editor import status_editor
+from checksum import StreamHasher
+
+MB = 1024 * 1024
+PATTERN = bytes(range(256)) * 4096  # 1 MB
+ORIGIN_CHUNK = 256 * 1024
+
+
+def synthetic_bytes(offset, length):
+    """Bytes deterministas del archivo sintético en [offset, offset+length)"""
+    start = offset % len(PATTERN)
+    data = PATTERN[start:start + length]
+    while len(data) < length:
+        data += PATTERN[:length - len(data)]
+    return data
+
+
+class Origin:
+    """Servidor HTTP local con soporte opcional de rangos, límite de velocidad y errores"""
+
+    def __init__(self, ranges=True, rate=None, error_rate=0.0, seed=1):
+        self.ranges = ranges
+        self.rate = rate  # bytes/s por conexión
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.runner = None
+        self.port = None
+
+    async def handle(self, request):
+        self.requests += 1
+        size = int(request.match_info['size'])
+        start, end, status = 0, size - 1, 200
+        headers = {'ETag': f'"bench-{size}"', 'Content-Type': 'application/octet-stream'}
+        range_header = request.headers.get('Range')
+        if self.ranges:
+            headers['Accept-Ranges'] = 'bytes'
+            if range_header and range_header.startswith('bytes='):
+                first, _, last = range_header[6:].partition('-')
+                start = int(first)
+                end = min(int(last), size - 1) if last else size - 1
+                status = 206
+                headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+
+        response = web.StreamResponse(status=status, headers=headers)
+        response.content_length = end - start + 1
+        await response.prepare(request)
+        if request.method == 'HEAD':
+            return response
+
+        offset = start
+        while offset <= end:
+            length = min(ORIGIN_CHUNK, end + 1 - offset)
+            if self.error_rate and self.random.random() < self.error_rate:
+                # Cortar la conexión a mitad de la respuesta
+                request.transport.close()
+                return response
+            await response.write(synthetic_bytes(offset, length))
+            offset += length
+            if self.rate:
+                await asyncio.sleep(length / self.rate)
+        await response.write_eof()
+        return response
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/file/{size:\\d+}', self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    def url(self, size, name='bench.bin'):
+        return f'http://127.0.0.1:{self.port}/file/{size}?name={name}'
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+class StubMessage:
+    """Mensaje de estado simulado: registra las ediciones"""
+
+    def __init__(self, chat_id=1, message_id=1):
+        self.chat = SimpleNamespace(id=chat_id)
+        self.id = message_id
+        self.edits = []
+
+    async def edit(self, text):
+        self.edits.append(text)
+
+    async def reply(self, text):
+        return StubMessage(self.chat.id, self.id + 1)
+
+
+class StubParser:
+    """Parser de texto simulado: deja el pie de foto tal cual, sin entidades"""
+
+    async def parse(self, text, mode=None):
+        return {'message': text, 'entities': None}
+
+
+class StubClient:
+    """Client de pyrogram simulado con ancho de banda de subida limitado.
+
+    Como pyrogram, cada subida ocupa uno de max_concurrent_transmissions huecos.
+    """
+
+    PART_SIZE = 512 * 1024
+
+    def __init__(self, upload_rate=None, max_concurrent_transmissions=split_upload.UPLOAD_TRANSMISSIONS):
+        self.upload_rate = upload_rate  # bytes/s por subida
+        self.save_file_semaphore = asyncio.Semaphore(max_concurrent_transmissions)
+        self.calls = []
+        self.uploaded_bytes = 0
+        self.parser = StubParser()
+
+    def rnd_id(self):
+        return random.getrandbits(63)
+
+    def guess_mime_type(self, filename):
+        return None
+
+    async def resolve_peer(self, chat_id):
+        return chat_id
+
+    async def _consume(self, fp, progress):
+        async with self.save_file_semaphore:
+            return await self._transfer(fp, progress)
+
+    async def _transfer(self, fp, progress):
+        fp.seek(0, os.SEEK_END)
+        total = fp.tell()
+        fp.seek(0)
+        sent = 0
+        while True:
+            chunk = await asyncio.to_thread(fp.read, self.PART_SIZE)
+            if not chunk:
+                break
+            sent += len(chunk)
+            if self.upload_rate:
+                await asyncio.sleep(len(chunk) / self.upload_rate)
+            if progress:
+                await progress(sent, total)
+        self.uploaded_bytes += sent
+        return sent
+
+    async def save_file(self, path, file_id=None, file_part=0, progress=None, progress_args=()):
+        if isinstance(path, str):
+            with open(path, 'rb') as fp:
+                size = await self._consume(fp, progress)
+        else:
+            size = await self._consume(path, progress)
+        self.calls.append(('save_file', getattr(path, 'name', path), size))
+        return SimpleNamespace(id=file_id or self.rnd_id(), name=getattr(path, 'name', path))
+
+    async def invoke(self, rpc):
+        self.calls.append(('invoke', type(rpc).__name__))
+        return SimpleNamespace(updates=[], users=[], chats=[])
+
+    async def _send(self, kind, chat_id, media, progress=None, **kwargs):
+        size = 0
+        if isinstance(media, str) and os.path.exists(media):
+            with open(media, 'rb') as fp:
+                size = await self._consume(fp, progress)
+        self.calls.append((kind, os.path.basename(str(media)), size))
+        file = SimpleNamespace(file_id=f'{kind}-{len(self.calls)}')
+        return SimpleNamespace(
+            document=file if kind == 'send_document' else None,
+            video=file if kind == 'send_video' else None,
+            caption=kwargs.get('caption')
+        )
+
+    async def send_document(self, chat_id, document, progress=None, **kwargs):
+        return await self._send('send_document', chat_id, document, progress, **kwargs)
+
+    async def send_video(self, chat_id, video, progress=None, **kwargs):
+        return await self._send('send_video', chat_id, video, progress, **kwargs)
+
+
+class ResourceSampler:
+    """Muestrea en segundo plano el RSS del proceso y el disco usado en un directorio"""
+
+    def __init__(self, directory, interval=0.05):
+        self.directory = directory
+        self.interval = interval
+        self.peak_rss = 0
+        self.peak_disk = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @staticmethod
+    def _rss():
+        try:
+            with open('/proc/self/status') as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        return int(line.split()[1]) * 1024
+        except OSError:
+            pass
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def _disk(self):
+        total = 0
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                try:
+                    # Bloques reservados: un archivo preasignado sin escribir no cuenta
+                    total += os.stat(os.path.join(root, name)).st_blocks * 512
+                except OSError:
+                    pass
+        return total
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak_rss = max(self.peak_rss, self._rss())
+            self.peak_disk = max(self.peak_disk, self._disk())
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak_rss = max(self.peak_rss, self._rss())
+        return False
+
+
+async def run_download(origin, workdir, size):
+    """download_content de un enlace directo al directorio de trabajo, con el hash calculado durante la descarga"""
+    task_id = 'BENCH'
+    bot.active_tasks[task_id] = {'start_time': time.time(), 'progress_message': None}
+    message = StubMessage()
+
+    async def progress_callback(current, total, status, progress_msg, name, tid, stime):
+        await bot.progress_bar(current, total, status, progress_msg, name, tid, stime)
+
+    progress_callback.progress_message = message
+    file_path = os.path.join(workdir, 'bench.bin')
+    try:
+        url = origin.url(size)
+        info = await bot.probe_url(url)
+        hasher = StreamHasher()
+        ok = await bot.download_content(
+            url, file_path, progress_callback, task_id, 'bench.bin', time.time(), info, hasher
+        )
+        if ok:
+            with open(file_path, 'rb') as f:
+                head = f.read(MB)
+            ok = head == synthetic_bytes(0, len(head)) and os.path.getsize(file_path) == size == hasher.position
+        return ok, size
+    finally:
+        bot.active_tasks.pop(task_id, None)
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+
+async def run_split_upload(workdir, size, client):
+    """split_and_upload de un archivo local ya descargado"""
+    file_path = os.path.join(workdir, 'bench_split.bin')
+    with open(file_path, 'wb') as f:
+        for offset in range(0, size, MB):
+            f.write(synthetic_bytes(offset, min(MB, size - offset)))
+    message = StubMessage()
+    sent = await split_upload.split_and_upload(client, message, StubMessage(), file_path, 'BENCH')
+    return sent is not None, size
+
+
+async def run_pipeline(origin, workdir, size, client):
+    """Descarga por volúmenes solapada con la subida (bot.pipelined_task)"""
+    task_id = 'BENCH'
+    bot.active_tasks[task_id] = {'start_time': time.time(), 'progress_message': None}
+    url = origin.url(size)
+    try:
+        info = await bot.probe_url(url)
+        sent = await bot.pipelined_task(
+            client, StubMessage(), StubMessage(), url, 'bench_pipe.bin', info, task_id, time.time(), workdir,
+            StreamHasher(split_upload.VOLUME_SIZE)
+        )
+        return sent is not None, size
+    finally:
+        bot.active_tasks.pop(task_id, None)
+
+
+SCENARIOS = {
+    'download-ranges': dict(kind='download', ranges=True),
+    'download-no-ranges': dict(kind='download', ranges=False),
+    'download-throttled': dict(kind='download', ranges=True, throttled=True),
+    'download-errors': dict(kind='download', ranges=True, errors=True),
+    'split-upload': dict(kind='split'),
+    'pipeline': dict(kind='pipeline', ranges=True),
+}
+
+
+async def run_scenario(name, args):
+    spec = SCENARIOS[name]
+    size = args.size * MB
+    workdir = tempfile.mkdtemp(prefix=f'bench_{name}_')
+    origin = Origin(
+        ranges=spec.get('ranges', True),
+        rate=args.origin_rate * MB if spec.get('throttled') else None,
+        error_rate=args.error_rate if spec.get('errors') else 0.0
+    )
+    client = StubClient(upload_rate=args.upload_rate * MB if args.upload_rate else None,
+                        max_concurrent_transmissions=args.transmissions)
+    await origin.start()
+    try:
+        with ResourceSampler(workdir) as sampler:
+            start = time.monotonic()
+            if spec['kind'] == 'download':
+                ok, transferred = await run_download(origin, workdir, size)
+            elif spec['kind'] == 'split':
+                ok, transferred = await run_split_upload(workdir, size, client)
+            else:
+                ok, transferred = await run_pipeline(origin, workdir, size, client)
+            wall = time.monotonic() - start
+    finally:
+        await origin.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return {
+        'scenario': name,
+        'ok': ok,
+        'size_mb': args.size,
+        'wall_seconds': round(wall, 3),
+        'mb_per_s': round(transferred / MB / wall, 2) if wall > 0 else 0,
+        'peak_rss_mb': round(sampler.peak_rss / MB, 1),
+        'peak_disk_mb': round(sampler.peak_disk / MB, 1),
+        'origin_requests': origin.requests,
+        'uploads': sum(1 for call in client.calls if call[0] in ('save_file', 'send_document', 'send_video')),
+    }
+
+
+def print_table(results):
+    columns = ['scenario', 'ok', 'wall_seconds', 'mb_per_s', 'peak_rss_mb', 'peak_disk_mb',
+               'origin_requests', 'uploads']
+    widths = [max(len(col), *(len(str(r[col])) for r in results)) for col in columns]
+    print("  ".join(col.ljust(w) for col, w in zip(columns, widths)))
+    for result in results:
+        print("  ".join(str(result[col]).ljust(w) for col, w in zip(columns, widths)))
+
+
+async def main(args):
+    # Volúmenes pequeños para ejercitar la división sin generar gigas
+    split_upload.VOLUME_SIZE = args.volume_size * MB
+    bot.MAX_DIRECT_SIZE = args.volume_size * MB
+    results = []
+    try:
+        for name in args.scenarios:
+            result = await run_scenario(name, args)
+            results.append(result)
+            print(f"{name}: {result['mb_per_s']} MB/s en {result['wall_seconds']}s", file=sys.stderr)
+    finally:
+        await status_editor.stop()
+        await close_session()
+    print_table(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0 if all(r['ok'] for r in results) else 1
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=128, help='Tamaño del archivo sintético en MB')
+    parser.add_argument('--volume-size', type=int, default=48, help='Tamaño de volumen para la división en MB')
+    parser.add_argument('--upload-rate', type=float, default=0, help='Ancho de banda simulado por subida en MB/s (0 = ilimitado)')
+    parser.add_argument('--transmissions', type=int, default=split_upload.UPLOAD_TRANSMISSIONS,
+                        help='Subidas simultáneas del cliente simulado (max_concurrent_transmissions)')
+    parser.add_argument('--origin-rate', type=float, default=8, help='Velocidad por conexión del escenario throttled en MB/s')
+    parser.add_argument('--error-rate', type=float, default=0.002, help='Probabilidad de cortar la conexión por bloque de 256 KB')
+    parser.add_argument('--scenarios', nargs='+', default=list(SCENARIOS), choices=list(SCENARIOS))
+    parser.add_argument('--json', help='Guardar los resultados en este archivo JSON')
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(asyncio.run(main(parse_args())))
@@ -1,20 +1,33 @@
 import os
-import subprocess
-import asyncio
 import time
-import re
 import logging
 import mimetypes
 import uuid
-import json
 import math
 import humanize
-import aiohttp
-from pyrogram import Client, filters
+from functools import partial
+from pyrogram import Client, filters, idle
 from pyrogram.types import Message
-from pyrogram.errors import FloodWait
-from split_upload import split_and_upload
-from urllib.parse import urlparse, unquote, parse_qs
+from split_upload import (split_and_upload, pipelined_split_upload, upload_video_parts, sent_item, VOLUME_SIZE,
+                          PIPELINE_VOLUMES_ON_DISK, UPLOAD_TRANSMISSIONS)
+from downloader import download_direct, download_range, has_journal
+from storage import storage
+from probe import probe_url, probe_cache, safe_filename
+from http_session import get_session, close_session
+from scheduler import scheduler, Job, QueueFull
+from media_tools import prepare_video, get_video_metadata, split_video_by_time
+from file_cache import file_cache
+from status_editor import status_editor, LocalStatus
+from batch import Batch, parse_links, BATCH_MAX_ITEMS, BATCH_LIST_MAX_BYTES, BATCH_CONCURRENCY, PLAYLIST_CONCURRENCY
+from metrics import begin_task, finish_task, track_stage, start_metrics_server
+from ytdlp_engine import ytdlp_engine, YtdlpInterrupted
+from bandwidth import bandwidth, throttle
+from checksum import StreamHasher, hash_file, find_mismatch, caption_line
+from job_queue import job_queue
+from worker_pool import WorkerPool, QUEUE_WORKERS, queued_text
+from updater import updater
+from compression import plan_for_file, plan_for_url, compress_file
+from manifest import download_manifest, ManifestUnsupported
 
 # Configuración
 API_ID = int(os.environ.get('API_ID', 0))
@@ -22,6 +35,8 @@ API_HASH = os.environ.get('API_HASH', '')
 BOT_TOKEN = os.environ.get('BOT_TOKEN', '')
 OWNER_ID = int(os.environ.get('OWNER_ID', 0))
 MAX_DIRECT_SIZE = 1990 * 1024 * 1024  # 1990 MB
+MAX_FILE_SIZE = int(os.environ.get('MAX_FILE_SIZE', 0))  # bytes, 0 = sin límite
+VIDEO_SPLIT_MODE = os.environ.get('VIDEO_SPLIT_MODE', 'time')  # 'time': partes reproducibles, 'volumes': .001...
 
 # Configurar logging
 logging.basicConfig(
@@ -41,76 +56,79 @@ app = Client(
     "download_bot",
     api_id=API_ID,
     api_hash=API_HASH,
-    bot_token=BOT_TOKEN
+    bot_token=BOT_TOKEN,
+    max_concurrent_transmissions=UPLOAD_TRANSMISSIONS
 )
 
 # Sistema de seguimiento de tareas
 active_tasks = {}
-progress_last_update = {}
-user_active_tasks = {}
 
-# Lista de dominios compatibles con yt-dlp
-YTDLP_DOMAINS = [
-    "youtube.com", "youtu.be", "facebook.com", "instagram.com", 
-    "twitter.com", "tiktok.com", "twitch.tv", "vimeo.com",
-    "dailymotion.com", "bilibili.com", "nicovideo.jp", "soundcloud.com"
-]
+# Grupo de procesos de trabajo (solo en modo cola)
+worker_pool = None
 
 def is_owner(user_id):
     return user_id == OWNER_ID
 
-def requires_ytdlp(url):
-    """Determina si la URL requiere yt-dlp para descargar"""
-    url_lower = url.lower()
-    if any(key in url_lower for key in ["m3u8", "hls", "mpd", "dash"]):
-        return True
-    
-    try:
-        domain = urlparse(url).netloc.lower()
-        return any(d in domain for d in YTDLP_DOMAINS)
-    except:
-        return False
+def is_video_file(name, mime_type=None):
+    mime_type = mime_type or mimetypes.guess_type(name)[0]
+    return bool(mime_type) and mime_type.startswith('video/')
 
-def get_filename_from_url(url):
-    """Extrae el nombre de archivo desde la URL"""
-    try:
-        parsed = urlparse(url)
-        path = unquote(parsed.path)
-        
-        if "/" in path:
-            filename = path.split("/")[-1]
-            if "." in filename and len(filename) > 4:
-                return filename
-        
-        query = parse_qs(parsed.query)
-        for key in ["filename", "name", "file"]:
-            if key in query:
-                value = query[key][0]
-                if "." in value:
-                    return value
-    except Exception as e:
-        logger.error(f"Error extrayendo nombre: {str(e)}")
-    
-    # Nombres por defecto
-    if "video" in url:
-        return "video.mp4"
-    elif "audio" in url:
-        return "audio.mp3"
-    elif "image" in url:
-        return "image.jpg"
-    
-    return f"archivo_{int(time.time())}.bin"
+def choose_split(info):
+    """Estrategia de subida según el tamaño anunciado: 'video', 'pipelined', 'split' o 'none'"""
+    if info['size'] <= MAX_DIRECT_SIZE:
+        return 'none'
+    if VIDEO_SPLIT_MODE == 'time' and is_video_file(info['filename'] or '', info['mime_type']):
+        # Partes reproducibles: hace falta el video completo y espacio para las partes
+        return 'video'
+    return 'pipelined' if info['engine'] == 'segmented' else 'split'
+
+def disk_reservation(info):
+    """Bytes de disco que necesita la tarea según el tamaño anunciado y la estrategia"""
+    if info['engine'] in ('ytdlp', 'manifest'):
+        # yt-dlp y los manifiestos no informan del tamaño antes de descargar
+        return storage.reservation_for(0)
+    split = choose_split(info)
+    if split == 'pipelined':
+        # La subida por volúmenes solo necesita dos volúmenes en disco a la vez
+        return storage.reservation_for(min(info['size'], PIPELINE_VOLUMES_ON_DISK * VOLUME_SIZE))
+    if split == 'video':
+        # El original más las partes cortadas con ffmpeg
+        return storage.reservation_for(2 * info['size'])
+    return storage.reservation_for(info['size'])
+
+def admission_error(info):
+    """Motivo por el que el enlace no se puede aceptar, o None"""
+    if info['error']:
+        return f"El enlace no es descargable ({info['error']})"
+    size = info['size']
+    if MAX_FILE_SIZE and size > MAX_FILE_SIZE:
+        return (f"El archivo ({humanize.naturalsize(size)}) supera el máximo permitido "
+                f"({humanize.naturalsize(MAX_FILE_SIZE)})")
+    needed = disk_reservation(info)
+    if not storage.fits(needed):
+        return f"No hay espacio en disco para {humanize.naturalsize(needed)}"
+    return None
+
+def expected_digests(info, checksum):
+    """Hashes esperados con su origen: los del servidor y el indicado en el mensaje"""
+    sources = [("el servidor", info['digests'])]
+    if checksum:
+        sources.append(("el indicado", dict([checksum])))
+    return sources
+
+def checksum_error(digests, info, checksum):
+    """Motivo por el que el contenido descargado no es íntegro, o None"""
+    for label, expected in expected_digests(info, checksum):
+        mismatch = find_mismatch(digests, expected)
+        if mismatch:
+            algorithm, wanted, got = mismatch
+            return (f"El archivo está corrupto: el {algorithm} no coincide con {label}\n"
+                    f"Esperado: `{wanted}`\nObtenido: `{got}`")
+    return None
 
 async def safe_edit_message(message: Message, text: str):
-    """Edita un mensaje de forma segura manejando FloodWait"""
-    try:
-        await message.edit(text)
-    except FloodWait as e:
-        logger.warning(f"FloodWait: Esperando {e.value} segundos")
-        await asyncio.sleep(e.value)
-        await message.edit(text)
-    except Exception as e:
-        logger.error(f"Error editando mensaje: {str(e)}")
+    """Programa la edición de un mensaje en el editor de estado (no espera ni bloquea)"""
+    status_editor.push(message, text)
 
 async def progress_bar(
     current: int, 
@@ -121,18 +139,12 @@ async def progress_bar(
     task_id: str, 
     start_time: float
 ):
-    """Muestra una barra de progreso con manejo de FloodWait"""
+    """Envía el progreso al editor de estado, que limita y agrupa las ediciones"""
+    if isinstance(progress_message, LocalStatus):
+        progress_message.set_progress(current, total, status_msg)
     present = time.time()
-    key = f"{task_id}_{status_msg}"
-    
-    # Actualizar máximo cada 20 segundos o al completar
-    last_update = progress_last_update.get(key, 0)
-    if present - last_update < 20 and current != total:
-        return
-        
-    progress_last_update[key] = present
     
-    try:
+    def render():
         elapsed = present - start_time
         speed = current / elapsed if elapsed > 0 else 0
         percentage = current * 100 / total if total > 0 else 0
@@ -144,7 +156,7 @@ async def progress_bar(
             "".join(["⚫" for _ in range(10 - math.floor(percentage / 10))]),
         )
 
-        current_message = (
+        return (
             f"[{task_id}] **{status_msg}**\n"
             f"**{filename}**\n"
             f"📊 {round(percentage, 2)}%\n"
@@ -155,100 +167,93 @@ async def progress_bar(
             f"**⏰ Tiempo restante**: {time_to_complete_str}"
         )
 
-        await safe_edit_message(progress_message, current_message)
-    except Exception as e:
-        logger.error(f"Error actualizando progreso: {str(e)}")
+    status_editor.push(progress_message, render)
 
-async def download_with_aiohttp(url, filepath, progress_callback, task_id, filename, start_time):
-    """Descarga usando aiohttp con manejo de cancelación"""
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                if response.status != 200:
-                    return False
-                
-                total_size = int(response.headers.get('Content-Length', 0))
-                downloaded = 0
-                chunk_size = 1024 * 1024  # 1 MB
-                
-                with open(filepath, 'wb') as f:
-                    async for chunk in response.content.iter_chunked(chunk_size):
-                        if task_id not in active_tasks:
-                            return False
-                            
-                        f.write(chunk)
-                        downloaded += len(chunk)
-                        await progress_callback(
-                            downloaded, 
-                            total_size,
-                            "📥 Descargando",
-                            progress_callback.progress_message,
-                            filename,
-                            task_id,
-                            start_time
-                        )
-        return True
-    except Exception as e:
-        logger.error(f"Error aiohttp: {str(e)}")
-        return False
+async def download_with_aiohttp(url, filepath, progress_callback, task_id, filename, start_time, info=None,
+                                hasher=None):
+    """Descarga usando aiohttp (varias conexiones si hay soporte de rangos)"""
+    async def on_progress(downloaded, total_size):
+        await progress_callback(
+            downloaded,
+            total_size,
+            "📥 Descargando",
+            progress_callback.progress_message,
+            filename,
+            task_id,
+            start_time
+        )
+
+    return await download_direct(
+        url,
+        filepath,
+        on_progress,
+        lambda: task_id not in active_tasks,
+        info=info,
+        hasher=hasher
+    )
 
 async def download_with_ytdlp(url, filepath, progress_callback, task_id, filename, start_time):
-    """Descarga usando yt-dlp con progreso unificado"""
-    try:
-        cmd = [
-            "yt-dlp",
-            "-o", filepath,
-            "--no-playlist",
-            "--concurrent-fragments", "5",
-            "--newline",
-            "-f", "bestvideo[height<=720]+bestaudio/best[height<=720]/best",
-            url
-        ]
-        
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.STDOUT
+    """Descarga usando yt-dlp dentro del proceso con progreso real en bytes.
+
+    Devuelve la ruta final, que lleva la extensión del formato descargado.
+    """
+    async def on_progress(downloaded, total_size):
+        await progress_callback(
+            downloaded,
+            total_size,
+            "📥 Descargando",
+            progress_callback.progress_message,
+            filename,
+            task_id,
+            start_time
         )
-        
-        active_tasks[task_id]['process'] = process
-        progress_pattern = re.compile(
-            r'\[download\]\s+(\d+\.\d+)%.*?(\d+\.\d+)([KM]iB)/s.*?ETA\s+(\d+:\d+)'
+
+    return await ytdlp_engine.download(
+        url,
+        filepath,
+        on_progress,
+        lambda: task_id not in active_tasks
+    )
+
+async def download_with_manifest(url, filepath, progress_callback, task_id, filename, start_time):
+    """Descarga un manifiesto HLS/DASH por segmentos sin yt-dlp; el progreso es exacto por segmentos"""
+    async def on_progress(downloaded, total_size, done, count):
+        await progress_callback(
+            downloaded,
+            total_size,
+            f"📥 Descargando ({done}/{count} segmentos)",
+            progress_callback.progress_message,
+            filename,
+            task_id,
+            start_time
         )
-        
-        while True:
-            if task_id not in active_tasks:
-                process.terminate()
-                return False
-                
-            line = await process.stdout.readline()
-            if not line:
-                break
-                
-            line = line.decode().strip()
-            match = progress_pattern.search(line)
-            if match:
-                percent = float(match.group(1))
-                downloaded = (percent / 100) * progress_callback.total_size
-                await progress_callback(
-                    int(downloaded),
-                    progress_callback.total_size,
-                    "📥 Descargando",
-                    progress_callback.progress_message,
-                    filename,
-                    task_id,
-                    start_time
-                )
-        
-        await process.wait()
-        return process.returncode == 0
-    except Exception as e:
-        logger.error(f"Error yt-dlp: {str(e)}")
-        return False
 
-async def download_content(url, filepath, progress_callback, task_id, filename, start_time):
-    """Elige el método de descarga basado en el tipo de URL"""
-    if requires_ytdlp(url):
+    return await download_manifest(
+        url,
+        filepath,
+        on_progress,
+        lambda: task_id not in active_tasks
+    )
+
+async def download_content(url, filepath, progress_callback, task_id, filename, start_time, info, hasher=None):
+    """Descarga con el motor elegido en la consulta previa (hasher solo se usa con descarga directa).
+
+    Con yt-dlp devuelve la ruta final en lugar de True: su extensión puede no ser la de filepath.
+    """
+    if info['engine'] == 'manifest':
+        logger.info(f"Descargando manifiesto por segmentos: {url}")
+        try:
+            return await download_with_manifest(
+                info['final_url'],
+                filepath,
+                progress_callback,
+                task_id,
+                filename,
+                start_time
+            )
+        except ManifestUnsupported as e:
+            logger.info(f"Manifiesto no soportado ({str(e)}), usando yt-dlp: {url}")
+    if info['engine'] in ('ytdlp', 'manifest'):
         logger.info(f"Usando yt-dlp para URL: {url}")
         return await download_with_ytdlp(
             url, 
@@ -259,76 +264,39 @@ async def download_content(url, filepath, progress_callback, task_id, filename,
             start_time
         )
     else:
-        logger.info(f"Descargando directamente: {url}")
+        logger.info(f"Descargando directamente ({info['engine']}): {url}")
         return await download_with_aiohttp(
             url, 
             filepath,
             progress_callback,
             task_id,
             filename,
-            start_time
+            start_time,
+            info,
+            hasher
         )
 
-def get_video_metadata(file_path):
-    """Obtiene metadatos del video usando ffprobe"""
-    try:
-        result = subprocess.run(
-            ['ffprobe', '-v', 'quiet', '-print_format', 'json', '-show_format', '-show_streams', file_path],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True
-        )
-        metadata = json.loads(result.stdout)
-        
-        video_stream = next((stream for stream in metadata['streams'] if stream['codec_type'] == 'video'), None)
-        
-        if video_stream:
-            width = int(video_stream.get('width', 0))
-            height = int(video_stream.get('height', 0))
-            duration = float(metadata['format'].get('duration', 0))
-            size = int(metadata['format'].get('size', 0))
-            return {
-                'resolution': f"{width}x{height}",
-                'duration': duration,
-                'size': size
-            }
-        return None
-    except Exception as e:
-        logger.error(f"Error obteniendo metadatos: {str(e)}")
-        return None
-
-def generate_thumbnail(video_path, task_id):
-    """Genera una miniatura para el video"""
-    try:
-        thumb_path = f"/tmp/thumb_{task_id}.jpg"
-        subprocess.run(
-            ['ffmpeg', '-i', video_path, '-ss', '00:00:05', '-vframes', '1', '-q:v', '2', thumb_path],
-            check=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE
-        )
-        return thumb_path
-    except Exception as e:
-        logger.error(f"Error generando miniatura: {e}")
-        return None
-
 @app.on_message(filters.command("start"))
 async def start(client: Client, message: Message):
     await safe_edit_message(
         message,
         "🤖 **Bot de Descargas Avanzado**\n\n"
         "Envía un enlace directo a un archivo o video\n\n"
-        "Puedes agregar un nombre personalizado:\n"
-        "`https://ejemplo.com/video.mp4 | Mi Video.mp4`\n\n"
+        "Puedes agregar un nombre personalizado y el hash esperado:\n"
+        "`https://ejemplo.com/video.mp4 | Mi Video.mp4 | sha256:...`\n\n"
+        "Varios enlaces en un mensaje o una lista .txt se procesan como un lote\n\n"
         "Comandos:\n"
         "/start - Muestra este mensaje\n"
-        "/update - Actualiza herramientas (propietario)\n\n"
-        "⚠️ Solo 1 tarea activa por usuario"
+        "/playlist <url> [inicio-fin] [límite] - Descarga una lista de reproducción o canal\n"
+        "/update - Actualiza yt-dlp sin reiniciar (propietario)\n"
+        "/cachestats - Estado de la caché (propietario)\n"
+        "/limit - Límites de velocidad (propietario)\n\n"
+        "⏳ Los enlaces se procesan en cola, por turnos entre usuarios"
     )
 
 @app.on_message(filters.command("update") & filters.private)
 async def update_bot(client: Client, message: Message):
-    """Actualiza herramientas y reinicia el bot"""
+    """Actualiza yt-dlp en caliente sin cortar las descargas ni las subidas en curso"""
     if not is_owner(message.from_user.id):
         await message.reply("❌ Solo el propietario puede usar este comando")
         return
@@ -336,34 +304,23 @@ async def update_bot(client: Client, message: Message):
     msg = await message.reply("🔄 Actualizando herramientas...")
     log_file = "/tmp/update_error.log"
     
+    async def on_status(text):
+        await safe_edit_message(msg, text)
+    
     try:
-        result = subprocess.run(
-            ["pip", "install", "--upgrade", "yt-dlp"],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True
-        )
-        
-        if result.returncode != 0:
-            raise Exception(f"Error actualizando: {result.stdout}")
-        
-        version_result = subprocess.run(
-            ["yt-dlp", "--version"],
-            stdout=subprocess.PIPE,
-            text=True
-        )
-        ytdlp_version = version_result.stdout.strip()
-        
+        previous, version, interrupted = await updater.update(on_status, worker_pool)
+        if version == previous:
+            await safe_edit_message(msg, f"✅ yt-dlp ya está en la última versión ({version})")
+            return
+        resumed = f"\n♻️ {interrupted} tareas se detuvieron y continúan donde iban" if interrupted else ""
         await safe_edit_message(
             msg,
-            f"✅ Herramientas actualizadas:\n"
-            f"- yt-dlp: {ytdlp_version}\n\n"
-            "Reiniciando bot..."
+            f"✅ Herramientas actualizadas sin reiniciar:\n"
+            f"- yt-dlp: {previous} → {version}{resumed}"
         )
-        await asyncio.sleep(3)
-        os._exit(0)
         
     except Exception as e:
+        logger.error(f"Error actualizando yt-dlp: {str(e)}")
         with open(log_file, "w") as f:
             f.write(str(e))
         
@@ -374,98 +331,506 @@ async def update_bot(client: Client, message: Message):
         )
         await safe_edit_message(msg, "⚠️ Actualización fallida. Ver log para detalles.")
 
-@app.on_message(filters.text | filters.command)
-async def handle_links(client: Client, message: Message):
-    """Procesa enlaces de archivos/videos"""
-    user_id = message.from_user.id
+@app.on_message(filters.command("cachestats") & filters.private)
+async def cache_stats(client: Client, message: Message):
+    """Muestra el estado de la caché de archivos subidos"""
+    if not is_owner(message.from_user.id):
+        await message.reply("❌ Solo el propietario puede usar este comando")
+        return
     
-    # Verificar si el usuario tiene una tarea activa
-    if user_id in user_active_tasks:
-        task_id_actual = user_active_tasks[user_id]
-        if task_id_actual in active_tasks:
+    stats = await file_cache.stats()
+    disk = storage.stats()
+    queue = "\n\n📋 **Cola compartida**\n" + (
+        "En espera: {queued} · En curso: {running} · Procesos ocupados: {busy_workers}\n"
+        "Terminadas: {done} · Abandonadas: {failed}".format(**await job_queue.stats())
+    ) if QUEUE_WORKERS else ""
+    await message.reply(
+        "🗄️ **Caché de archivos**\n"
+        f"Entradas: {stats['entries']}\n"
+        f"Aciertos: {stats['hits']}\n"
+        f"Fallos: {stats['misses']} ({stats['stale']} caducadas)\n"
+        f"Tasa de aciertos: {stats['hit_rate'] * 100:.1f}%\n\n"
+        "💾 **Disco**\n"
+        f"Reservado: {humanize.naturalsize(disk['reserved'])} de {humanize.naturalsize(disk['budget'])}\n"
+        f"Tareas: {disk['active']} activas, {disk['waiting']} esperando espacio, "
+        f"{disk['retained']} descargas parciales conservadas"
+        + queue
+    )
+
+def new_task_id():
+    return str(uuid.uuid4())[:8].upper()
+
+async def queued_count(user_id):
+    """Tareas del usuario en espera, en este proceso o en la cola compartida"""
+    if QUEUE_WORKERS:
+        return await job_queue.queued_count(user_id)
+    return scheduler.queued_count(user_id)
+
+async def check_queue_depth(message: Message):
+    """Avisa y devuelve False si el usuario ya tiene demasiadas tareas en espera"""
+    if await queued_count(message.from_user.id) >= scheduler.user_queue_depth:
+        await message.reply(
+            "⚠️ Tienes demasiadas tareas en cola.\n"
+            f"Máximo: {scheduler.user_queue_depth} en espera.\n\n"
+            "Espera a que avance la cola antes de enviar otra."
+        )
+        return False
+    return True
+
+def parse_rate(text):
+    """Convierte '50M', '512K', '1.5G' o '0' en bytes por segundo; None si no es válido"""
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    text = text.strip().upper().removesuffix('/S').removesuffix('B')
+    factor = units.get(text[-1:], 1)
+    number = text[:-1] if text[-1:] in units else text
+    try:
+        value = float(number)
+    except ValueError:
+        return None
+    return int(value * factor) if value >= 0 else None
+
+def format_rate(rate):
+    return f"{humanize.naturalsize(rate)}/s" if rate else "sin límite"
+
+@app.on_message(filters.command("limit") & filters.private)
+async def bandwidth_limit(client: Client, message: Message):
+    """Consulta o cambia en caliente los límites de velocidad"""
+    if not is_owner(message.from_user.id):
+        await message.reply("❌ Solo el propietario puede usar este comando")
+        return
+    
+    args = message.command[1:]
+    if args:
+        direction = {'down': 'down', 'bajada': 'down', 'up': 'up', 'subida': 'up'}.get(args[0].lower())
+        target = args[1].lower() if len(args) > 1 else None
+        rate = parse_rate(args[2]) if len(args) > 2 else None
+        if target and target.isdigit():
+            target = int(target)
+        if len(args) != 3 or direction is None or target not in ('global', 'user') and not isinstance(target, int) \
+                or rate is None:
             await message.reply(
-                "⚠️ Ya tienes una tarea en curso.\n"
-                f"ID de tarea: `{task_id_actual}`\n\n"
-                "Espera a que finalice antes de enviar otra."
+                "Uso: `/limit <down|up> <global|user|ID> <velocidad>`\n"
+                "Ejemplos: `/limit down global 50M`, `/limit up user 5M`, `/limit down 12345 0`\n"
+                "`0` quita el límite"
             )
             return
+        bandwidth.set_limit(direction, target, rate)
     
-    user_input = message.text
-    parts = user_input.split(" | ", 1)
-    url = parts[0].strip()
-    custom_name = parts[1].strip() if len(parts) > 1 else None
+    stats = bandwidth.stats()
+    lines = [
+        "📶 **Límites de velocidad**",
+        f"Global: ⬇️ {format_rate(stats['global']['down'])} · ⬆️ {format_rate(stats['global']['up'])}",
+        f"Por usuario: ⬇️ {format_rate(stats['user']['down'])} · ⬆️ {format_rate(stats['user']['up'])}",
+    ]
+    for (user_id, direction), rate in sorted(stats['overrides'].items()):
+        lines.append(f"Usuario {user_id}: {'⬇️' if direction == 'down' else '⬆️'} {format_rate(rate)}")
+    lines.append(f"Usuarios transfiriendo: {stats['active_users']}")
+    await message.reply("\n".join(lines))
+
+@app.on_message(filters.document & filters.private)
+async def handle_link_list(client: Client, message: Message):
+    """Recibe una lista .txt de enlaces (uno por línea, con ' | nombre' opcional) y la procesa como lote"""
+    document = message.document
+    if not (document.file_name or "").lower().endswith(".txt") and document.mime_type != "text/plain":
+        return
+    if document.file_size > BATCH_LIST_MAX_BYTES:
+        await message.reply("❌ La lista es demasiado grande")
+        return
     
-    if not url.startswith(("http://", "https://")):
+    data = await client.download_media(message, in_memory=True)
+    entries = parse_links(data.getvalue().decode('utf-8', errors='replace'))
+    if not entries:
+        await message.reply("❌ La lista no contiene enlaces válidos")
+        return
+    await submit_batch(client, message, entries)
+
+def parse_playlist_args(args):
+    """Interpreta '[inicio-fin] [límite]' de /playlist; devuelve (inicio, fin, límite) o None si no es válido"""
+    start, end, limit = 1, None, None
+    for arg in args:
+        if "-" in arg:
+            first, _, last = arg.partition("-")
+            if not (first or last) or not (first or "1").isdigit() or (last and not last.isdigit()):
+                return None
+            start = int(first or 1)
+            end = int(last) if last else None
+        elif arg.isdigit():
+            limit = int(arg)
+        else:
+            return None
+    if start < 1 or (end is not None and end < start) or limit == 0:
+        return None
+    return start, end, limit
+
+@app.on_message(filters.command("playlist"))
+async def handle_playlist(client: Client, message: Message):
+    """Expande una lista de reproducción o canal y descarga sus videos como un lote"""
+    selection = parse_playlist_args(message.command[2:]) if len(message.command) > 1 else None
+    url = message.command[1] if len(message.command) > 1 else ""
+    if not url.startswith(("http://", "https://")) or selection is None:
+        await message.reply(
+            "Uso: `/playlist <url> [inicio-fin] [límite]`\n"
+            "Ejemplos: `/playlist <url> 10` (primeros 10), `/playlist <url> 5-20`"
+        )
+        return
+    
+    start, end, limit = selection
+    await submit_batch(client, message, [], playlist={'url': url, 'start': start, 'end': end, 'limit': limit},
+                       concurrency=PLAYLIST_CONCURRENCY, label="Lista de reproducción")
+
+async def playlist_source(url, start, end, limit):
+    """Elementos de una lista de reproducción según se extraen, como (url, nombre).
+
+    La extensión del nombre es provisional: yt-dlp la cambia por la del formato descargado.
+    """
+    async for item_url, title in ytdlp_engine.iter_playlist(url, start, end, limit):
+        yield item_url, f"{title}.mp4" if title else None
+
+@app.on_message(filters.text | filters.command)
+async def handle_links(client: Client, message: Message):
+    """Recibe enlaces de archivos/videos y los encola en el planificador"""
+    entries = parse_links(message.text)
+    if not entries:
+        return
+    if len(entries) > 1:
+        await submit_batch(client, message, entries)
+        return
+    
+    url, custom_name, checksum = entries[0]
+    if not await check_queue_depth(message):
         return
     
     # Generar ID único para la tarea
-    task_id = str(uuid.uuid4())[:8].upper()
-    user_active_tasks[user_id] = task_id
+    task_id = new_task_id()
     
-    # Obtener nombre de archivo
-    original_filename = get_filename_from_url(url)
-    filename = custom_name or original_filename
+    # Consultar el enlace antes de encolar: los que no se pueden atender fallan al instante
+    info = await probe_url(url)
+    problem = admission_error(info)
+    if problem:
+        await message.reply(f"❌ {problem}")
+        return
     
-    msg = await message.reply(f"[{task_id}] ⏬ Iniciando descarga...")
+    # Obtener nombre de archivo (Content-Disposition o URL salvo nombre personalizado)
+    filename = (custom_name and safe_filename(custom_name)) or info['filename']
+    
+    msg = await message.reply(f"[{task_id}] 🕐 En cola...")
+    await enqueue(client, message, msg, task_id, 'link', {'url': url, 'filename': filename, 'checksum': checksum})
+
+async def submit_batch(client: Client, message: Message, entries, playlist=None,
+                       concurrency=BATCH_CONCURRENCY, label="Lote"):
+    """Encola varios enlaces como un solo trabajo con un mensaje de progreso común.
+
+    playlist ({'url', 'start', 'end', 'limit'}), opcional, añade los elementos de una
+    lista de reproducción que se expande al empezar el trabajo.
+    """
+    if len(entries) > BATCH_MAX_ITEMS:
+        await message.reply(f"❌ Demasiados enlaces en el lote (máximo {BATCH_MAX_ITEMS})")
+        return
+    if not await check_queue_depth(message):
+        return
+    
+    batch_id = new_task_id()
+    size = f"de {len(entries)} enlaces " if entries else ""
+    msg = await message.reply(f"[{batch_id}] 🕐 {label} {size}en cola...")
+    payload = {'entries': entries, 'concurrency': concurrency, 'label': label, 'playlist': playlist}
+    await enqueue(client, message, msg, batch_id, 'batch', payload)
+
+async def enqueue(client: Client, message: Message, msg: Message, task_id: str, kind: str, payload):
+    """Encola una tarea en el planificador de este proceso o, en modo cola, para los procesos de trabajo.
+
+    payload debe ser serializable en JSON: es lo que recibe run_job en el proceso que la ejecute.
+    """
+    if QUEUE_WORKERS:
+        await job_queue.submit(task_id, message.from_user.id, message.chat.id, message.id, msg.id, kind, payload)
+        return
+    
+    async def on_queued(position):
+        await safe_edit_message(msg, queued_text(task_id, position, payload.get('label')))
+    
+    async def run():
+        await run_job(client, message, msg, task_id, kind, payload, job.queue_wait, job)
+    
+    job = Job(task_id, message.from_user.id, run, on_queued)
+    try:
+        scheduler.submit(job)
+    except QueueFull:
+        await safe_edit_message(msg, f"[{task_id}] ⚠️ Cola llena, inténtalo más tarde")
+
+async def run_job(client: Client, message: Message, msg: Message, task_id: str, kind: str, payload,
+                  queue_wait: float = 0.0, job: Job = None):
+    """Ejecuta una tarea encolada ('link' o 'batch') y devuelve su resultado.
+
+    message solo necesita chat.id y from_user.id, y msg puede ser un estado remoto:
+    así la misma tarea se ejecuta en el bot o en un proceso de trabajo.
+    job es la tarea del planificador local, si la hay.
+    """
+    if kind == 'link':
+        checksum = tuple(payload['checksum']) if payload['checksum'] else None
+        return await process_resumable(client, message, msg, payload['url'], payload['filename'], task_id,
+                                       queue_wait, checksum)
+    
+    entries = [(url, name, tuple(checksum) if checksum else None) for url, name, checksum in payload['entries']]
+    batch = Batch(task_id, entries, msg)
+    playlist = payload['playlist']
+    source = playlist_source(**playlist) if playlist else None
+    
+    async def process_item(item):
+        # Cada elemento es una tarea normal que informa a su entrada del lote
+        name = item.name and safe_filename(item.name)
+        return await process_resumable(client, message, item, item.url, name, new_task_id(), queue_wait,
+                                       item.checksum)
+    
+    slot = None
+    if job is not None:
+        # Cada elemento ocupa un hueco del planificador como una tarea suelta; el lote
+        # devuelve el suyo y sus elementos (hasta su concurrencia) cuentan para MAX_WORKERS
+        scheduler.release(job)
+        slot = partial(scheduler.slot, job.user_id)
+    
+    await batch.run(process_item, payload['concurrency'], source, slot)
+    return 'ok'
+
+async def process_resumable(client: Client, message: Message, msg: Message, url: str, filename: str, task_id: str,
+                            queue_wait: float = 0.0, checksum=None):
+    """process_task que no empieza mientras se actualiza yt-dlp y repite las descargas que
+    la actualización detuvo (reanudan desde sus .part con la versión nueva)"""
+    async def on_pause():
+        await safe_edit_message(msg, f"[{task_id}] ⏸️ En pausa mientras se actualiza yt-dlp...")
+    
+    while True:
+        await updater.wait_resumed(on_pause)
+        outcome = await process_task(client, message, msg, url, filename, task_id, queue_wait, checksum)
+        if outcome != 'interrupted':
+            return outcome
+
+async def process_task(client: Client, message: Message, msg: Message, url: str, filename: str, task_id: str,
+                       queue_wait: float = 0.0, checksum=None):
+    """Descarga y sube un enlace cuando el planificador le asigna turno; devuelve el resultado.
+
+    Sin filename se usa el que dio la consulta previa. msg puede ser un LocalStatus
+    (elemento de un lote) en lugar de un mensaje de Telegram. checksum es el hash
+    esperado (algoritmo, hex) indicado por el usuario.
+    """
+    await safe_edit_message(msg, f"[{task_id}] ⏬ Iniciando descarga...")
+    task_metrics = begin_task(task_id, queue_wait)
+    outcome = 'error'
     
     # Registrar tarea activa
     start_time = time.time()
     active_tasks[task_id] = {
         'start_time': start_time,
-        'progress_message': msg,
-        'process': None
+        'progress_message': msg
     }
     
-    file_path = None
+    workspace = None
+    flows = None
     try:
         # Configurar callback de progreso
         async def progress_callback(current, total, status, progress_msg, name, tid, stime):
             await progress_bar(current, total, status, progress_msg, name, tid, stime)
         
         progress_callback.progress_message = msg
-        progress_callback.total_size = 0
         
-        # Crear ruta de descarga
-        download_path = "/tmp/downloads"
-        os.makedirs(download_path, exist_ok=True)
-        file_path = os.path.join(download_path, filename)
+        # Revalidar contra el servidor (sin la caché de consultas: el archivo pudo cambiar
+        # desde que se encoló) y reenviar desde la caché de archivos si no cambió
+        with track_stage('probe'):
+            info = await probe_url(url, fresh=True)
+        problem = admission_error(info)
+        if problem:
+            outcome = 'rejected'
+            await safe_edit_message(msg, f"[{task_id}] ❌ {problem}")
+            return outcome
+        filename = filename or info['filename']
+        split = choose_split(info)
+        flows = bandwidth.begin_task(message.from_user.id, bandwidth.weight_for(info['size']))
+        # yt-dlp no da validadores: la caché se usa solo por URL y nombre
+        validators = None if info['engine'] == 'ytdlp' else info
+        cached = await file_cache.get(url, filename, validators)
+        if cached:
+            await send_cached(client, message.chat.id, cached)
+            await safe_edit_message(msg, f"[{task_id}] ⚡ Enviado desde caché")
+            outcome = 'cached'
+            return outcome
         
-        # Descargar contenido
-        success = await download_content(
-            url, 
-            file_path,
-            progress_callback,
-            task_id,
-            filename,
-            start_time
+        # Con un SHA-256 conocido de antemano, el mismo contenido pudo llegar antes desde otra URL
+        known_hash = next((expected['sha256'] for _, expected in expected_digests(info, checksum)
+                           if 'sha256' in expected), None)
+        if known_hash and await send_by_hash(client, message, url, filename, validators, known_hash):
+            await safe_edit_message(msg, f"[{task_id}] ⚡ Enviado desde caché (mismo contenido)")
+            outcome = 'cached'
+            return outcome
+        
+        # Un archivo grande que se comprime bien se descarga entero para comprimirlo antes de subir
+        compression = None
+        reservation = disk_reservation(info)
+        if split == 'pipelined':
+            compression = await plan_for_url(info['final_url'], filename, info['mime_type'], info['size'])
+            needed = storage.reservation_for(info['size'] + compression['estimated']) if compression else 0
+            if compression and storage.fits(needed):
+                split, reservation = 'split', needed
+            else:
+                compression = None
+        
+        # Reservar disco y crear el directorio propio de la tarea (espera si no hay espacio)
+        async def on_disk_wait():
+            await safe_edit_message(msg, f"[{task_id}] 💾 Esperando espacio en disco...")
+        
+        workspace = await storage.acquire(
+            storage.workspace_key(message.from_user.id, url, filename), reservation, on_disk_wait
         )
+        file_path = workspace.file(filename)
+        # Hashes calculados durante la descarga; por volumen solo si puede hacer falta dividir
+        hasher = StreamHasher(VOLUME_SIZE if split != 'none' or not info['size'] else 0)
+        
+        # Archivos grandes con soporte de rangos: descargar y subir por volúmenes a la vez
+        if split == 'pipelined':
+            sent = await pipelined_task(client, message, msg, url, filename, info, task_id, start_time,
+                                        workspace.path, hasher)
+            if sent:
+                # Los volúmenes ya se enviaron: un error de integridad solo se puede avisar
+                problem = checksum_error(hasher.result(), info, checksum)
+                if problem:
+                    outcome = 'corrupt'
+                    probe_cache.invalidate(url)
+                    await safe_edit_message(msg, f"[{task_id}] ⚠️ {problem}\nLos volúmenes enviados no son válidos")
+                    return outcome
+                await file_cache.put(url, filename, validators, sent, hasher.result()['sha256'])
+                outcome = 'ok'
+            return outcome
+        
+        # Descargar contenido
+        try:
+            async with scheduler.stage('download'):
+                with track_stage('download') as stage:
+                    success = await download_content(
+                        url, 
+                        file_path,
+                        progress_callback,
+                        task_id,
+                        filename,
+                        start_time,
+                        info,
+                        hasher
+                    )
+                    if isinstance(success, str):
+                        # yt-dlp guarda el archivo con la extensión real del formato descargado
+                        file_path = success
+                    if success and os.path.exists(file_path):
+                        stage.bytes = os.path.getsize(file_path)
+        except YtdlpInterrupted:
+            # El directorio de la tarea se conserva con los .part: al repetirla se reanuda
+            outcome = 'interrupted'
+            await safe_edit_message(msg, f"[{task_id}] ⏸️ Descarga detenida para actualizar yt-dlp, se reanudará...")
+            return outcome
         
         if not success or not os.path.exists(file_path):
-            await safe_edit_message(msg, f"[{task_id}] ❌ Error al descargar el contenido")
-            return
+            outcome = 'download_failed'
+            # El archivo pudo cambiar en el servidor: la próxima consulta debe ser nueva
+            probe_cache.invalidate(url)
+            if has_journal(file_path):
+                await safe_edit_message(
+                    msg,
+                    f"[{task_id}] ❌ Error al descargar el contenido\n"
+                    "♻️ El progreso se guardó: reenvía el enlace para reanudar"
+                )
+            else:
+                await safe_edit_message(msg, f"[{task_id}] ❌ Error al descargar el contenido")
+            return outcome
         
         file_size = os.path.getsize(file_path)
+        if info['engine'] in ('ytdlp', 'manifest'):
+            # yt-dlp y ffmpeg escriben el archivo final por su cuenta: se calcula al terminar
+            with track_stage('checksum'):
+                hasher = await hash_file(file_path, VOLUME_SIZE if file_size > MAX_DIRECT_SIZE else 0)
+        digests = hasher.result()
+        problem = checksum_error(digests, info, checksum)
+        if problem:
+            # No subir contenido corrupto; el archivo no sirve para reanudar
+            outcome = 'corrupt'
+            probe_cache.invalidate(url)
+            os.remove(file_path)
+            await safe_edit_message(msg, f"[{task_id}] ❌ {problem}")
+            return outcome
+        if await send_by_hash(client, message, url, filename, validators, digests['sha256']):
+            await safe_edit_message(msg, f"[{task_id}] ⚡ Enviado desde caché (mismo contenido)")
+            outcome = 'cached'
+            return outcome
+        
+        # Detectar tipo de archivo
+        is_video = is_video_file(file_path)
+        
+        # Comprimir si la muestra indica que se ahorra más tiempo de subida del que cuesta la CPU
+        compressed = False
+        if not is_video:
+            compression = compression or await plan_for_file(file_path, filename, info['mime_type'])
+            needed = storage.reservation_for(file_size + compression['estimated']) if compression else 0
+            if compression and await storage.grow(workspace, needed, on_disk_wait):
+                await safe_edit_message(
+                    msg,
+                    f"[{task_id}] 🗜️ Comprimiendo (nivel {compression['level']}, "
+                    f"muestra al {compression['ratio']:.0%} de su tamaño)..."
+                )
+                async with scheduler.stage('processing'):
+                    archive = await compress_file(file_path, compression, task_id)
+                if archive:
+                    os.remove(file_path)
+                    file_path = archive
+                    file_size = os.path.getsize(file_path)
+                    compressed = True
+        hash_label = "SHA-256 del original" if compressed else "SHA-256"
+        time_split = file_size > MAX_DIRECT_SIZE and is_video and VIDEO_SPLIT_MODE == 'time'
+        if time_split and not await storage.grow(workspace, storage.reservation_for(2 * file_size), on_disk_wait):
+            # Sin sitio para el original y las partes: los volúmenes se leen del original sin copiarlo
+            logger.warning(f"[{task_id}] Sin espacio para dividir por tiempo, usando volúmenes")
+            time_split = False
+        
+        # Con el tamaño real ya conocido, devolver al resto de tareas lo que sobró de la reserva
+        storage.resize(workspace, storage.reservation_for(2 * file_size if time_split else file_size))
         size_mb = file_size / (1024 * 1024)
         
         # Manejar archivos grandes
         if file_size > MAX_DIRECT_SIZE:
-            await safe_edit_message(
-                msg, 
-                f"[{task_id}] 📦 Archivo grande ({size_mb:.2f} MB). Dividiendo..."
-            )
-            await split_and_upload(client, message, msg, file_path, task_id)
+            if time_split:
+                await safe_edit_message(
+                    msg,
+                    f"[{task_id}] 🎬 Video grande ({size_mb:.2f} MB). Dividiendo en partes reproducibles..."
+                )
+                async with scheduler.stage('processing'):
+                    metadata = await get_video_metadata(file_path)
+                    parts = await split_video_by_time(
+                        file_path, workspace.path, metadata, MAX_DIRECT_SIZE
+                    ) if metadata else None
+                if parts:
+                    # El original ya no hace falta: liberar su espacio antes de subir
+                    os.remove(file_path)
+                    sent = await upload_video_parts(client, message, msg, parts, os.path.basename(file_path),
+                                                    task_id, digests['sha256'])
+                else:
+                    logger.warning(f"[{task_id}] No se pudo dividir por tiempo, usando volúmenes")
+            if not time_split or not parts:
+                await safe_edit_message(
+                    msg, 
+                    f"[{task_id}] 📦 Archivo grande ({size_mb:.2f} MB). Dividiendo..."
+                )
+                # Los hashes por volumen son del original, no del archivo comprimido
+                sent = await split_and_upload(client, message, msg, file_path, task_id,
+                                              None if compressed else hasher.volume)
+            if sent:
+                await file_cache.put(url, filename, validators, sent, digests['sha256'])
+                outcome = 'ok'
         else:
             await safe_edit_message(
                 msg, 
                 f"[{task_id}] ✅ Descarga completa ({size_mb:.2f} MB)\n⬆️ Subiendo..."
             )
             
-            # Detectar tipo de archivo
-            mime_type, _ = mimetypes.guess_type(file_path)
-            is_video = mime_type and mime_type.startswith('video/')
+            # Función de progreso para subida (también aplica el límite de subida)
+            uploaded = 0
             
-            # Función de progreso para subida
             async def upload_callback(current, total):
+                nonlocal uploaded
+                await throttle('up', current - uploaded)
+                uploaded = current
                 await progress_bar(
                     current, 
                     total,
@@ -478,7 +843,9 @@ async def handle_links(client: Client, message: Message):
             
             if is_video:
                 # Procesar video
-                metadata = get_video_metadata(file_path)
+                async with scheduler.stage('processing'):
+                    metadata = await prepare_video(file_path, task_id)
+                thumb = metadata['thumb'] if metadata else None
                 duration = int(metadata['duration']) if metadata else 0
                 size_mb = metadata['size'] / (1024 * 1024) if metadata else size_mb
                 resolution = metadata['resolution'] if metadata else "Desconocida"
@@ -487,53 +854,150 @@ async def handle_links(client: Client, message: Message):
                     f"📹 {os.path.basename(file_path)}\n"
                     f"💾 {size_mb:.2f} MB\n"
                     f"🖥️ {resolution}\n"
-                    f"⏱️ {duration} seg"
+                    f"⏱️ {duration} seg\n"
+                    f"{caption_line(digests['sha256'])}"
                 )
                 
-                thumb = generate_thumbnail(file_path, task_id) if metadata else None
-                
-                await client.send_video(
-                    chat_id=message.chat.id,
-                    video=file_path,
-                    caption=caption,
-                    duration=duration,
-                    thumb=thumb,
-                    progress=upload_callback
-                )
+                async with scheduler.stage('upload'):
+                    with track_stage('upload') as stage:
+                        result = await client.send_video(
+                            chat_id=message.chat.id,
+                            video=file_path,
+                            caption=caption,
+                            duration=duration,
+                            width=metadata['width'] if metadata else 0,
+                            height=metadata['height'] if metadata else 0,
+                            supports_streaming=metadata['supports_streaming'] if metadata else None,
+                            thumb=thumb,
+                            progress=upload_callback
+                        )
+                        stage.bytes = file_size
                 
                 # Limpiar miniatura
                 if thumb and os.path.exists(thumb):
                     os.remove(thumb)
             else:
                 # Procesar otros tipos de archivos
-                await client.send_document(
-                    chat_id=message.chat.id,
-                    document=file_path,
-                    progress=upload_callback
-                )
+                async with scheduler.stage('upload'):
+                    with track_stage('upload') as stage:
+                        result = await client.send_document(
+                            chat_id=message.chat.id,
+                            document=file_path,
+                            caption=caption_line(digests['sha256'], hash_label),
+                            progress=upload_callback
+                        )
+                        stage.bytes = file_size
+            
+            if result:
+                await file_cache.put(url, filename, validators, [sent_item(result)], digests['sha256'])
                 
             await safe_edit_message(msg, f"[{task_id}] ✅ Subida completada")
+            outcome = 'ok'
     except Exception as e:
         await safe_edit_message(msg, f"[{task_id}] ❌ Error: {str(e)}")
     finally:
-        # Limpieza final
-        try:
-            if file_path and os.path.exists(file_path):
-                os.remove(file_path)
-        except Exception as e:
-            logger.error(f"Error eliminando archivo: {str(e)}")
+        # Liberar el disco reservado (se conservan las descargas parciales reanudables)
+        if workspace:
+            storage.release(workspace)
+        if flows:
+            bandwidth.finish_task(flows)
         
         # Limpiar registro de tareas
         if task_id in active_tasks:
             del active_tasks[task_id]
-        if user_id in user_active_tasks and user_active_tasks[user_id] == task_id:
-            del user_active_tasks[user_id]
         
-        # Limpiar registro de progreso
-        for key in list(progress_last_update.keys()):
-            if key.startswith(task_id):
-                del progress_last_update[key]
+        finish_task(task_metrics, outcome)
+    return outcome
+
+async def send_cached(client: Client, chat_id, items):
+    """Reenvía por file_id los archivos ya subidos anteriormente"""
+    for item in items:
+        if item['type'] == 'video':
+            await client.send_video(chat_id=chat_id, video=item['file_id'], caption=item.get('caption') or "")
+        else:
+            await client.send_document(
+                chat_id=chat_id,
+                document=item['file_id'],
+                caption=item.get('caption') or "",
+                disable_notification=len(items) > 1
+            )
+
+async def send_by_hash(client: Client, message: Message, url, filename, validators, content_hash):
+    """Reenvía un envío previo con el mismo contenido y lo asocia también a esta URL"""
+    cached = await file_cache.find_by_hash(content_hash)
+    if not cached:
+        return False
+    await send_cached(client, message.chat.id, cached)
+    await file_cache.put(url, filename, validators, cached, content_hash)
+    return True
+
+async def pipelined_task(client, message, msg, url, filename, info, task_id, start_time, workdir, hasher=None):
+    """Descarga por volúmenes un archivo grande mientras se suben los ya completos.
+
+    hasher, opcional, calcula el hash del archivo completo y el de cada volumen.
+    """
+    async def fetch_volume(offset, length, part_path):
+        async def on_progress(current, total):
+            await progress_bar(
+                offset + current,
+                info['size'],
+                "📥 Descargando por partes",
+                msg,
+                filename,
+                task_id,
+                start_time
+            )
+        
+        async with scheduler.stage('download'):
+            with track_stage('download') as stage:
+                ok = await download_range(
+                    url,
+                    part_path,
+                    offset,
+                    length,
+                    info,
+                    on_progress,
+                    lambda: task_id not in active_tasks,
+                    hasher=hasher
+                )
+                if ok:
+                    stage.bytes = length
+                return ok
+    
+    return await pipelined_split_upload(
+        client, message, msg, workdir, filename, info['size'], task_id, fetch_volume,
+        hasher.volume if hasher else None
+    )
+
+async def main():
+    """Ciclo de vida del bot: recursos compartidos, arranque y cierre ordenado"""
+    global worker_pool
+    pool = worker_pool = WorkerPool(app) if QUEUE_WORKERS else None
+    if pool:
+        # Los procesos de trabajo gestionan el disco; el bot solo comprueba que cada tarea cabe en uno
+        storage_share = storage.split_budget(QUEUE_WORKERS)
+    else:
+        storage.start()
+    get_session()
+    metrics_runner = await start_metrics_server()
+    try:
+        async with app:
+            if pool:
+                await pool.start(storage_share)
+            logger.info("⚡ Bot iniciado ⚡")
+            try:
+                await idle()
+            finally:
+                if pool:
+                    await pool.stop()
+    finally:
+        await status_editor.stop()
+        await bandwidth.stop()
+        await close_session()
+        file_cache.close()
+        ytdlp_engine.shutdown()
+        if metrics_runner:
+            await metrics_runner.cleanup()
 
 if __name__ == "__main__":
-    logger.info("⚡ Bot iniciado ⚡")
-    app.run()
+    app.run(main())
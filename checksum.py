@@ -0,0 +1,182 @@
+import os
+import re
+import base64
+import asyncio
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Configuración
+HASH_WORKERS = int(os.environ.get('HASH_WORKERS', os.cpu_count() or 2))
+HASH_CHUNK = 4 * 1024 * 1024  # bytes leídos por bloque al ponerse al día desde el archivo
+HASH_ALGORITHMS = ('sha256', 'md5')
+HASH_LENGTHS = {64: 'sha256', 32: 'md5'}  # longitud en hexadecimal -> algoritmo
+
+# Nombres de algoritmo en las cabeceras Digest / Repr-Digest / x-goog-hash
+_HEADER_ALGORITHMS = {'sha-256': 'sha256', 'sha256': 'sha256', 'md5': 'md5'}
+_CHECKSUM_PATTERN = re.compile(r'(?:(sha256|sha-256|md5)[:=])?([0-9a-fA-F]{32}|[0-9a-fA-F]{64})')
+
+# hashlib libera el GIL con bloques grandes: los hilos calculan en paralelo al event loop
+_executor = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="hash")
+
+
+class ChecksumMismatch(Exception):
+    """El contenido descargado no coincide con el hash esperado"""
+
+
+def parse_checksum(text):
+    """Interpreta 'sha256:HEX', 'md5=HEX' o un hexadecimal de 64/32 caracteres; devuelve (algoritmo, hex) o None"""
+    match = _CHECKSUM_PATTERN.fullmatch(text.strip())
+    if not match:
+        return None
+    algorithm = _HEADER_ALGORITHMS[match.group(1).lower()] if match.group(1) else HASH_LENGTHS[len(match.group(2))]
+    if len(match.group(2)) * 4 != hashlib.new(algorithm).digest_size * 8:
+        return None
+    return algorithm, match.group(2).lower()
+
+
+def _decode_digest(value):
+    """Valor de cabecera en base64 (o entre ':' como en Repr-Digest) a hexadecimal"""
+    value = value.strip().strip(':')
+    try:
+        return base64.b64decode(value, validate=True).hex()
+    except ValueError:
+        return None
+
+
+def digests_from_headers(headers, partial=False):
+    """Hashes del archivo completo anunciados por el servidor: {'sha256': hex, 'md5': hex}.
+
+    Content-MD5 describe el cuerpo de la respuesta, así que no vale en respuestas parciales
+    (206) ni con Content-Encoding. Digest, Repr-Digest y x-goog-hash describen el recurso.
+    """
+    digests = {}
+    values = headers.getall('x-goog-hash', []) + headers.getall('Digest', []) + headers.getall('Repr-Digest', [])
+    for value in values:
+        for item in value.split(','):
+            name, _, encoded = item.strip().partition('=')
+            algorithm = _HEADER_ALGORITHMS.get(name.strip().lower())
+            digest = _decode_digest(encoded) if algorithm else None
+            if digest:
+                digests.setdefault(algorithm, digest)
+    if 'Content-MD5' in headers and not partial and 'Content-Encoding' not in headers:
+        digest = _decode_digest(headers['Content-MD5'])
+        if digest:
+            digests.setdefault('md5', digest)
+    return digests
+
+
+class StreamHasher:
+    """SHA-256 y MD5 de un archivo calculados mientras se descarga, en un hilo aparte.
+
+    Los datos que llegan en orden se pasan con feed(); las descargas segmentadas escriben
+    fuera de orden, así que follow() lee del archivo (aún en la caché de páginas) el
+    prefijo contiguo ya escrito. Con volume_size también se calcula el SHA-256 de cada
+    volumen. position es el byte del archivo remoto hasta el que se lleva calculado.
+    """
+
+    def __init__(self, volume_size=0):
+        self.volume_size = volume_size
+        self.hashes = {name: hashlib.new(name) for name in HASH_ALGORITHMS}
+        self.volume_hash = hashlib.sha256()
+        self.volumes = []  # SHA-256 de cada volumen completo
+        self.position = 0
+        self._pending = None
+
+    async def reset(self):
+        """Vuelve a empezar (la descarga se reinicia desde el principio)"""
+        await self.wait()
+        self.__init__(self.volume_size)
+
+    def _update(self, data):
+        # Ejecutado en un hilo del pool: como mucho un bloque por hasher a la vez
+        view = memoryview(data)
+        while view:
+            take = len(view)
+            if self.volume_size:
+                take = min(take, self.volume_size - self.position % self.volume_size)
+            piece = view[:take]
+            for hash_object in self.hashes.values():
+                hash_object.update(piece)
+            if self.volume_size:
+                self.volume_hash.update(piece)
+            self.position += take
+            view = view[take:]
+            if self.volume_size and self.position % self.volume_size == 0:
+                self.volumes.append(self.volume_hash.hexdigest())
+                self.volume_hash = hashlib.sha256()
+
+    def _read_through(self, path, upto, base):
+        """Lee de path los bytes [position, upto) del archivo remoto; el archivo empieza en base"""
+        try:
+            with open(path, 'rb') as f:
+                while self.position < upto:
+                    data = os.pread(f.fileno(), min(HASH_CHUNK, upto - self.position), self.position - base)
+                    if not data:
+                        return
+                    self._update(data)
+        except OSError as e:
+            # El archivo pudo borrarse tras cancelar la tarea; catch_up detecta el hueco
+            logger.warning(f"Error leyendo {path} para el hash: {str(e)}")
+
+    async def feed(self, data):
+        """Añade datos en orden; solo espera si el bloque anterior aún se está calculando"""
+        await self.wait()
+        self._pending = asyncio.get_running_loop().run_in_executor(_executor, self._update, data)
+
+    def follow(self, path, upto, base=0):
+        """Programa en segundo plano el cálculo hasta upto si no hay otro en curso (no espera)"""
+        if (self._pending and not self._pending.done()) or upto - self.position < HASH_CHUNK:
+            return
+        self._pending = asyncio.get_running_loop().run_in_executor(
+            _executor, self._read_through, path, upto, base
+        )
+
+    async def catch_up(self, path, upto, base=0):
+        """Completa el cálculo hasta upto al terminar la descarga"""
+        await self.wait()
+        self._pending = asyncio.get_running_loop().run_in_executor(
+            _executor, self._read_through, path, upto, base
+        )
+        await self.wait()
+        if self.position != upto:
+            raise ChecksumMismatch(f"No se pudo calcular el hash ({self.position}/{upto} bytes)")
+
+    async def wait(self):
+        """Espera al bloque en curso"""
+        pending, self._pending = self._pending, None
+        if pending:
+            await pending
+
+    def volume(self, index):
+        """SHA-256 del volumen index, el último aunque esté incompleto"""
+        if index < len(self.volumes):
+            return self.volumes[index]
+        if index == len(self.volumes) and self.position % (self.volume_size or 1):
+            return self.volume_hash.hexdigest()
+        return None
+
+    def result(self):
+        """{'sha256': hex, 'md5': hex} de lo calculado hasta ahora"""
+        return {name: hash_object.hexdigest() for name, hash_object in self.hashes.items()}
+
+
+async def hash_file(path, volume_size=0):
+    """Calcula los hashes de un archivo ya escrito por otro proceso (p. ej. yt-dlp)"""
+    hasher = StreamHasher(volume_size)
+    await hasher.catch_up(path, os.path.getsize(path))
+    return hasher
+
+
+def find_mismatch(digests, expected):
+    """Compara los hashes calculados con los esperados; devuelve (algoritmo, esperado, obtenido) o None"""
+    for algorithm, value in (expected or {}).items():
+        if algorithm in digests and digests[algorithm] != value.lower():
+            return algorithm, value.lower(), digests[algorithm]
+    return None
+
+
+def caption_line(sha256, label="SHA-256"):
+    return f"🔐 {label}: `{sha256}`"
@@ -0,0 +1,155 @@
+import os
+import zlib
+import asyncio
+import logging
+import mimetypes
+from media_tools import run_tool, MediaToolError
+from http_session import get_session
+from metrics import track_stage
+
+logger = logging.getLogger(__name__)
+
+# Configuración
+COMPRESSION = os.environ.get('COMPRESSION', 'auto')  # 'auto' o 'off'
+COMPRESS_UPLOAD_RATE = int(os.environ.get('COMPRESS_UPLOAD_RATE', 10 * 1024 * 1024))  # bytes/s de subida supuestos
+COMPRESS_THREADS = int(os.environ.get('COMPRESS_THREADS', os.cpu_count() or 2))
+COMPRESS_TIMEOUT = float(os.environ.get('COMPRESS_TIMEOUT', 3600))  # segundos
+COMPRESS_CONCURRENCY = int(os.environ.get('COMPRESS_CONCURRENCY', 1))  # compresiones a la vez
+COMPRESS_MIN_SIZE = 1024 * 1024  # por debajo no compensa
+SAMPLE_BLOCKS = 16
+SAMPLE_BLOCK_SIZE = 64 * 1024
+
+# Niveles de 7z (LZMA2 multihilo): nombre, argumentos, bytes/s por hilo aproximados y
+# tamaño esperado respecto a la muestra comprimida con zlib nivel 1
+COMPRESSION_LEVELS = (
+    ('rápida', ['-mx1'], 20e6, 0.95),
+    ('normal', ['-mx5'], 4e6, 0.8),
+    ('máxima', ['-mx9'], 1.5e6, 0.75),
+)
+
+# 7z puede tardar hasta COMPRESS_TIMEOUT: con sus propios turnos no deja sin hueco
+# a ffprobe, miniaturas y demás llamadas cortas de media_tools
+_compress_slots = asyncio.Semaphore(COMPRESS_CONCURRENCY)
+
+# Clases MIME que ya vienen comprimidas
+_COMPRESSED_MIME_PREFIXES = ('video/', 'audio/', 'image/jpeg', 'image/png', 'image/gif', 'image/webp')
+_COMPRESSED_MIME_TYPES = {
+    'application/zip', 'application/gzip', 'application/x-gzip', 'application/x-7z-compressed',
+    'application/x-rar-compressed', 'application/vnd.rar', 'application/x-xz', 'application/x-bzip2',
+    'application/zstd', 'application/x-zstd', 'application/java-archive', 'application/vnd.android.package-archive'
+}
+# Firmas de formatos comprimidos (por si el nombre o el tipo no lo dicen)
+_COMPRESSED_MAGIC = (
+    b'PK\x03\x04', b'7z\xbc\xaf\x27\x1c', b'\x1f\x8b', b'\xfd7zXZ\x00', b'BZh', b'\x28\xb5\x2f\xfd',
+    b'Rar!', b'\x89PNG', b'\xff\xd8\xff', b'GIF8', b'OggS', b'fLaC', b'ID3'
+)
+
+
+def is_precompressed(name, mime_type=None, head=b''):
+    """Indica si el contenido ya está comprimido según su tipo o su firma"""
+    mime_type = mime_type or mimetypes.guess_type(name or '')[0] or ''
+    if mime_type.startswith(_COMPRESSED_MIME_PREFIXES) or mime_type in _COMPRESSED_MIME_TYPES:
+        return True
+    # MP4/MOV/3GP: 'ftyp' tras el tamaño de la primera caja
+    return head.startswith(_COMPRESSED_MAGIC) or head[4:8] == b'ftyp'
+
+
+def _offsets(size):
+    """Posiciones de los bloques de muestra, repartidos por todo el archivo"""
+    if size <= SAMPLE_BLOCKS * SAMPLE_BLOCK_SIZE:
+        return list(range(0, size, SAMPLE_BLOCK_SIZE))
+    step = (size - SAMPLE_BLOCK_SIZE) // (SAMPLE_BLOCKS - 1)
+    return [i * step for i in range(SAMPLE_BLOCKS)]
+
+
+def _read_samples(path, size):
+    with open(path, 'rb') as f:
+        return [os.pread(f.fileno(), SAMPLE_BLOCK_SIZE, offset) for offset in _offsets(size)]
+
+
+async def _fetch_sample(url, offset):
+    headers = {'Range': f'bytes={offset}-{offset + SAMPLE_BLOCK_SIZE - 1}'}
+    async with get_session().get(url, headers=headers) as response:
+        if response.status != 206:
+            raise ValueError(f"el servidor no devolvió el rango (HTTP {response.status})")
+        try:
+            # read(n) devuelve lo que haya llegado; la muestra debe ser el bloque completo
+            return await response.content.readexactly(SAMPLE_BLOCK_SIZE)
+        except asyncio.IncompleteReadError as e:
+            return e.partial  # último bloque de un archivo pequeño
+
+
+def compressibility(blocks):
+    """Tamaño comprimido / original de la muestra (zlib nivel 1, cada bloque por separado)"""
+    original = sum(len(block) for block in blocks)
+    if not original:
+        return 1.0
+    return sum(len(zlib.compress(block, 1)) for block in blocks) / original
+
+
+def choose_level(size, ratio, upload_rate=COMPRESS_UPLOAD_RATE, threads=COMPRESS_THREADS):
+    """Nivel que más tiempo ahorra (subida evitada menos CPU), o None si ninguno compensa"""
+    best, best_gain = None, 0.0
+    for level in COMPRESSION_LEVELS:
+        _, _, speed, factor = level
+        saved = size * (1 - min(1.0, ratio * factor))
+        gain = saved / upload_rate - size / (speed * threads)
+        if gain > best_gain:
+            best, best_gain = level, gain
+    return best
+
+
+def _plan(name, mime_type, size, blocks):
+    if is_precompressed(name, mime_type, blocks[0] if blocks else b''):
+        return None
+    ratio = compressibility(blocks)
+    level = choose_level(size, ratio)
+    if level is None:
+        return None
+    # Estimación conservadora: LZMA comprime al menos como zlib nivel 1
+    return {'level': level[0], 'args': level[1], 'ratio': ratio, 'estimated': int(size * min(1.0, ratio))}
+
+
+async def plan_for_file(path, name=None, mime_type=None):
+    """Decide cómo comprimir un archivo descargado: {'level', 'args', 'ratio', 'estimated'} o None.
+
+    Se leen SAMPLE_BLOCKS bloques repartidos por el archivo; el tipo MIME y la firma
+    descartan sin más los formatos que ya vienen comprimidos.
+    """
+    size = os.path.getsize(path)
+    if COMPRESSION == 'off' or size < COMPRESS_MIN_SIZE or is_precompressed(name or path, mime_type):
+        return None
+    blocks = await asyncio.to_thread(_read_samples, path, size)
+    return await asyncio.to_thread(_plan, name or path, mime_type, size, blocks)
+
+
+async def plan_for_url(url, name, mime_type, size):
+    """Igual que plan_for_file pero con la muestra pedida por rangos, antes de descargar"""
+    if COMPRESSION == 'off' or size < COMPRESS_MIN_SIZE or is_precompressed(name, mime_type):
+        return None
+    try:
+        blocks = await asyncio.gather(*(_fetch_sample(url, offset) for offset in _offsets(size)))
+    except Exception as e:
+        logger.warning(f"No se pudo muestrear {url} para comprimir: {str(e)}")
+        return None
+    return await asyncio.to_thread(_plan, name, mime_type, size, blocks)
+
+
+async def compress_file(path, plan, task_id):
+    """Comprime path en path.7z con el nivel del plan; devuelve la ruta o None si falla"""
+    archive = f"{path}.7z"
+    cmd = ['7z', 'a', '-t7z', '-m0=lzma2', *plan['args'], f'-mmt={COMPRESS_THREADS}',
+           '-bd', '-bso0', '-bsp0', '-y', archive, path]
+    try:
+        with track_stage('compress') as stage:
+            await run_tool(cmd, timeout=COMPRESS_TIMEOUT, slots=_compress_slots)
+            stage.bytes = os.path.getsize(path)
+    except (MediaToolError, OSError) as e:
+        logger.error(f"[{task_id}] Error comprimiendo {path}: {str(e)}")
+        if os.path.exists(archive):
+            os.remove(archive)
+        return None
+    logger.info(
+        f"[{task_id}] Comprimido ({plan['level']}): {os.path.getsize(path)} -> {os.path.getsize(archive)} bytes"
+    )
+    return archive
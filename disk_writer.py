@@ -0,0 +1,124 @@
+import os
+import errno
+import queue
+import asyncio
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Configuración
+WRITE_BUFFER_POOL = int(os.environ.get('WRITE_BUFFER_POOL', 64))  # bloques esperando al disco en todo el proceso
+WRITE_BUFFERS_PER_FILE = int(os.environ.get('WRITE_BUFFERS_PER_FILE', 16))  # y en cada archivo
+
+# Con bloques de CHUNK_SIZE, la memoria retenida por escrituras pendientes no pasa de
+# WRITE_BUFFER_POOL bloques por rápido que llegue la red
+_buffer_pool = asyncio.Semaphore(WRITE_BUFFER_POOL)
+
+
+def preallocate(fd, size):
+    """Reserva size bytes en disco para fd; si el sistema de archivos no lo admite, solo fija el tamaño.
+
+    Con el espacio reservado de antemano un disco lleno falla al empezar y no a mitad
+    de la descarga, y las escrituras fuera de orden no fragmentan el archivo.
+    """
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except OSError as e:
+        if e.errno == errno.ENOSPC:
+            raise
+        os.ftruncate(fd, size)
+
+
+class DiskWriter:
+    """Escritura diferida: un hilo propio escribe con pwrite los bloques que le pasa el event loop.
+
+    write() vuelve en cuanto el bloque está en cola; si el disco va por detrás y se agotan
+    los búferes (WRITE_BUFFERS_PER_FILE por archivo, WRITE_BUFFER_POOL en el proceso)
+    espera, y así la red no lee más rápido de lo que escribe el disco. on_written(nbytes)
+    se llama en el event loop cuando el bloque ya está en el archivo. Un error de disco
+    descarta las escrituras siguientes y se lanza en el siguiente write(), flush() o close().
+    """
+
+    def __init__(self, fd, name="disk-writer"):
+        self.fd = fd
+        self.loop = asyncio.get_running_loop()
+        self.slots = asyncio.Semaphore(WRITE_BUFFERS_PER_FILE)
+        self.queue = queue.SimpleQueue()
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    async def write(self, data, offset, on_written=None):
+        if self.error:
+            raise self.error
+        await self.slots.acquire()
+        try:
+            await _buffer_pool.acquire()
+        except BaseException:
+            self.slots.release()
+            raise
+        self.queue.put((data, offset, on_written))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if isinstance(item, asyncio.Future):
+                # Barrera de flush(): todo lo encolado antes ya está escrito
+                self.loop.call_soon_threadsafe(_resolve, item)
+                continue
+            data, offset, on_written = item
+            error = None
+            if self.error is None:
+                try:
+                    view = memoryview(data)
+                    while view:
+                        written = os.pwrite(self.fd, view, offset)
+                        view = view[written:]
+                        offset += written
+                except OSError as e:
+                    error = e
+            self.loop.call_soon_threadsafe(self._written, len(data), on_written, error)
+
+    def _written(self, nbytes, on_written, error):
+        self.slots.release()
+        _buffer_pool.release()
+        if error and self.error is None:
+            logger.error(f"Error escribiendo en disco: {str(error)}")
+            self.error = error
+        elif on_written and self.error is None:
+            on_written(nbytes)
+
+    async def flush(self):
+        """Espera a que se escriba todo lo encolado hasta ahora"""
+        barrier = self.loop.create_future()
+        self.queue.put(barrier)
+        await barrier
+        if self.error:
+            raise self.error
+
+    async def _stop(self):
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        thread, self.thread = self.thread, None
+        await asyncio.to_thread(thread.join)
+
+    async def close(self, sync=True):
+        """Vacía la cola, termina el hilo y, con sync, asegura los datos en disco (fsync)"""
+        await self._stop()
+        if self.error:
+            raise self.error
+        if sync:
+            await asyncio.to_thread(os.fsync, self.fd)
+
+    async def abort(self):
+        """Como close sin fsync ni errores: para salir tras un fallo o una cancelación"""
+        await self._stop()
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
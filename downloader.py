@@ -0,0 +1,453 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+import aiohttp
+from http_session import get_session
+from metrics import record_retry
+from bandwidth import throttle
+from disk_writer import DiskWriter, preallocate
+
+logger = logging.getLogger(__name__)
+
+# Configuración
+DOWNLOAD_CONNECTIONS = int(os.environ.get('DOWNLOAD_CONNECTIONS', 8))
+DOWNLOAD_RETRIES = int(os.environ.get('DOWNLOAD_RETRIES', 5))
+MIN_SEGMENT_SIZE = 4 * 1024 * 1024  # 4 MB
+MAX_SEGMENTS = 1024  # segmentos por descarga (tamaño del journal)
+CHUNK_SIZE = 1024 * 1024  # 1 MB
+JOURNAL_SUFFIX = ".journal"
+JOURNAL_SAVE_INTERVAL = 5  # segundos
+MAX_BACKOFF = 30  # segundos
+
+RETRYABLE_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, ConnectionError)
+
+
+class DownloadCancelled(Exception):
+    """La tarea fue cancelada durante la descarga"""
+
+
+class RemoteChanged(Exception):
+    """El archivo remoto cambió respecto al journal guardado"""
+
+
+class RangesUnsupported(Exception):
+    """El servidor anuncia rangos pero responde 200 con el archivo completo a un GET con Range"""
+
+
+async def probe_ranges(session: aiohttp.ClientSession, url: str):
+    """Consulta el servidor y devuelve tamaño, soporte de rangos y validadores"""
+    info = {'size': 0, 'ranges': False, 'etag': None, 'last_modified': None}
+    try:
+        async with session.get(url, headers={'Range': 'bytes=0-0'}) as response:
+            info['etag'] = response.headers.get('ETag')
+            info['last_modified'] = response.headers.get('Last-Modified')
+            content_range = response.headers.get('Content-Range', '')
+            if response.status == 206 and '/' in content_range:
+                total = content_range.rsplit('/', 1)[1]
+                if total.isdigit():
+                    info['size'] = int(total)
+                    info['ranges'] = True
+            elif response.status == 200:
+                info['size'] = int(response.headers.get('Content-Length', 0))
+    except Exception as e:
+        logger.warning(f"Error comprobando rangos: {str(e)}")
+    return info
+
+
+def contiguous_end(segments):
+    """Byte remoto hasta el que el archivo está escrito sin huecos desde el principio"""
+    for _, end, pos in segments:
+        if pos <= end:
+            return pos
+    return segments[-1][1] + 1 if segments else 0
+
+
+def split_ranges(total_size: int, offset: int = 0):
+    """Divide el tamaño total en rangos de bytes (inicio, fin) inclusivos a partir de offset.
+
+    Los segmentos son pequeños (MIN_SEGMENT_SIZE, o más si saldrían más de MAX_SEGMENTS) y las
+    conexiones los toman en orden: el archivo se completa casi de principio a fin.
+    """
+    segment_size = max(MIN_SEGMENT_SIZE, -(-total_size // MAX_SEGMENTS))
+    ranges = []
+    for start in range(offset, offset + total_size, segment_size):
+        ranges.append((start, min(start + segment_size, offset + total_size) - 1))
+    return ranges
+
+
+def backoff_delay(attempt: int):
+    """Espera exponencial entre reintentos"""
+    return min(2 ** attempt, MAX_BACKOFF)
+
+
+class TransferJournal:
+    """Journal en disco con el avance de cada segmento de una descarga parcial.
+
+    save() toma una copia del estado en el event loop y hace el fsync y la escritura
+    en un hilo; si dos guardados se cruzan, una copia antigua nunca pisa a una posterior.
+    """
+
+    def __init__(self, filepath: str):
+        self.path = filepath + JOURNAL_SUFFIX
+        self.data = None
+        self.last_save = 0
+        self._seq = 0
+        self._written_seq = 0
+        self._lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                self.data = json.load(f)
+        except (OSError, ValueError):
+            self.data = None
+        return self.data
+
+    async def start(self, url, info, ranges, offset=0, length=None):
+        # Cada segmento es [inicio, fin, siguiente_byte_a_escribir] en bytes del archivo remoto
+        self.data = {
+            'url': url,
+            'size': info['size'],
+            'offset': offset,
+            'length': length,
+            'etag': info['etag'],
+            'last_modified': info['last_modified'],
+            'segments': [[start, end, start] for start, end in ranges]
+        }
+        await self.save()
+
+    def matches(self, url, info, offset=0, length=None):
+        """Indica si el journal corresponde al mismo archivo remoto y al mismo tramo"""
+        if not self.data or self.data.get('url') != url or self.data.get('size') != info['size']:
+            return False
+        if self.data.get('offset', 0) != offset or self.data.get('length') != length:
+            return False
+        if info['etag'] or self.data.get('etag'):
+            return self.data.get('etag') == info['etag']
+        if info['last_modified'] or self.data.get('last_modified'):
+            return self.data.get('last_modified') == info['last_modified']
+        return False
+
+    @property
+    def validator(self):
+        return self.data.get('etag') or self.data.get('last_modified')
+
+    @property
+    def downloaded(self):
+        return sum(pos - start for start, _, pos in self.data['segments'])
+
+    async def save(self, fd=None, force=True):
+        now = time.time()
+        if not force and now - self.last_save < JOURNAL_SAVE_INTERVAL:
+            return
+        self.last_save = now
+        self.data['updated'] = now
+        self._seq += 1
+        await asyncio.to_thread(self._write, fd, self._seq, json.dumps(self.data))
+
+    def _write(self, fd, seq, snapshot):
+        with self._lock:
+            if seq < self._written_seq:
+                return
+            if fd is not None:
+                # Asegurar que los datos están en disco antes de registrarlos
+                os.fsync(fd)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w') as f:
+                f.write(snapshot)
+            os.replace(tmp_path, self.path)
+            self._written_seq = seq
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def has_journal(filepath: str):
+    """Indica si existe una descarga parcial reanudable para el archivo"""
+    return os.path.exists(filepath + JOURNAL_SUFFIX)
+
+
+class _Progress:
+    """Acumula los bytes de todas las conexiones en un solo total"""
+
+    def __init__(self, total, callback, current=0):
+        self.total = total
+        self.current = current
+        self.callback = callback
+
+    async def add(self, amount):
+        self.current += amount
+        await self.callback(self.current, self.total)
+
+
+async def _fetch_segment(session, url, writer, segment, journal, progress, is_cancelled, base=0):
+    """Descarga lo que falta de un segmento y lo encola para escribirlo en su posición del archivo local.
+
+    segment[2] solo avanza cuando el bloque ya está escrito: el journal nunca da por
+    descargado algo que aún está en memoria. El journal se guarda cada JOURNAL_SAVE_INTERVAL
+    también a mitad de segmento, así un proceso que muere no repite los segmentos enteros.
+    """
+    start, end, pos = segment
+    validator = journal.validator
+    headers = {'Range': f'bytes={pos}-{end}'}
+
+    def written(nbytes):
+        segment[2] += nbytes
+
+    if validator:
+        # Si el archivo cambió el servidor responde 200 en lugar de 206
+        headers['If-Range'] = validator
+    async with session.get(url, headers=headers) as response:
+        if response.status == 200:
+            # Con If-Range, un 200 con otros validadores es otra versión del archivo; si no,
+            # el servidor ignora Range y reintentar no sirve de nada
+            current = (response.headers.get('ETag'), response.headers.get('Last-Modified'))
+            if validator and validator not in current:
+                raise RemoteChanged(f"El archivo remoto cambió ({url})")
+            raise RangesUnsupported(f"El servidor ignora Range ({url})")
+        if response.status != 206:
+            raise aiohttp.ClientResponseError(
+                response.request_info,
+                response.history,
+                status=response.status,
+                message=f"Rango no soportado ({pos}-{end})"
+            )
+        async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+            if is_cancelled():
+                raise DownloadCancelled()
+            chunk = chunk[:end + 1 - pos]
+            await writer.write(chunk, pos - base, written)
+            pos += len(chunk)
+            await journal.save(writer.fd, force=False)
+            await progress.add(len(chunk))
+            await throttle('down', len(chunk))
+            if pos > end:
+                break
+    if pos <= end:
+        raise aiohttp.ClientPayloadError(f"Segmento incompleto ({pos}/{end + 1})")
+
+
+async def _fetch_segment_with_retry(session, url, writer, segment, journal, progress, is_cancelled, base=0):
+    """Reintenta un segmento con espera exponencial, reanudando desde el último byte escrito"""
+    attempt = 0
+    while True:
+        try:
+            await _fetch_segment(session, url, writer, segment, journal, progress, is_cancelled, base)
+            await journal.save(writer.fd, force=False)
+            return
+        except RETRYABLE_ERRORS as e:
+            # Lo recibido antes del corte debe estar escrito para saber desde dónde seguir
+            await writer.flush()
+            await journal.save(writer.fd)
+            if attempt >= DOWNLOAD_RETRIES:
+                raise
+            delay = backoff_delay(attempt)
+            attempt += 1
+            record_retry('download')
+            logger.warning(
+                f"Error en segmento {segment[0]}-{segment[1]} ({str(e)}), "
+                f"reintento {attempt}/{DOWNLOAD_RETRIES} en {delay}s"
+            )
+            await asyncio.sleep(delay)
+
+
+async def segmented_download(session, url, filepath, info, progress_callback, is_cancelled,
+                             connections=DOWNLOAD_CONNECTIONS, offset=0, length=None, hasher=None):
+    """Descarga el archivo (o el tramo offset+length) en paralelo usando varias conexiones con Range.
+
+    Cada conexión toma el siguiente segmento pendiente, así el prefijo contiguo ya escrito
+    crece durante la descarga y hasher (checksum.StreamHasher) lo calcula sobre la marcha;
+    al terminar solo queda por leer la cola de los últimos segmentos.
+    """
+    total_size = length if length is not None else info['size'] - offset
+    if hasher and hasher.position != offset:
+        logger.warning(f"El hash va por {hasher.position} y el tramo empieza en {offset}: no se calcula")
+        hasher = None
+    journal = TransferJournal(filepath)
+    resume = await asyncio.to_thread(journal.load) and journal.matches(url, info, offset, length) and os.path.exists(filepath)
+
+    if resume:
+        logger.info(f"Reanudando descarga desde el journal: {journal.downloaded}/{total_size} bytes")
+        fd = os.open(filepath, os.O_RDWR)
+    else:
+        ranges = split_ranges(total_size, offset)
+        logger.info(f"Descarga segmentada: {len(ranges)} segmentos para {total_size} bytes")
+        fd = os.open(filepath, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+
+    writer = None
+    try:
+        if not resume:
+            # Reservar en disco el tamaño final para escribir cada segmento en su offset
+            await asyncio.to_thread(preallocate, fd, total_size)
+            await journal.start(url, info, ranges, offset, length)
+        writer = DiskWriter(fd)
+
+        segments = journal.data['segments']
+
+        async def on_progress(current, total):
+            if hasher:
+                hasher.follow(filepath, contiguous_end(segments), offset)
+            await progress_callback(current, total)
+
+        progress = _Progress(total_size, progress_callback if hasher is None else on_progress, journal.downloaded)
+        pending = iter([segment for segment in journal.data['segments'] if segment[2] <= segment[1]])
+
+        async def connection():
+            # El iterador es compartido: cada segmento lo descarga una sola conexión, en orden
+            for segment in pending:
+                await _fetch_segment_with_retry(session, url, writer, segment, journal, progress, is_cancelled,
+                                                offset)
+
+        tasks = [asyncio.create_task(connection()) for _ in range(max(1, connections))]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # El journal recoge lo que llegó a escribirse antes de parar
+            await writer.abort()
+            await journal.save(fd)
+            raise
+        # Escribir lo pendiente y asegurarlo en disco
+        await writer.close()
+    finally:
+        if writer:
+            await writer.abort()
+        os.close(fd)
+    if hasher:
+        await hasher.catch_up(filepath, offset + total_size, offset)
+    journal.remove()
+
+
+async def stream_download(session, url, filepath, progress_callback, is_cancelled, hasher=None):
+    """Descarga el archivo en un único flujo GET, calculando los hashes según llegan los datos"""
+    if hasher:
+        await hasher.reset()
+    async with session.get(url) as response:
+        if response.status != 200:
+            return False
+
+        total_size = int(response.headers.get('Content-Length', 0))
+        downloaded = 0
+
+        fd = os.open(filepath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        writer = None
+        try:
+            if total_size:
+                await asyncio.to_thread(preallocate, fd, total_size)
+            writer = DiskWriter(fd)
+            async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                if is_cancelled():
+                    raise DownloadCancelled()
+                await writer.write(chunk, downloaded)
+                if hasher:
+                    await hasher.feed(chunk)
+                downloaded += len(chunk)
+                await progress_callback(downloaded, total_size)
+                await throttle('down', len(chunk))
+            await writer.flush()
+            if downloaded != total_size:
+                # Content-Length no coincidía con lo recibido (p. ej. contenido comprimido)
+                await asyncio.to_thread(os.ftruncate, fd, downloaded)
+            await writer.close()
+        finally:
+            if writer:
+                await writer.abort()
+            os.close(fd)
+    if hasher:
+        await hasher.wait()
+    return True
+
+
+async def _stream_download_with_retry(session, url, filepath, progress_callback, is_cancelled, hasher=None):
+    """Sin soporte de rangos solo se puede reintentar desde el principio"""
+    attempt = 0
+    while True:
+        try:
+            return await stream_download(session, url, filepath, progress_callback, is_cancelled, hasher)
+        except RETRYABLE_ERRORS as e:
+            if attempt >= DOWNLOAD_RETRIES:
+                raise
+            delay = backoff_delay(attempt)
+            attempt += 1
+            record_retry('download')
+            logger.warning(f"Error en descarga ({str(e)}), reintento {attempt}/{DOWNLOAD_RETRIES} en {delay}s")
+            await asyncio.sleep(delay)
+
+
+async def download_range(url, filepath, offset, length, info, progress_callback, is_cancelled,
+                         connections=DOWNLOAD_CONNECTIONS, hasher=None):
+    """Descarga solo el tramo [offset, offset+length) del archivo remoto en filepath"""
+    try:
+        await segmented_download(
+            get_session(), url, filepath, info,
+            progress_callback, is_cancelled, connections, offset, length, hasher
+        )
+        return True
+    except DownloadCancelled:
+        logger.info(f"Descarga cancelada: {url}")
+        return False
+    except Exception as e:
+        # RemoteChanged incluido: los tramos anteriores ya no serían coherentes
+        logger.error(f"Error descargando tramo {offset}+{length}: {str(e)}")
+        return False
+
+
+async def _segmented_with_restart(session, url, filepath, info, progress_callback, is_cancelled, connections,
+                                  hasher=None):
+    """Descarga segmentada; si el archivo remoto cambió, empieza de nuevo con la versión actual"""
+    try:
+        await segmented_download(
+            session, url, filepath, info,
+            progress_callback, is_cancelled, connections, hasher=hasher
+        )
+    except RemoteChanged as e:
+        logger.warning(f"{str(e)}, reiniciando descarga")
+        TransferJournal(filepath).remove()
+        if hasher:
+            await hasher.reset()
+        info = await probe_ranges(session, url)
+        if not (info['ranges'] and info['size'] > 0):
+            raise RangesUnsupported(f"La versión actual no admite rangos ({url})")
+        await segmented_download(
+            session, url, filepath, info,
+            progress_callback, is_cancelled, connections, hasher=hasher
+        )
+
+
+async def download_direct(url, filepath, progress_callback, is_cancelled, connections=DOWNLOAD_CONNECTIONS,
+                          info=None, hasher=None):
+    """Descarga un enlace directo, segmentado y reanudable si el servidor acepta rangos.
+
+    info es el resultado de una consulta previa (probe.probe_url); si falta se consulta aquí.
+    hasher (checksum.StreamHasher), opcional, calcula los hashes durante la descarga.
+    """
+    session = get_session()
+    try:
+        if info is None:
+            info = await probe_ranges(session, url)
+        if info['ranges'] and info['size'] > 0:
+            try:
+                await _segmented_with_restart(session, url, filepath, info, progress_callback, is_cancelled,
+                                              connections, hasher)
+                return True
+            except RangesUnsupported as e:
+                # stream_download reinicia el hash; el journal ya no sirve
+                logger.warning(f"{str(e)}, descargando en un solo flujo")
+                TransferJournal(filepath).remove()
+        else:
+            logger.info("El servidor no acepta rangos, descargando en un solo flujo")
+        return await _stream_download_with_retry(session, url, filepath, progress_callback, is_cancelled, hasher)
+    except DownloadCancelled:
+        logger.info(f"Descarga cancelada: {url}")
+        return False
+    except Exception as e:
+        logger.error(f"Error aiohttp: {str(e)}")
+        return False
@@ -0,0 +1,185 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+import asyncio
+import logging
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+logger = logging.getLogger(__name__)
+
+# Configuración
+FILE_CACHE_DB = os.environ.get('FILE_CACHE_DB', 'file_cache.db')
+FILE_CACHE_TTL = int(os.environ.get('FILE_CACHE_TTL', 30 * 24 * 3600))  # segundos
+FILE_CACHE_MAX_ENTRIES = int(os.environ.get('FILE_CACHE_MAX_ENTRIES', 10000))
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def normalize_url(url: str):
+    """Normaliza una URL para usarla como clave: esquema/host en minúsculas, sin fragmento ni puerto por defecto"""
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or '').lower()
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{parts.port}"
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, host, parts.path or '/', query, ''))
+
+
+class FileCache:
+    """Caché persistente URL -> file_id(s) de Telegram ya subidos"""
+
+    def __init__(self, path=FILE_CACHE_DB, ttl=FILE_CACHE_TTL, max_entries=FILE_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self._db = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute(
+                """CREATE TABLE IF NOT EXISTS files (
+                    key TEXT PRIMARY KEY,
+                    url TEXT NOT NULL,
+                    etag TEXT,
+                    content_length INTEGER,
+                    last_modified TEXT,
+                    content_hash TEXT,
+                    items TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    last_hit REAL NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0
+                )"""
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS files_hash ON files (content_hash)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS files_last_hit ON files (last_hit)")
+            self._db.commit()
+        return self._db
+
+    @staticmethod
+    def make_key(url: str, filename: str):
+        return f"{normalize_url(url)}|{filename}"
+
+    @staticmethod
+    def _validators_match(row, info):
+        """Compara los validadores guardados con los de la revalidación"""
+        etag, content_length, last_modified = row
+        if info is None:
+            return True
+        if content_length and info.get('size') and content_length != info['size']:
+            return False
+        if etag or info.get('etag'):
+            return etag == info.get('etag')
+        if last_modified or info.get('last_modified'):
+            return last_modified == info.get('last_modified')
+        return True
+
+    def _get(self, key, info):
+        db = self._connect()
+        row = db.execute(
+            "SELECT etag, content_length, last_modified, items, created FROM files WHERE key = ?",
+            (key,)
+        ).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        if time.time() - row[4] > self.ttl or not self._validators_match(row[:3], info):
+            db.execute("DELETE FROM files WHERE key = ?", (key,))
+            db.commit()
+            self.stale += 1
+            self.misses += 1
+            return None
+        db.execute("UPDATE files SET hits = hits + 1, last_hit = ? WHERE key = ?", (time.time(), key))
+        db.commit()
+        self.hits += 1
+        return json.loads(row[3])
+
+    def _put(self, key, url, info, items, content_hash):
+        db = self._connect()
+        info = info or {}
+        now = time.time()
+        db.execute(
+            """INSERT OR REPLACE INTO files
+               (key, url, etag, content_length, last_modified, content_hash, items, created, last_hit, hits)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 0)""",
+            (key, url, info.get('etag'), info.get('size') or None, info.get('last_modified'),
+             content_hash, json.dumps(items), now, now)
+        )
+        self._evict(db)
+        db.commit()
+
+    def _evict(self, db):
+        db.execute("DELETE FROM files WHERE created < ?", (time.time() - self.ttl,))
+        db.execute(
+            """DELETE FROM files WHERE key IN (
+                   SELECT key FROM files ORDER BY last_hit DESC LIMIT -1 OFFSET ?
+               )""",
+            (self.max_entries,)
+        )
+
+    def _find_by_hash(self, content_hash):
+        row = self._connect().execute(
+            "SELECT items FROM files WHERE content_hash = ? AND created >= ? LIMIT 1",
+            (content_hash, time.time() - self.ttl)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def _count(self):
+        return self._connect().execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def _locked(self, func, *args):
+        # Una sola conexión compartida entre los hilos de asyncio.to_thread
+        with self._lock:
+            return func(*args)
+
+    async def get(self, url, filename, info=None):
+        """Devuelve los elementos guardados si siguen siendo válidos para los validadores de info"""
+        try:
+            return await asyncio.to_thread(self._locked, self._get, self.make_key(url, filename), info)
+        except sqlite3.Error as e:
+            logger.error(f"Error leyendo caché: {str(e)}")
+            return None
+
+    async def put(self, url, filename, info, items, content_hash=None):
+        """Guarda los file_id enviados para url+nombre (items: [{'type', 'file_id', 'caption'}])"""
+        if not items or not all(item and item.get('file_id') for item in items):
+            # Sin el file_id de todas las partes la entrada no se podría reenviar
+            logger.info(f"Envío sin file_id, no se guarda en caché: {url}")
+            return
+        try:
+            await asyncio.to_thread(self._locked, self._put, self.make_key(url, filename), url, info, items, content_hash)
+        except sqlite3.Error as e:
+            logger.error(f"Error guardando en caché: {str(e)}")
+
+    async def find_by_hash(self, content_hash):
+        """Busca un envío previo con el mismo contenido aunque venga de otra URL"""
+        try:
+            return await asyncio.to_thread(self._locked, self._find_by_hash, content_hash)
+        except sqlite3.Error as e:
+            logger.error(f"Error leyendo caché: {str(e)}")
+            return None
+
+    async def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'entries': await asyncio.to_thread(self._locked, self._count),
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale': self.stale,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+file_cache = FileCache()
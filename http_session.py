@@ -0,0 +1,48 @@
+import os
+import logging
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+# Configuración
+HTTP_LIMIT = int(os.environ.get('HTTP_LIMIT', 100))
+HTTP_LIMIT_PER_HOST = int(os.environ.get('HTTP_LIMIT_PER_HOST', 16))
+HTTP_DNS_TTL = int(os.environ.get('HTTP_DNS_TTL', 300))  # segundos
+HTTP_CONNECT_TIMEOUT = float(os.environ.get('HTTP_CONNECT_TIMEOUT', 30))
+HTTP_READ_TIMEOUT = float(os.environ.get('HTTP_READ_TIMEOUT', 60))
+HTTP_KEEPALIVE_TIMEOUT = float(os.environ.get('HTTP_KEEPALIVE_TIMEOUT', 30))
+
+_session = None
+
+
+def get_session() -> aiohttp.ClientSession:
+    """Devuelve la sesión HTTP compartida por todo el proceso, creándola si hace falta"""
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=HTTP_LIMIT,
+            limit_per_host=HTTP_LIMIT_PER_HOST,
+            ttl_dns_cache=HTTP_DNS_TTL,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT
+        )
+        # Sin límite total: las descargas grandes pueden durar horas
+        timeout = aiohttp.ClientTimeout(
+            total=None,
+            sock_connect=HTTP_CONNECT_TIMEOUT,
+            sock_read=HTTP_READ_TIMEOUT
+        )
+        _session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        logger.info(
+            f"Sesión HTTP creada (límite {HTTP_LIMIT}, por host {HTTP_LIMIT_PER_HOST}, "
+            f"DNS TTL {HTTP_DNS_TTL}s)"
+        )
+    return _session
+
+
+async def close_session():
+    """Cierra la sesión compartida y libera sus conexiones"""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+        logger.info("Sesión HTTP cerrada")
+    _session = None
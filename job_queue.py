@@ -0,0 +1,294 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import threading
+import asyncio
+import logging
+from scheduler import USER_MAX_ACTIVE, USER_QUEUE_DEPTH
+
+logger = logging.getLogger(__name__)
+
+# Configuración
+JOB_QUEUE_DB = os.environ.get('JOB_QUEUE_DB', 'jobs.db')
+JOB_HEARTBEAT_INTERVAL = float(os.environ.get('JOB_HEARTBEAT_INTERVAL', 10))  # segundos
+JOB_STALL_TIMEOUT = float(os.environ.get('JOB_STALL_TIMEOUT', 60))  # sin latido: se reasigna
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 3))
+JOB_RETENTION = 24 * 3600  # segundos que se conservan las tareas terminadas
+SQLITE_TIMEOUT = 30  # segundos esperando el bloqueo de otro proceso
+
+
+def worker_name(index, pid=None):
+    """Identificador con el que un proceso de trabajo reclama tareas"""
+    return f"{socket.gethostname()}:{index}:{pid or os.getpid()}"
+
+
+class JobQueue:
+    """Cola de tareas persistente en SQLite compartida entre el bot y los procesos de trabajo.
+
+    El bot inserta las tareas; cada proceso de trabajo las reclama (con el mismo reparto
+    por turnos entre usuarios que el planificador), envía latidos mientras trabaja y las
+    completa. Una tarea sin latidos durante JOB_STALL_TIMEOUT vuelve a la cola. Los
+    textos de estado se escriben en la tabla status y el bot los aplica a los mensajes.
+    """
+
+    def __init__(self, path=JOB_QUEUE_DB, user_max_active=USER_MAX_ACTIVE, user_queue_depth=USER_QUEUE_DEPTH):
+        self.path = path
+        self.user_max_active = user_max_active
+        self.user_queue_depth = user_queue_depth
+        self._db = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._db is None:
+            # Transacciones explícitas: BEGIN IMMEDIATE serializa los reclamos entre procesos
+            self._db = sqlite3.connect(self.path, timeout=SQLITE_TIMEOUT, isolation_level=None,
+                                       check_same_thread=False)
+            self._db.row_factory = sqlite3.Row
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                """CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    user_id INTEGER NOT NULL,
+                    chat_id INTEGER NOT NULL,
+                    message_id INTEGER NOT NULL,
+                    status_message_id INTEGER NOT NULL,
+                    kind TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    state TEXT NOT NULL DEFAULT 'queued',
+                    worker TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    outcome TEXT,
+                    created REAL NOT NULL,
+                    claimed REAL,
+                    heartbeat REAL,
+                    finished REAL
+                )"""
+            )
+            self._db.execute(
+                """CREATE TABLE IF NOT EXISTS status (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    job_id TEXT NOT NULL,
+                    text TEXT NOT NULL
+                )"""
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, created)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS jobs_user ON jobs (user_id, state)")
+        return self._db
+
+    def _transaction(self, func, *args):
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            result = func(db, *args)
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+        return result
+
+    async def _call(self, func, *args):
+        # Una sola conexión por proceso, usada desde los hilos de asyncio.to_thread
+        def locked():
+            with self._lock:
+                return self._transaction(func, *args)
+        return await asyncio.to_thread(locked)
+
+    # Bot
+
+    @staticmethod
+    def _submit(db, job_id, user_id, chat_id, message_id, status_message_id, kind, payload):
+        db.execute(
+            """INSERT INTO jobs (id, user_id, chat_id, message_id, status_message_id, kind, payload, created)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+            (job_id, user_id, chat_id, message_id, status_message_id, kind, json.dumps(payload), time.time())
+        )
+
+    async def submit(self, job_id, user_id, chat_id, message_id, status_message_id, kind, payload):
+        """Guarda una tarea; kind y payload indican a los procesos de trabajo qué ejecutar"""
+        await self._call(self._submit, job_id, user_id, chat_id, message_id, status_message_id, kind, payload)
+
+    @staticmethod
+    def _queued_count(db, user_id):
+        return db.execute(
+            "SELECT COUNT(*) FROM jobs WHERE user_id = ? AND state = 'queued'", (user_id,)
+        ).fetchone()[0]
+
+    async def queued_count(self, user_id):
+        return await self._call(self._queued_count, user_id)
+
+    @staticmethod
+    def _statuses(db, after):
+        rows = db.execute(
+            """SELECT s.seq, s.text, j.id, j.chat_id, j.status_message_id
+               FROM status AS s JOIN jobs AS j ON j.id = s.job_id
+               WHERE s.seq > ? ORDER BY s.seq""",
+            (after,)
+        ).fetchall()
+        if rows:
+            db.execute("DELETE FROM status WHERE seq <= ?", (rows[-1]['seq'],))
+        return rows
+
+    async def statuses(self, after=0):
+        """Textos de estado nuevos (se borran al leerlos); solo el más reciente de cada tarea importa"""
+        return await self._call(self._statuses, after)
+
+    # Orden de reclamo: primero el usuario atendido hace más tiempo, y dentro de él la tarea más antigua
+    _ORDER = """ORDER BY COALESCE((SELECT MAX(s.claimed) FROM jobs AS s WHERE s.user_id = j.user_id), 0),
+                         j.created"""
+
+    def _positions(self, db):
+        rows = db.execute(
+            f"""SELECT j.id, j.chat_id, j.status_message_id, json_extract(j.payload, '$.label') AS label
+                FROM jobs AS j WHERE j.state = 'queued' {self._ORDER}"""
+        ).fetchall()
+        return [(position, row) for position, row in enumerate(rows, start=1)]
+
+    async def positions(self):
+        """Posición estimada de cada tarea en espera"""
+        return await self._call(self._positions)
+
+    @staticmethod
+    def _prune(db, retention):
+        db.execute("DELETE FROM jobs WHERE state IN ('done', 'failed') AND finished < ?",
+                   (time.time() - retention,))
+
+    async def prune(self, retention=JOB_RETENTION):
+        await self._call(self._prune, retention)
+
+    @staticmethod
+    def _stats(db, stall_timeout):
+        counts = dict(db.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+        workers = db.execute(
+            "SELECT COUNT(DISTINCT worker) FROM jobs WHERE state = 'running' AND heartbeat >= ?",
+            (time.time() - stall_timeout,)
+        ).fetchone()[0]
+        return {'queued': counts.get('queued', 0), 'running': counts.get('running', 0),
+                'done': counts.get('done', 0), 'failed': counts.get('failed', 0), 'busy_workers': workers}
+
+    async def stats(self):
+        return await self._call(self._stats, JOB_STALL_TIMEOUT)
+
+    # Procesos de trabajo
+
+    def _claim(self, db, worker):
+        row = db.execute(
+            f"""SELECT j.* FROM jobs AS j
+                WHERE j.state = 'queued'
+                  AND (SELECT COUNT(*) FROM jobs AS r WHERE r.user_id = j.user_id AND r.state = 'running') < ?
+                {self._ORDER} LIMIT 1""",
+            (self.user_max_active,)
+        ).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        db.execute(
+            "UPDATE jobs SET state = 'running', worker = ?, attempts = attempts + 1, claimed = ?, heartbeat = ? "
+            "WHERE id = ?",
+            (worker, now, now, row['id'])
+        )
+        job = dict(row, state='running', worker=worker, claimed=now, heartbeat=now)
+        job['payload'] = json.loads(job['payload'])
+        job['attempts'] += 1
+        return job
+
+    async def claim(self, worker):
+        """Reclama la siguiente tarea para worker; None si no hay ninguna disponible"""
+        return await self._call(self._claim, worker)
+
+    @staticmethod
+    def _heartbeat(db, job_id, worker):
+        return db.execute(
+            "UPDATE jobs SET heartbeat = ? WHERE id = ? AND worker = ? AND state = 'running'",
+            (time.time(), job_id, worker)
+        ).rowcount == 1
+
+    async def heartbeat(self, job_id, worker):
+        """Renueva la tarea; False si ya no pertenece a worker (se reasignó por falta de latidos)"""
+        return await self._call(self._heartbeat, job_id, worker)
+
+    @staticmethod
+    def _complete(db, job_id, worker, outcome):
+        db.execute(
+            "UPDATE jobs SET state = 'done', outcome = ?, finished = ? WHERE id = ? AND worker = ? "
+            "AND state = 'running'",
+            (outcome, time.time(), job_id, worker)
+        )
+
+    async def complete(self, job_id, worker, outcome):
+        await self._call(self._complete, job_id, worker, outcome)
+
+    @staticmethod
+    def _release(db, job_id, worker):
+        # El proceso se detiene: la tarea vuelve a la cola sin contar como intento
+        db.execute(
+            "UPDATE jobs SET state = 'queued', worker = NULL, attempts = attempts - 1 "
+            "WHERE id = ? AND worker = ? AND state = 'running'",
+            (job_id, worker)
+        )
+
+    async def release(self, job_id, worker):
+        await self._call(self._release, job_id, worker)
+
+    @staticmethod
+    def _post_status(db, job_id, text):
+        db.execute("INSERT INTO status (job_id, text) VALUES (?, ?)", (job_id, text))
+
+    async def post_status(self, job_id, text):
+        """Envía al bot el texto de estado de una tarea"""
+        await self._call(self._post_status, job_id, text)
+
+    @staticmethod
+    def _running_jobs(db, worker):
+        rows = db.execute("SELECT id FROM jobs WHERE worker = ? AND state = 'running'", (worker,)).fetchall()
+        return [row['id'] for row in rows]
+
+    async def running_jobs(self, worker):
+        """Ids de las tareas que worker tiene en curso"""
+        return await self._call(self._running_jobs, worker)
+
+    @staticmethod
+    def _unfinished(db, job_ids):
+        return sum(
+            db.execute("SELECT COUNT(*) FROM jobs WHERE id = ? AND state NOT IN ('done', 'failed')",
+                       (job_id,)).fetchone()[0]
+            for job_id in job_ids
+        )
+
+    async def unfinished(self, job_ids):
+        """Cuántas de job_ids no han terminado (siguen en cola o en curso en otro proceso)"""
+        return await self._call(self._unfinished, job_ids)
+
+    @staticmethod
+    def _reclaim(db, stall_timeout, max_attempts):
+        stalled = db.execute(
+            "SELECT id, attempts FROM jobs WHERE state = 'running' AND heartbeat < ?",
+            (time.time() - stall_timeout,)
+        ).fetchall()
+        for job_id, attempts in stalled:
+            if attempts >= max_attempts:
+                db.execute("UPDATE jobs SET state = 'failed', outcome = 'stalled', finished = ? WHERE id = ?",
+                           (time.time(), job_id))
+                text = f"[{job_id}] ❌ La tarea se interrumpió {attempts} veces y se abandonó"
+            else:
+                db.execute("UPDATE jobs SET state = 'queued', worker = NULL WHERE id = ?", (job_id,))
+                text = f"[{job_id}] ♻️ La tarea se interrumpió, vuelve a la cola..."
+            db.execute("INSERT INTO status (job_id, text) VALUES (?, ?)", (job_id, text))
+        return len(stalled)
+
+    async def reclaim_stalled(self, stall_timeout=JOB_STALL_TIMEOUT, max_attempts=JOB_MAX_ATTEMPTS):
+        """Devuelve a la cola (o da por fallidas) las tareas cuyo proceso dejó de enviar latidos"""
+        reclaimed = await self._call(self._reclaim, stall_timeout, max_attempts)
+        if reclaimed:
+            logger.warning(f"{reclaimed} tareas sin latido reasignadas")
+        return reclaimed
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+job_queue = JobQueue()
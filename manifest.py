@@ -0,0 +1,466 @@
+import os
+import re
+import math
+import asyncio
+import logging
+import xml.etree.ElementTree as ET
+from collections import deque
+from urllib.parse import urljoin
+from yt_dlp.aes import aes_cbc_decrypt_bytes, unpad_pkcs7
+from http_session import get_session
+from downloader import CHUNK_SIZE, DOWNLOAD_RETRIES, RETRYABLE_ERRORS, DownloadCancelled, backoff_delay
+from media_tools import run_tool, MediaToolError
+from bandwidth import throttle
+from metrics import record_retry
+
+logger = logging.getLogger(__name__)
+
+# Configuración
+MANIFEST_CONCURRENCY = int(os.environ.get('MANIFEST_CONCURRENCY', 16))  # segmentos descargados a la vez
+MANIFEST_MAX_HEIGHT = int(os.environ.get('MANIFEST_MAX_HEIGHT', 720))  # como height<=720 en YTDLP_FORMAT
+MANIFEST_REMUX_TIMEOUT = float(os.environ.get('MANIFEST_REMUX_TIMEOUT', 1800))  # segundos
+MANIFEST_WINDOW = 2  # segmentos por conexión que pueden esperar en memoria a escribirse en orden
+MANIFEST_MAX_BYTES = 16 * 1024 * 1024  # tamaño máximo del texto de un manifiesto
+
+
+class ManifestUnsupported(Exception):
+    """El manifiesto necesita yt-dlp (directo, DRM, cifrado distinto de AES-128...)"""
+
+
+class Segment:
+    """Un segmento a descargar; byterange es (offset, longitud) y key la URL de la clave AES-128"""
+
+    def __init__(self, url, byterange=None, key=None, iv=None):
+        self.url = url
+        self.byterange = byterange
+        self.key = key
+        self.iv = iv
+
+
+def choose_variant(variants, max_height=MANIFEST_MAX_HEIGHT):
+    """La mejor variante con altura <= max_height; si ninguna la cumple, la mejor (como YTDLP_FORMAT)"""
+    fitting = [v for v in variants if v['height'] and v['height'] <= max_height]
+    return max(fitting or variants, key=lambda v: (v['height'] or 0, v['bandwidth']))
+
+
+# HLS
+
+def _attributes(text):
+    """Atributos CLAVE=valor de una etiqueta HLS (los valores pueden ir entre comillas)"""
+    return {key: value.strip('"') for key, value in re.findall(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)', text)}
+
+
+def _byterange(value, previous_end):
+    length, _, offset = value.partition('@')
+    return int(offset) if offset else previous_end, int(length)
+
+
+def parse_hls_master(text, base):
+    """Variantes de una lista maestra y la URL del audio por defecto de cada grupo"""
+    variants, groups, pending = [], {}, None
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith('#EXT-X-STREAM-INF:'):
+            pending = _attributes(line.split(':', 1)[1])
+        elif line.startswith('#EXT-X-MEDIA:'):
+            attrs = _attributes(line.split(':', 1)[1])
+            # Sin URI el audio va dentro de la variante
+            if attrs.get('TYPE') == 'AUDIO' and attrs.get('URI'):
+                groups.setdefault(attrs.get('GROUP-ID'), []).append(attrs)
+        elif line and not line.startswith('#') and pending is not None:
+            width, _, height = pending.get('RESOLUTION', '').partition('x')
+            variants.append({
+                'url': urljoin(base, line),
+                'bandwidth': int(pending.get('BANDWIDTH') or 0),
+                'height': int(height) if height.isdigit() else None,
+                'audio': pending.get('AUDIO')
+            })
+            pending = None
+    audio = {
+        group: urljoin(base, next((a for a in items if a.get('DEFAULT') == 'YES'), items[0])['URI'])
+        for group, items in groups.items()
+    }
+    return variants, audio
+
+
+def parse_hls_media(text, base):
+    """Segmentos de una lista de medios, con su clave e IV si está cifrada"""
+    if '#EXT-X-ENDLIST' not in text:
+        raise ManifestUnsupported("transmisión en directo")
+    segments = []
+    sequence = 0
+    key = iv = init = byterange = None
+    previous_end = 0
+    for line in text.splitlines():
+        line = line.strip()
+        tag, _, value = line.partition(':')
+        if tag == '#EXT-X-MEDIA-SEQUENCE':
+            sequence = int(value)
+        elif tag == '#EXT-X-KEY':
+            attrs = _attributes(value)
+            method = attrs.get('METHOD', 'NONE')
+            if method == 'NONE':
+                key = iv = None
+            elif method == 'AES-128':
+                key = urljoin(base, attrs['URI'])
+                iv = bytes.fromhex(attrs['IV'][2:].rjust(32, '0')) if 'IV' in attrs else None
+            else:
+                raise ManifestUnsupported(f"cifrado {method}")
+        elif tag == '#EXT-X-MAP':
+            attrs = _attributes(value)
+            map_range = _byterange(attrs['BYTERANGE'], 0) if 'BYTERANGE' in attrs else None
+            # Tras una discontinuidad suele repetirse el mismo segmento de inicio
+            if (attrs['URI'], map_range) != init:
+                init = (attrs['URI'], map_range)
+                segments.append(Segment(urljoin(base, attrs['URI']), map_range, key, iv or bytes(16)))
+        elif tag == '#EXT-X-BYTERANGE':
+            byterange = _byterange(value, previous_end)
+        elif line and not line.startswith('#'):
+            # Sin IV explícito se usa el número de secuencia del segmento
+            segment_iv = iv or sequence.to_bytes(16, 'big')
+            segments.append(Segment(urljoin(base, line), byterange, key, segment_iv if key else None))
+            if byterange:
+                previous_end = sum(byterange)
+            byterange = None
+            sequence += 1
+    return segments
+
+
+# DASH
+
+def _local(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def _children(element, name):
+    return [child for child in element if _local(child.tag) == name] if element is not None else []
+
+
+def _child(element, name):
+    children = _children(element, name)
+    return children[0] if children else None
+
+
+def _base_url(element, base):
+    child = _child(element, 'BaseURL')
+    return urljoin(base, child.text.strip()) if child is not None and child.text else base
+
+
+def _iso_duration(value):
+    """Duración ISO 8601 (PT1H2M3.5S) en segundos"""
+    match = re.fullmatch(r'P(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:([\d.]+)S)?)?', value or '')
+    if not match:
+        return 0.0
+    days, hours, minutes, seconds = (float(part or 0) for part in match.groups())
+    return ((days * 24 + hours) * 60 + minutes) * 60 + seconds
+
+
+def _fill(template, values):
+    """Sustituye $Number$, $Time$, $RepresentationID$, $Bandwidth$ (con formato %0Nd opcional)"""
+    def replace(match):
+        if not match.group(1):
+            return '$'
+        value = values[match.group(1)]
+        return match.group(2) % value if match.group(2) else str(value)
+    return re.sub(r'\$(?:(\w+)(%0\d+d)?)?\$', replace, template)
+
+
+def _range(value):
+    start, _, end = value.partition('-')
+    return int(start), int(end) - int(start) + 1
+
+
+def _dash_segments(representation, adaptation, period_duration, base):
+    base = _base_url(representation, base)
+    values = {
+        'RepresentationID': representation.get('id'),
+        'Bandwidth': int(representation.get('bandwidth') or 0)
+    }
+    # La plantilla puede estar en el AdaptationSet y completarse en la Representation
+    templates = [t for t in (_child(adaptation, 'SegmentTemplate'), _child(representation, 'SegmentTemplate'))
+                 if t is not None]
+    if templates:
+        attrs = {}
+        for template in templates:
+            attrs.update(template.attrib)
+        timeline = next((t for t in (_child(tpl, 'SegmentTimeline') for tpl in reversed(templates))
+                         if t is not None), None)
+        number = int(attrs.get('startNumber', 1))
+        timescale = int(attrs.get('timescale', 1))
+        segments = []
+        if 'initialization' in attrs:
+            segments.append(Segment(urljoin(base, _fill(attrs['initialization'], values))))
+        times = []
+        if timeline is not None:
+            time = 0
+            for entry in _children(timeline, 'S'):
+                time = int(entry.get('t', time))
+                duration = int(entry.get('d'))
+                repeat = int(entry.get('r', 0))
+                if repeat < 0:
+                    # Repetir hasta el final del periodo
+                    repeat = math.ceil((period_duration * timescale - time) / duration) - 1
+                for _ in range(repeat + 1):
+                    times.append(time)
+                    time += duration
+        elif 'duration' in attrs:
+            duration = int(attrs['duration'])
+            times = [i * duration for i in range(math.ceil(period_duration * timescale / duration))]
+        for index, time in enumerate(times):
+            url = _fill(attrs['media'], dict(values, Number=number + index, Time=time))
+            segments.append(Segment(urljoin(base, url)))
+        return segments
+    segment_list = _child(representation, 'SegmentList')
+    if segment_list is None:
+        segment_list = _child(adaptation, 'SegmentList')
+    if segment_list is not None:
+        segments = []
+        init = _child(segment_list, 'Initialization')
+        if init is not None:
+            segments.append(Segment(
+                urljoin(base, init.get('sourceURL', '')),
+                _range(init.get('range')) if init.get('range') else None
+            ))
+        for item in _children(segment_list, 'SegmentURL'):
+            segments.append(Segment(
+                urljoin(base, item.get('media', '')),
+                _range(item.get('mediaRange')) if item.get('mediaRange') else None
+            ))
+        return segments
+    # SegmentBase o nada: la representación es un único archivo
+    return [Segment(base)]
+
+
+def parse_dash(text, base, max_height=MANIFEST_MAX_HEIGHT):
+    """Segmentos de la mejor representación de video (con altura <= max_height) y de audio"""
+    root = ET.fromstring(text)
+    if root.get('type') == 'dynamic':
+        raise ManifestUnsupported("transmisión en directo")
+    periods = _children(root, 'Period')
+    if len(periods) != 1:
+        raise ManifestUnsupported(f"{len(periods)} periodos")
+    period = periods[0]
+    duration = _iso_duration(period.get('duration') or root.get('mediaPresentationDuration'))
+    base = _base_url(period, _base_url(root, base))
+    candidates = {'video': [], 'audio': []}
+    for adaptation in _children(period, 'AdaptationSet'):
+        if _children(adaptation, 'ContentProtection'):
+            continue
+        for representation in _children(adaptation, 'Representation'):
+            if _children(representation, 'ContentProtection'):
+                continue
+            kind = (adaptation.get('contentType') or representation.get('mimeType')
+                    or adaptation.get('mimeType') or '').split('/')[0]
+            if kind not in candidates:
+                continue
+            height = representation.get('height') or adaptation.get('height')
+            candidates[kind].append({
+                'representation': representation, 'adaptation': adaptation,
+                'bandwidth': int(representation.get('bandwidth') or 0),
+                'height': int(height) if height else None,
+                'base': _base_url(adaptation, base)
+            })
+    chosen = []
+    if candidates['video']:
+        chosen.append(choose_variant(candidates['video'], max_height))
+    if candidates['audio']:
+        chosen.append(max(candidates['audio'], key=lambda a: a['bandwidth']))
+    if not chosen:
+        raise ManifestUnsupported("sin representaciones sin DRM")
+    return [_dash_segments(c['representation'], c['adaptation'], duration, c['base']) for c in chosen]
+
+
+# Descarga
+
+async def _get_text(session, url):
+    async with session.get(url) as response:
+        response.raise_for_status()
+        if (response.content_length or 0) > MANIFEST_MAX_BYTES:
+            raise ManifestUnsupported(f"manifiesto de {response.content_length} bytes")
+        # read(n) devuelve lo que haya llegado: se lee hasta el final sin pasar del límite
+        data = bytearray()
+        while True:
+            chunk = await response.content.read(MANIFEST_MAX_BYTES + 1 - len(data))
+            if not chunk:
+                break
+            data += chunk
+            if len(data) > MANIFEST_MAX_BYTES:
+                raise ManifestUnsupported(f"manifiesto de más de {MANIFEST_MAX_BYTES} bytes")
+        return data.decode('utf-8', errors='replace'), str(response.url)
+
+
+async def _load(session, url, max_height):
+    text, final_url = await _get_text(session, url)
+    if text.lstrip('\ufeff \r\n').startswith('#EXTM3U'):
+        if '#EXT-X-STREAM-INF' not in text:
+            return [parse_hls_media(text, final_url)]
+        variants, audio = parse_hls_master(text, final_url)
+        if not variants:
+            raise ManifestUnsupported("lista maestra sin variantes")
+        variant = choose_variant(variants, max_height)
+        tracks = [variant['url']]
+        if variant['audio'] in audio:
+            tracks.append(audio[variant['audio']])
+        return [parse_hls_media(*await _get_text(session, track)) for track in tracks]
+    if '<MPD' in text:
+        return parse_dash(text, final_url, max_height)
+    raise ManifestUnsupported("formato de manifiesto desconocido")
+
+
+async def load_manifest(url, max_height=MANIFEST_MAX_HEIGHT):
+    """Lee el manifiesto HLS o DASH y devuelve los segmentos de cada pista a descargar"""
+    try:
+        return await _load(get_session(), url, max_height)
+    except (ET.ParseError, KeyError, ValueError, TypeError) as e:
+        # Algo que este lector no entiende: que lo intente yt-dlp
+        raise ManifestUnsupported(f"manifiesto no reconocido ({type(e).__name__}: {str(e)})")
+
+
+class _SegmentProgress:
+    """Progreso exacto por segmentos: el total en bytes se estima con el tamaño medio"""
+
+    def __init__(self, count, callback):
+        self.count = count
+        self.done = 0
+        self.bytes = 0
+        self.callback = callback
+
+    async def add(self, nbytes):
+        self.done += 1
+        self.bytes += nbytes
+        await self.callback(self.bytes, self.bytes * self.count // self.done, self.done, self.count)
+
+
+class _Downloader:
+    """Descarga las pistas de un manifiesto con conexiones compartidas y claves en caché"""
+
+    def __init__(self, is_cancelled, concurrency=MANIFEST_CONCURRENCY):
+        self.session = get_session()
+        self.is_cancelled = is_cancelled
+        self.concurrency = concurrency
+        self.slots = asyncio.Semaphore(concurrency)
+        self.keys = {}  # URL -> tarea que descarga la clave
+
+    async def _get(self, url, byterange=None):
+        headers = {'Range': f'bytes={byterange[0]}-{sum(byterange) - 1}'} if byterange else {}
+        attempt = 0
+        while True:
+            if self.is_cancelled():
+                raise DownloadCancelled()
+            try:
+                data = bytearray()
+                async with self.session.get(url, headers=headers) as response:
+                    response.raise_for_status()
+                    if byterange and response.status != 206:
+                        # Sin rango se recibiría el archivo entero en lugar del segmento
+                        raise ManifestUnsupported(f"el servidor no admite rangos en {url}")
+                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                        if self.is_cancelled():
+                            raise DownloadCancelled()
+                        data += chunk
+                        await throttle('down', len(chunk))
+                return bytes(data)
+            except RETRYABLE_ERRORS as e:
+                if attempt >= DOWNLOAD_RETRIES:
+                    raise
+                delay = backoff_delay(attempt)
+                attempt += 1
+                record_retry('download')
+                logger.warning(f"Error en segmento {url} ({str(e)}), reintento {attempt}/{DOWNLOAD_RETRIES} en {delay}s")
+                await asyncio.sleep(delay)
+
+    async def _segment(self, segment):
+        async with self.slots:
+            data = await self._get(segment.url, segment.byterange)
+        if segment.key:
+            if segment.key not in self.keys:
+                self.keys[segment.key] = asyncio.ensure_future(self._get(segment.key))
+            key = await self.keys[segment.key]
+            data = await asyncio.to_thread(lambda: unpad_pkcs7(aes_cbc_decrypt_bytes(data, key, segment.iv)))
+        return data
+
+    async def track(self, segments, path, progress):
+        """Descarga los segmentos en paralelo y los escribe en orden en path"""
+        pending = deque()
+        remaining = iter(segments)
+
+        def schedule():
+            # Ventana acotada: la memoria no crece aunque un segmento lento retenga a los siguientes
+            while len(pending) < self.concurrency * MANIFEST_WINDOW:
+                segment = next(remaining, None)
+                if segment is None:
+                    return
+                pending.append(asyncio.ensure_future(self._segment(segment)))
+
+        try:
+            with open(path, 'wb') as f:
+                schedule()
+                while pending:
+                    data = await pending.popleft()
+                    schedule()
+                    await asyncio.to_thread(f.write, data)
+                    await progress.add(len(data))
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def close(self):
+        for task in self.keys.values():
+            task.cancel()
+        await asyncio.gather(*self.keys.values(), return_exceptions=True)
+
+
+async def _remux(track_paths, filepath):
+    """Une las pistas en un contenedor sin recodificar (solo video y audio)"""
+    cmd = ['ffmpeg', '-y', '-v', 'error']
+    for path in track_paths:
+        cmd += ['-i', path]
+    for index in range(len(track_paths)):
+        cmd += ['-map', f'{index}:v?', '-map', f'{index}:a?']
+    if filepath.lower().endswith('.mkv'):
+        cmd += ['-c', 'copy', '-f', 'matroska', filepath]
+    else:
+        cmd += ['-c', 'copy', '-movflags', '+faststart', '-f', 'mp4', filepath]
+    await run_tool(cmd, timeout=MANIFEST_REMUX_TIMEOUT)
+
+
+async def download_manifest(url, filepath, progress_callback, is_cancelled):
+    """Descarga un manifiesto HLS/DASH sin yt-dlp y lo deja en filepath.
+
+    progress_callback(bytes, total estimado, segmentos descargados, segmentos) se llama
+    por cada segmento escrito. Lanza ManifestUnsupported si el manifiesto necesita
+    yt-dlp; devuelve False si la descarga falla o se cancela.
+    """
+    try:
+        tracks = await load_manifest(url)
+    except RETRYABLE_ERRORS as e:
+        logger.error(f"Error leyendo el manifiesto {url}: {str(e)}")
+        return False
+    if not all(tracks):
+        raise ManifestUnsupported("pista sin segmentos")
+    logger.info(f"Manifiesto {url}: {len(tracks)} pistas, {sum(len(t) for t in tracks)} segmentos")
+    progress = _SegmentProgress(sum(len(t) for t in tracks), progress_callback)
+    track_paths = [f"{filepath}.track{index}" for index in range(len(tracks))]
+    downloader = _Downloader(is_cancelled)
+    tasks = [asyncio.ensure_future(downloader.track(segments, path, progress))
+             for segments, path in zip(tracks, track_paths)]
+    try:
+        await asyncio.gather(*tasks)
+        await _remux(track_paths, filepath)
+        return True
+    except DownloadCancelled:
+        logger.info(f"Descarga de manifiesto cancelada: {url}")
+    except (*RETRYABLE_ERRORS, MediaToolError, OSError, ValueError) as e:
+        logger.error(f"Error descargando manifiesto {url}: {str(e)}")
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await downloader.close()
+        for path in track_paths:
+            if os.path.exists(path):
+                os.remove(path)
+    if os.path.exists(filepath):
+        os.remove(filepath)
+    return False
@@ -0,0 +1,274 @@
+import os
+import re
+import glob
+import json
+import struct
+import asyncio
+import logging
+from metrics import track_stage
+
+logger = logging.getLogger(__name__)
+
+# Configuración
+MEDIA_TOOL_CONCURRENCY = int(os.environ.get('MEDIA_TOOL_CONCURRENCY', 4))
+MEDIA_TOOL_TIMEOUT = float(os.environ.get('MEDIA_TOOL_TIMEOUT', 120))  # segundos
+THUMBNAIL_OFFSET = 5  # segundos
+VIDEO_SPLIT_TIMEOUT = float(os.environ.get('VIDEO_SPLIT_TIMEOUT', 1800))  # segundos por pasada de ffmpeg
+VIDEO_PART_FILL = 0.9  # fracción del tamaño máximo que se apunta por parte (margen para GOPs largos)
+VIDEO_SPLIT_ATTEMPTS = 3
+
+_process_slots = asyncio.Semaphore(MEDIA_TOOL_CONCURRENCY)
+
+
+class MediaToolError(Exception):
+    """Error o timeout al ejecutar ffprobe/ffmpeg/7z; stderr guarda la salida de error completa"""
+
+    def __init__(self, message, stderr=b''):
+        super().__init__(message)
+        self.stderr = stderr
+
+
+async def run_tool(cmd, timeout=MEDIA_TOOL_TIMEOUT, slots=None):
+    """Ejecuta una herramienta externa sin bloquear el event loop y devuelve (stdout, stderr).
+
+    slots es el semáforo que limita la llamada; por defecto el de MEDIA_TOOL_CONCURRENCY.
+    """
+    async with slots or _process_slots:
+        process = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+            raise MediaToolError(f"{cmd[0]} superó el tiempo límite de {timeout}s")
+        except asyncio.CancelledError:
+            process.kill()
+            await process.wait()
+            raise
+
+    if process.returncode != 0:
+        raise MediaToolError(
+            f"{cmd[0]} terminó con código {process.returncode}: "
+            f"{stderr.decode(errors='replace').strip()[-500:]}",
+            stderr
+        )
+    return stdout, stderr
+
+
+def is_faststart(file_path):
+    """Indica si el átomo moov está antes que mdat (el video se puede reproducir en streaming)"""
+    try:
+        with open(file_path, 'rb') as f:
+            while True:
+                header = f.read(8)
+                if len(header) < 8:
+                    return False
+                size, kind = struct.unpack('>I4s', header)
+                if kind == b'moov':
+                    return True
+                if kind == b'mdat':
+                    return False
+                if size == 1:
+                    size = struct.unpack('>Q', f.read(8))[0] - 8
+                elif size == 0:
+                    return False
+                f.seek(size - 8, os.SEEK_CUR)
+    except (OSError, struct.error):
+        return False
+
+
+async def get_video_metadata(file_path):
+    """Obtiene metadatos del video usando ffprobe"""
+    try:
+        with track_stage('metadata'):
+            stdout, _ = await run_tool(
+                ['ffprobe', '-v', 'quiet', '-print_format', 'json', '-show_format', '-show_streams', file_path]
+            )
+        metadata = json.loads(stdout)
+
+        video_stream = next((stream for stream in metadata['streams'] if stream['codec_type'] == 'video'), None)
+
+        if video_stream:
+            width = int(video_stream.get('width', 0))
+            height = int(video_stream.get('height', 0))
+            duration = float(metadata['format'].get('duration', 0))
+            size = int(metadata['format'].get('size', 0))
+            format_name = metadata['format'].get('format_name', '')
+            return {
+                'width': width,
+                'height': height,
+                'resolution': f"{width}x{height}",
+                'duration': duration,
+                'size': size,
+                'bit_rate': int(metadata['format'].get('bit_rate', 0) or 0),
+                'supports_streaming': 'mp4' in format_name and await asyncio.to_thread(is_faststart, file_path)
+            }
+        return None
+    except Exception as e:
+        logger.error(f"Error obteniendo metadatos: {str(e)}")
+        return None
+
+
+def _thumb_path(video_path, task_id):
+    # Junto al video: queda dentro del espacio de trabajo de la tarea
+    return os.path.join(os.path.dirname(video_path), f"thumb_{task_id}.jpg")
+
+
+_INPUT_RE = re.compile(r"^Input #0, (.+?), from ", re.M)
+_DURATION_RE = re.compile(r"Duration: (\d+):(\d+):(\d+(?:\.\d+)?)(?:, start: [^,]+)?(?:, bitrate: (\d+) kb/s)?")
+_VIDEO_RE = re.compile(r"^\s*Stream #0:\d+.*?: Video: (.*)$", re.M)
+_RESOLUTION_RE = re.compile(r"\b(\d{2,5})x(\d{2,5})\b")
+
+
+def parse_ffmpeg_input(stderr):
+    """Metadatos de la entrada a partir de la cabecera que ffmpeg escribe en stderr.
+
+    Devuelve un dict con width, height, duration, bit_rate y format_name, o None si no
+    hay flujo de video (las carátulas de los audios no cuentan).
+    """
+    text = stderr.decode(errors='replace') if isinstance(stderr, bytes) else stderr
+    # Solo la descripción de la entrada, no la de la salida
+    text = re.split(r"^(?:Output #0|Stream mapping:)", text, maxsplit=1, flags=re.M)[0]
+    video = next((m.group(1) for m in _VIDEO_RE.finditer(text) if '(attached pic)' not in m.group(1)), None)
+    resolution = _RESOLUTION_RE.search(video) if video else None
+    if not resolution:
+        return None
+    duration = _DURATION_RE.search(text)
+    input_format = _INPUT_RE.search(text)
+    return {
+        'width': int(resolution.group(1)),
+        'height': int(resolution.group(2)),
+        'duration': (int(duration.group(1)) * 3600 + int(duration.group(2)) * 60 + float(duration.group(3))
+                     if duration else 0.0),
+        'bit_rate': int(duration.group(4)) * 1000 if duration and duration.group(4) else 0,
+        'format_name': input_format.group(1) if input_format else ''
+    }
+
+
+async def generate_thumbnail(video_path, task_id, duration=None):
+    """Genera una miniatura para el video buscando antes de abrir la entrada (-ss antes de -i)"""
+    thumb_path = _thumb_path(video_path, task_id)
+    seek = THUMBNAIL_OFFSET
+    if duration:
+        # En videos cortos tomar el fotograma de la mitad
+        seek = min(THUMBNAIL_OFFSET, duration / 2)
+    try:
+        with track_stage('thumbnail'):
+            await run_tool(
+                ['ffmpeg', '-y', '-ss', f"{seek:.2f}", '-i', video_path,
+                 '-frames:v', '1', '-q:v', '2', thumb_path]
+            )
+        if os.path.exists(thumb_path):
+            return thumb_path
+    except Exception as e:
+        logger.error(f"Error generando miniatura: {e}")
+    return None
+
+
+async def prepare_video(file_path, task_id):
+    """Obtiene metadatos y miniatura con una sola ejecución de ffmpeg; None si no es un video válido.
+
+    La miniatura se extrae en THUMBNAIL_OFFSET y los metadatos salen de la cabecera que
+    ffmpeg escribe al abrir la entrada. Solo los videos más cortos que THUMBNAIL_OFFSET
+    necesitan una segunda ejecución, ya con la duración conocida.
+    """
+    thumb_path = _thumb_path(file_path, task_id)
+    try:
+        with track_stage('metadata'):
+            _, stderr = await run_tool(
+                ['ffmpeg', '-hide_banner', '-y', '-ss', f"{THUMBNAIL_OFFSET:.2f}", '-i', file_path,
+                 '-map', '0:v:0', '-frames:v', '1', '-q:v', '2', thumb_path]
+            )
+    except MediaToolError as e:
+        # Sin flujo de video ffmpeg falla, pero la cabecera de la entrada ya está en stderr
+        stderr = e.stderr
+    metadata = parse_ffmpeg_input(stderr)
+    if not metadata:
+        if os.path.exists(thumb_path):
+            os.remove(thumb_path)
+        return None
+    size = await asyncio.to_thread(os.path.getsize, file_path)
+    faststart = 'mp4' in metadata['format_name'] and await asyncio.to_thread(is_faststart, file_path)
+    metadata.update(
+        resolution=f"{metadata['width']}x{metadata['height']}",
+        size=size,
+        bit_rate=metadata['bit_rate'] or (int(size * 8 / metadata['duration']) if metadata['duration'] else 0),
+        supports_streaming=faststart
+    )
+    del metadata['format_name']
+    if os.path.exists(thumb_path) and os.path.getsize(thumb_path):
+        metadata['thumb'] = thumb_path
+    else:
+        # Video más corto que THUMBNAIL_OFFSET: fotograma de la mitad
+        metadata['thumb'] = await generate_thumbnail(file_path, task_id, metadata['duration'])
+    return metadata
+
+
+async def _segment_video(file_path, pattern, segment_seconds):
+    """Corta el video en tramos de ~segment_seconds copiando los flujos (sin recodificar).
+
+    El muxer segment solo corta en fotogramas clave, así cada parte empieza con uno y
+    se reproduce por sí sola.
+    """
+    ext = os.path.splitext(file_path)[1].lower()
+    cmd = [
+        'ffmpeg', '-y', '-v', 'error', '-i', file_path,
+        '-map', '0:v:0', '-map', '0:a?', '-c', 'copy',
+        '-f', 'segment', '-segment_time', f"{segment_seconds:.2f}",
+        '-reset_timestamps', '1', '-avoid_negative_ts', 'make_zero'
+    ]
+    if ext in ('.mp4', '.m4v', '.mov'):
+        # moov al principio: cada parte se puede ver en streaming
+        cmd += ['-segment_format_options', 'movflags=+faststart']
+    await run_tool(cmd + [pattern], timeout=VIDEO_SPLIT_TIMEOUT)
+
+
+async def split_video_by_time(file_path, out_dir, metadata, max_size):
+    """Divide un video en partes reproducibles de menos de max_size bytes.
+
+    La duración de cada parte se calcula con el bitrate de metadata; si alguna parte
+    queda grande (bitrate variable) se repite con tramos más cortos. Devuelve la lista
+    ordenada de rutas o None si no se pudo dividir.
+    """
+    size = metadata['size'] or os.path.getsize(file_path)
+    duration = metadata['duration']
+    if not duration:
+        return None
+    bytes_per_second = metadata['bit_rate'] / 8 if metadata['bit_rate'] else size / duration
+    segment_seconds = max_size * VIDEO_PART_FILL / bytes_per_second
+
+    stem, ext = os.path.splitext(os.path.basename(file_path))
+    # Patrón de ffmpeg (printf): los '%' del nombre se escapan
+    pattern = os.path.join(out_dir, stem.replace('%', '%%') + ".part%03d" + ext.replace('%', '%%'))
+    part_glob = os.path.join(glob.escape(out_dir), glob.escape(f"{stem}.part") + "[0-9]" * 3 + glob.escape(ext))
+
+    def remove_parts():
+        for part in glob.glob(part_glob):
+            os.remove(part)
+
+    try:
+        # Partes de un intento anterior interrumpido (el directorio de la tarea se conserva)
+        remove_parts()
+        with track_stage('video_split'):
+            for attempt in range(VIDEO_SPLIT_ATTEMPTS):
+                await _segment_video(file_path, pattern, segment_seconds)
+                parts = sorted(glob.glob(part_glob))
+                largest = max((os.path.getsize(p) for p in parts), default=0)
+                if parts and largest <= max_size:
+                    return parts
+                logger.warning(
+                    f"Parte de {largest / (1024 * 1024):.0f} MB supera el límite, "
+                    f"reintentando ({attempt + 1}/{VIDEO_SPLIT_ATTEMPTS})"
+                )
+                remove_parts()
+                if not largest:
+                    break
+                segment_seconds *= max_size * VIDEO_PART_FILL / largest
+    except Exception as e:
+        logger.error(f"Error dividiendo video: {str(e)}")
+        remove_parts()
+    return None
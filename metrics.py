@@ -0,0 +1,198 @@
+import os
+import json
+import time
+import logging
+import contextvars
+from bisect import bisect_left
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Configuración
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 0))  # 0 desactiva el endpoint
+METRICS_HOST = os.environ.get('METRICS_HOST', '127.0.0.1')
+
+DURATION_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+THROUGHPUT_BUCKETS = tuple(mb * 1024 * 1024 for mb in (0.5, 1, 2, 5, 10, 20, 50, 100, 200))
+
+
+def _labels_text(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in self.values.items():
+            lines.append(f"{self.name}{_labels_text(key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=DURATION_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = buckets
+        self.values = {}  # labels -> [conteos por bucket, suma, total]
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        counts, total_sum, count = self.values.get(key, ([0] * len(self.buckets), 0.0, 0))
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            counts[index] += 1
+        self.values[key] = (counts, total_sum + value, count + 1)
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total_sum, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_labels_text(key + (('le', bound),))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_labels_text(key + (('le', '+Inf'),))} {count}")
+            lines.append(f"{self.name}_sum{_labels_text(key)} {total_sum}")
+            lines.append(f"{self.name}_count{_labels_text(key)} {count}")
+        return lines
+
+
+stage_duration = Histogram('urlbot_stage_duration_seconds', 'Duración de cada etapa de una tarea')
+stage_throughput = Histogram(
+    'urlbot_stage_throughput_bytes_per_second', 'Velocidad de las etapas que transfieren datos',
+    THROUGHPUT_BUCKETS
+)
+stage_bytes = Counter('urlbot_stage_bytes_total', 'Bytes procesados por etapa')
+stage_errors = Counter('urlbot_stage_errors_total', 'Etapas terminadas con error')
+retries = Counter('urlbot_retries_total', 'Reintentos por etapa')
+floodwait_seconds = Counter('urlbot_floodwait_seconds_total', 'Segundos de FloodWait recibidos')
+queue_wait = Histogram('urlbot_queue_wait_seconds', 'Tiempo en cola antes de empezar una tarea')
+tasks = Counter('urlbot_tasks_total', 'Tareas terminadas por resultado')
+
+REGISTRY = (stage_duration, stage_throughput, stage_bytes, stage_errors, retries,
+            floodwait_seconds, queue_wait, tasks)
+
+_current_task = contextvars.ContextVar('current_task_metrics', default=None)
+
+
+class TaskMetrics:
+    """Resumen de una tarea: duración y bytes por etapa, reintentos, FloodWait y espera en cola"""
+
+    def __init__(self, task_id, queue_wait_seconds=0.0):
+        self.task_id = task_id
+        self.start_time = time.time()
+        self.queue_wait = queue_wait_seconds
+        self.stages = {}
+        self.retries = {}
+        self.floodwait = 0.0
+        self.result = None
+
+    def summary(self):
+        return {
+            'event': 'task_summary',
+            'task_id': self.task_id,
+            'result': self.result,
+            'queue_wait': round(self.queue_wait, 3),
+            'total_seconds': round(time.time() - self.start_time, 3),
+            'stages': self.stages,
+            'retries': self.retries,
+            'floodwait_seconds': self.floodwait
+        }
+
+
+class _Stage:
+    """Mide una etapa; asignar .bytes para registrar volumen y velocidad"""
+
+    def __init__(self, name):
+        self.name = name
+        self.bytes = 0
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.monotonic() - self.start
+        stage_duration.observe(elapsed, stage=self.name)
+        if exc_type is not None:
+            stage_errors.inc(stage=self.name)
+        if self.bytes:
+            stage_bytes.inc(self.bytes, stage=self.name)
+            if elapsed > 0:
+                stage_throughput.observe(self.bytes / elapsed, stage=self.name)
+
+        task = _current_task.get()
+        if task is not None:
+            entry = task.stages.setdefault(self.name, {'seconds': 0.0, 'bytes': 0})
+            entry['seconds'] = round(entry['seconds'] + elapsed, 3)
+            entry['bytes'] += self.bytes
+        return False
+
+
+def track_stage(name):
+    """Context manager que mide la duración (y opcionalmente bytes) de una etapa"""
+    return _Stage(name)
+
+
+def record_retry(stage):
+    retries.inc(stage=stage)
+    task = _current_task.get()
+    if task is not None:
+        task.retries[stage] = task.retries.get(stage, 0) + 1
+
+
+def record_floodwait(seconds):
+    floodwait_seconds.inc(seconds)
+    task = _current_task.get()
+    if task is not None:
+        task.floodwait += seconds
+
+
+def begin_task(task_id, queue_wait_seconds=0.0):
+    """Asocia las métricas de una tarea al contexto actual (y a sus subtareas asyncio)"""
+    task = TaskMetrics(task_id, queue_wait_seconds)
+    queue_wait.observe(queue_wait_seconds)
+    _current_task.set(task)
+    return task
+
+
+def finish_task(task, result):
+    """Registra el resultado y escribe una línea JSON con el resumen de la tarea"""
+    task.result = result
+    tasks.inc(result=result)
+    logger.info(json.dumps(task.summary(), ensure_ascii=False))
+
+
+def exposition():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.expose())
+    return "\n".join(lines) + "\n"
+
+
+async def _metrics_handler(request):
+    return web.Response(text=exposition(), content_type='text/plain', charset='utf-8')
+
+
+async def start_metrics_server(port=METRICS_PORT, host=METRICS_HOST):
+    """Inicia el endpoint /metrics en formato Prometheus; devuelve el runner o None si está desactivado"""
+    if not port:
+        return None
+    app = web.Application()
+    app.router.add_get('/metrics', _metrics_handler)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Métricas disponibles en http://{host}:{port}/metrics")
+    return runner
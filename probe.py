@@ -0,0 +1,247 @@
+import os
+import re
+import asyncio
+import time
+import logging
+import mimetypes
+from collections import OrderedDict
+from urllib.parse import urlparse, unquote, parse_qs
+import aiohttp
+from http_session import get_session
+from file_cache import normalize_url
+from checksum import digests_from_headers
+
+logger = logging.getLogger(__name__)
+
+# Configuración
+PROBE_CACHE_SIZE = int(os.environ.get('PROBE_CACHE_SIZE', 256))
+PROBE_CACHE_TTL = int(os.environ.get('PROBE_CACHE_TTL', 300))  # segundos
+PROBE_TIMEOUT = float(os.environ.get('PROBE_TIMEOUT', 15))  # segundos
+MANIFEST_ENGINE = os.environ.get('MANIFEST_ENGINE', 'native')  # manifiestos sueltos: 'native' o 'ytdlp'
+
+# Lista de dominios compatibles con yt-dlp
+YTDLP_DOMAINS = [
+    "youtube.com", "youtu.be", "facebook.com", "instagram.com",
+    "twitter.com", "tiktok.com", "twitch.tv", "vimeo.com",
+    "dailymotion.com", "bilibili.com", "nicovideo.jp", "soundcloud.com"
+]
+MANIFEST_EXTENSIONS = ('.m3u8', '.mpd')
+MANIFEST_MIME_TYPES = ('application/vnd.apple.mpegurl', 'application/x-mpegurl', 'audio/mpegurl',
+                       'application/dash+xml')
+# Tipos que indican una página y no un archivo: se intenta con el extractor genérico de yt-dlp
+PAGE_MIME_TYPES = ('text/html', 'application/xhtml+xml')
+
+
+def requires_ytdlp(url):
+    """Determina por dominio si la URL requiere un extractor de yt-dlp"""
+    try:
+        domain = (urlparse(url).hostname or '').lower()
+        return any(domain == d or domain.endswith('.' + d) for d in YTDLP_DOMAINS)
+    except ValueError:
+        return False
+
+
+def is_manifest(url, mime_type=None):
+    """Indica por extensión o tipo MIME si la URL es un manifiesto HLS/DASH"""
+    if mime_type in MANIFEST_MIME_TYPES:
+        return True
+    try:
+        return unquote(urlparse(url).path).lower().endswith(MANIFEST_EXTENSIONS)
+    except ValueError:
+        return False
+
+
+def manifest_filename(name):
+    """Nombre del video resultante de un manifiesto (index.m3u8 -> index.mp4)"""
+    stem, extension = os.path.splitext(name or 'video')
+    return f"{stem}.mp4" if extension.lower() in MANIFEST_EXTENSIONS + ('',) else name
+
+
+def safe_filename(name):
+    """Deja solo el último componente del nombre y quita caracteres problemáticos"""
+    name = os.path.basename(name.replace('\\', '/')).strip()
+    name = re.sub(r'[\x00-\x1f]', '', name)
+    return name if name not in ('', '.', '..') else None
+
+
+def get_filename_from_url(url, mime_type=None):
+    """Extrae el nombre de archivo desde la URL (o lo deduce del tipo MIME)"""
+    try:
+        parsed = urlparse(url)
+        path = unquote(parsed.path)
+
+        if "/" in path:
+            filename = path.split("/")[-1]
+            if "." in filename and len(filename) > 4:
+                return safe_filename(filename)
+
+        query = parse_qs(parsed.query)
+        for key in ["filename", "name", "file"]:
+            if key in query:
+                value = query[key][0]
+                if "." in value:
+                    return safe_filename(value)
+    except Exception as e:
+        logger.error(f"Error extrayendo nombre: {str(e)}")
+
+    # Nombres por defecto
+    extension = mimetypes.guess_extension(mime_type) if mime_type else None
+    if extension:
+        return f"archivo_{int(time.time())}{extension}"
+    if "video" in url:
+        return "video.mp4"
+    elif "audio" in url:
+        return "audio.mp3"
+    elif "image" in url:
+        return "image.jpg"
+
+    return f"archivo_{int(time.time())}.bin"
+
+
+def _empty_info(url):
+    return {
+        'url': url, 'final_url': url, 'status': None, 'error': None,
+        'size': 0, 'ranges': False, 'etag': None, 'last_modified': None,
+        'mime_type': None, 'filename': None, 'engine': 'direct', 'digests': {}
+    }
+
+
+def _read_headers(response, info):
+    """Copia de la respuesta los datos comunes a HEAD y GET con rango"""
+    info['status'] = response.status
+    info['final_url'] = str(response.url)
+    info['etag'] = response.headers.get('ETag')
+    info['last_modified'] = response.headers.get('Last-Modified')
+    info['mime_type'] = response.content_type if 'Content-Type' in response.headers else None
+    disposition = response.content_disposition
+    if disposition and disposition.filename:
+        info['filename'] = safe_filename(disposition.filename)
+    info['digests'] = digests_from_headers(response.headers, partial=response.status == 206)
+
+
+async def _head(session, url, info):
+    """HEAD; devuelve False si el servidor no lo admite o no informa del tamaño"""
+    async with session.head(url, allow_redirects=True, timeout=aiohttp.ClientTimeout(total=PROBE_TIMEOUT)) as response:
+        if response.status >= 400 or response.content_length is None:
+            return False
+        _read_headers(response, info)
+        info['size'] = response.content_length
+        info['ranges'] = response.headers.get('Accept-Ranges', '').lower() == 'bytes' and info['size'] > 0
+        return True
+
+
+async def _confirm_ranges(session, info):
+    """Algunos servidores anuncian Accept-Ranges en HEAD pero responden 200 a un GET con rango"""
+    try:
+        async with session.get(info['final_url'], headers={'Range': 'bytes=0-0'},
+                               timeout=aiohttp.ClientTimeout(total=PROBE_TIMEOUT)) as response:
+            info['ranges'] = response.status == 206
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        # El HEAD ya dio tamaño y nombre: sin confirmación se descarga en un solo flujo
+        logger.warning(f"No se pudo confirmar el soporte de rangos: {str(e)}")
+        info['ranges'] = False
+
+
+async def _ranged_get(session, url, info):
+    """GET del primer byte: confirma el soporte de rangos y da el tamaño en Content-Range"""
+    async with session.get(url, headers={'Range': 'bytes=0-0'},
+                           timeout=aiohttp.ClientTimeout(total=PROBE_TIMEOUT)) as response:
+        _read_headers(response, info)
+        if response.status >= 400:
+            info['error'] = f"HTTP {response.status}"
+            return
+        content_range = response.headers.get('Content-Range', '')
+        if response.status == 206 and '/' in content_range:
+            total = content_range.rsplit('/', 1)[1]
+            if total.isdigit():
+                info['size'] = int(total)
+                info['ranges'] = True
+        elif response.status == 200:
+            info['size'] = response.content_length or 0
+
+
+def _choose_engine(info):
+    if requires_ytdlp(info['final_url']):
+        return 'ytdlp'
+    mime_type = info['mime_type'] or ''
+    if is_manifest(info['final_url'], mime_type):
+        # Los manifiestos sueltos no necesitan extractor: se descargan por segmentos sin yt-dlp
+        return 'manifest' if MANIFEST_ENGINE == 'native' else 'ytdlp'
+    if mime_type in PAGE_MIME_TYPES and not info['filename']:
+        return 'ytdlp'
+    return 'segmented' if info['ranges'] else 'direct'
+
+
+class ProbeCache:
+    """Caché LRU acotada con caducidad para los resultados de probe_url"""
+
+    def __init__(self, max_entries=PROBE_CACHE_SIZE, ttl=PROBE_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # clave -> (instante, info)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry[0] > self.ttl:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return dict(entry[1])
+
+    def put(self, key, info):
+        self.entries[key] = (time.monotonic(), dict(info))
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, url):
+        self.entries.pop(normalize_url(url), None)
+
+
+probe_cache = ProbeCache()
+
+
+async def probe_url(url: str, fresh: bool = False):
+    """Consulta el enlace antes de descargar y decide el motor.
+
+    Devuelve un dict con url final, tamaño, soporte de rangos, validadores, tipo MIME,
+    nombre (Content-Disposition o URL), 'engine' ('direct', 'segmented', 'manifest' o 'ytdlp'),
+    'digests' (hashes anunciados por el servidor) y 'error' si el enlace no es descargable. Los resultados válidos se guardan en una
+    caché LRU con caducidad; fresh=True consulta el servidor aunque haya un resultado en caché.
+    """
+    key = normalize_url(url)
+    cached = None if fresh else probe_cache.get(key)
+    if cached:
+        return cached
+
+    info = _empty_info(url)
+    if requires_ytdlp(url):
+        # yt-dlp hace su propia extracción: no tiene sentido consultar la página
+        info['engine'] = 'ytdlp'
+        info['filename'] = get_filename_from_url(url)
+        probe_cache.put(key, info)
+        return info
+
+    session = get_session()
+    try:
+        if not await _head(session, url, info):
+            await _ranged_get(session, url, info)
+        elif info['ranges']:
+            await _confirm_ranges(session, info)
+    except Exception as e:
+        logger.warning(f"Error consultando {url}: {str(e)}")
+        info['error'] = str(e) or type(e).__name__
+        return info
+
+    if info['error']:
+        return info
+    info['engine'] = _choose_engine(info)
+    if not info['filename']:
+        info['filename'] = get_filename_from_url(info['final_url'], info['mime_type'])
+    if info['engine'] == 'manifest':
+        # Tamaño, rangos y hashes eran los del manifiesto, no los del video
+        info.update(size=0, ranges=False, digests={}, filename=manifest_filename(info['filename']))
+    probe_cache.put(key, info)
+    return info
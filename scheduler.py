@@ -0,0 +1,188 @@
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+logger = logging.getLogger(__name__)
+
+# Configuración
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', 6))
+USER_MAX_ACTIVE = int(os.environ.get('USER_MAX_ACTIVE', 1))
+USER_QUEUE_DEPTH = int(os.environ.get('USER_QUEUE_DEPTH', 5))
+STAGE_LIMITS = {
+    'download': int(os.environ.get('MAX_DOWNLOADS', 4)),
+    'processing': int(os.environ.get('MAX_PROCESSING', 2)),
+    'upload': int(os.environ.get('MAX_UPLOADS', 3)),
+}
+
+
+class QueueFull(Exception):
+    """El usuario alcanzó el máximo de tareas en cola"""
+
+
+class Job:
+    """Tarea en espera dentro del planificador"""
+
+    def __init__(self, task_id, user_id, run, on_queued=None, counted=True, capped=True):
+        self.task_id = task_id
+        self.user_id = user_id
+        self.run = run
+        self.on_queued = on_queued
+        self.counted = counted  # cuenta para USER_QUEUE_DEPTH (no en los elementos de un lote)
+        self.capped = capped  # respeta USER_MAX_ACTIVE (los elementos de un lote usan su propio límite)
+        self.released = False
+        self.enqueued_at = time.time()
+        self.started_at = None
+        self.position = None
+
+    @property
+    def queue_wait(self):
+        return (self.started_at or time.time()) - self.enqueued_at
+
+
+class JobScheduler:
+    """Cola global con reparto round-robin entre usuarios y límites por etapa"""
+
+    def __init__(self, workers=MAX_WORKERS, user_max_active=USER_MAX_ACTIVE,
+                 user_queue_depth=USER_QUEUE_DEPTH, stage_limits=None):
+        self.workers = workers
+        self.user_max_active = user_max_active
+        self.user_queue_depth = user_queue_depth
+        self.queues = OrderedDict()  # user_id -> deque de Job
+        self.running = {}  # user_id -> tareas en ejecución
+        self.last_served = {}  # user_id -> último turno atendido
+        self.turn = 0
+        self.active = 0
+        self.tasks = set()
+        limits = stage_limits or STAGE_LIMITS
+        self.stages = {name: asyncio.Semaphore(limit) for name, limit in limits.items()}
+
+    def stage(self, name):
+        """Semáforo de la etapa (download, processing, upload) para usar con async with"""
+        return self.stages[name]
+
+    def queued_count(self, user_id):
+        return sum(1 for job in self.queues.get(user_id, ()) if job.counted)
+
+    def active_count(self, user_id):
+        return self.running.get(user_id, 0)
+
+    def submit(self, job: Job):
+        """Encola una tarea y devuelve su posición (0 si empieza de inmediato)"""
+        if job.counted and self.queued_count(job.user_id) >= self.user_queue_depth:
+            raise QueueFull()
+        self.queues.setdefault(job.user_id, deque()).append(job)
+        self._dispatch()
+        return job.position or 0
+
+    def _next_job(self):
+        """Toma la siguiente tarea del usuario atendido hace más tiempo"""
+        eligible = [
+            user_id for user_id, queue in self.queues.items()
+            if not queue[0].capped or self.running.get(user_id, 0) < self.user_max_active
+        ]
+        if not eligible:
+            return None
+        user_id = min(eligible, key=lambda uid: self.last_served.get(uid, -1))
+        self.turn += 1
+        self.last_served[user_id] = self.turn
+        queue = self.queues[user_id]
+        job = queue.popleft()
+        if not queue:
+            del self.queues[user_id]
+        return job
+
+    def _dispatch(self):
+        while self.active < self.workers:
+            job = self._next_job()
+            if job is None:
+                break
+            self.active += 1
+            self.running[job.user_id] = self.running.get(job.user_id, 0) + 1
+            job.started_at = time.time()
+            job.position = 0
+            task = asyncio.create_task(self._run(job))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        self._notify_positions()
+
+    async def _run(self, job: Job):
+        try:
+            await job.run()
+        except Exception as e:
+            logger.error(f"[{job.task_id}] Error en tarea: {str(e)}", exc_info=True)
+        finally:
+            if not job.released:
+                self._finish(job)
+
+    def _finish(self, job: Job):
+        job.released = True
+        self.active -= 1
+        self.running[job.user_id] -= 1
+        if not self.running[job.user_id]:
+            del self.running[job.user_id]
+            if job.user_id not in self.queues:
+                self.last_served.pop(job.user_id, None)
+        self._dispatch()
+
+    def release(self, job: Job):
+        """Libera el hueco de una tarea en curso que reparte su trabajo en slot() (un lote)"""
+        if not job.released:
+            self._finish(job)
+
+    @asynccontextmanager
+    async def slot(self, user_id, task_id=None):
+        """Ocupa un hueco con el mismo turno, MAX_WORKERS y etapas que una tarea encolada.
+
+        No cuenta contra USER_MAX_ACTIVE: quien reparte los huecos (un lote) limita los
+        suyos, pero sí ocupa el usuario y retrasa sus demás tareas mientras dura.
+        """
+        started = asyncio.get_running_loop().create_future()
+        done = asyncio.Event()
+
+        async def run():
+            if not started.done():
+                started.set_result(None)
+            await done.wait()
+
+        job = Job(task_id, user_id, run, counted=False, capped=False)
+        self.submit(job)
+        try:
+            await started
+            yield
+        finally:
+            done.set()
+            queue = self.queues.get(user_id)
+            if queue and job in queue:
+                # Cancelado mientras esperaba turno
+                queue.remove(job)
+                if not queue:
+                    del self.queues[user_id]
+                self._notify_positions()
+
+    def _waiting_order(self):
+        """Orden estimado de salida de las tareas en espera (intercalado por usuario)"""
+        users = sorted(self.queues, key=lambda uid: self.last_served.get(uid, -1))
+        queues = [self.queues[user_id] for user_id in users]
+        order = []
+        depth = max((len(q) for q in queues), default=0)
+        for index in range(depth):
+            for queue in queues:
+                if index < len(queue):
+                    order.append(queue[index])
+        return order
+
+    def _notify_positions(self):
+        for position, job in enumerate(self._waiting_order(), start=1):
+            if job.position == position:
+                continue
+            job.position = position
+            if job.on_queued:
+                task = asyncio.create_task(job.on_queued(position))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+
+
+scheduler = JobScheduler()
@@ -1,125 +1,419 @@
 import os
 import asyncio
 import logging
-import subprocess
+import io
 import time
-from pyrogram import Client
+import math
+from pyrogram import Client, raw, types, utils
 from pyrogram.types import Message
+from pyrogram.errors import FloodWait, FilePartMissing, InternalServerError
+from scheduler import scheduler, STAGE_LIMITS
+from status_editor import status_editor
+from metrics import track_stage, record_retry, record_floodwait
+from media_tools import prepare_video
+from bandwidth import throttle
+from checksum import caption_line
 
 logger = logging.getLogger(__name__)
 
-async def split_upload_progress(current, total, progress_msg, task_id, part_index, total_parts):
-    """Callback para mostrar progreso de subida de partes divididas"""
-    current_time = time.time()
-    if not hasattr(split_upload_progress, 'last_update'):
-        split_upload_progress.last_update = {}
-    
-    if task_id not in split_upload_progress.last_update:
-        split_upload_progress.last_update[task_id] = {}
-    
-    # Inicializar para esta parte si es necesario
-    if part_index not in split_upload_progress.last_update[task_id]:
-        split_upload_progress.last_update[task_id][part_index] = 0
-    
-    # Actualizar cada 15 segundos
-    if current_time - split_upload_progress.last_update[task_id][part_index] > 15:
-        split_upload_progress.last_update[task_id][part_index] = current_time
-        percent = current * 100 / total
-        
-        # Calcular tamaño en MB
-        current_mb = current // (1024 * 1024)
-        total_mb = total // (1024 * 1024)
-        
-        message = (
-            f"[{task_id}] ⬆️ Subiendo parte {part_index}/{total_parts}\n"
-            f"📊 {percent:.1f}% - {current_mb}MB/{total_mb}MB"
+# Configuración
+VOLUME_SIZE = 1990 * 1024 * 1024  # 1990 MB
+PIPELINE_VOLUMES_ON_DISK = 2
+PART_UPLOAD_CONCURRENCY = int(os.environ.get('PART_UPLOAD_CONCURRENCY', 3))
+UPLOAD_RETRIES = int(os.environ.get('UPLOAD_RETRIES', 5))
+# Subidas simultáneas del cliente (max_concurrent_transmissions); pyrogram usa 1 por defecto
+# y serializaría todas las partes aunque se lancen en paralelo
+UPLOAD_TRANSMISSIONS = int(os.environ.get('UPLOAD_TRANSMISSIONS', PART_UPLOAD_CONCURRENCY * STAGE_LIMITS['upload']))
+
+def volume_name(base_name: str, index: int):
+    """Nombre del volumen N (base.001, base.002, ...), unible con cat o 7-Zip"""
+    return f"{base_name}.{index:03d}"
+
+class FileRangeView(io.RawIOBase):
+    """Vista de solo lectura sobre un tramo [offset, offset+length) de un archivo.
+
+    Se comporta como un archivo independiente (seek/tell/read limitados al tramo),
+    así cada volumen se sube directamente desde el original sin copias intermedias.
+    """
+
+    def __init__(self, path: str, offset: int, length: int, name: str):
+        super().__init__()
+        self._fp = open(path, 'rb')
+        self.offset = offset
+        self.length = length
+        self.name = name
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            pos += self._pos
+        elif whence == io.SEEK_END:
+            pos += self.length
+        self._pos = max(0, min(pos, self.length))
+        return self._pos
+
+    def readinto(self, buffer):
+        size = min(len(buffer), self.length - self._pos)
+        if size <= 0:
+            return 0
+        data = os.pread(self._fp.fileno(), size, self.offset + self._pos)
+        buffer[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self._fp.close()
+        super().close()
+
+def split_file_views(file_path: str, volume_size: int = None):
+    """Devuelve una vista por volumen del archivo, nombradas base.001, base.002, ..."""
+    volume_size = volume_size or VOLUME_SIZE
+    base_name = os.path.basename(file_path)
+    total_size = os.path.getsize(file_path)
+    return [
+        FileRangeView(file_path, offset, min(volume_size, total_size - offset), volume_name(base_name, i + 1))
+        for i, offset in enumerate(range(0, total_size, volume_size))
+    ]
+
+class UploadProgress:
+    """Progreso combinado de todas las partes de una tarea en una sola línea de estado"""
+
+    def __init__(self, progress_msg: Message, task_id: str, sizes):
+        self.progress_msg = progress_msg
+        self.task_id = task_id
+        self.sizes = list(sizes)
+        self.current = [0] * len(self.sizes)
+        self.sent = 0
+        self.start_time = time.time()
+
+    def part_callback(self, index: int):
+        """Callback de progreso de pyrogram para la parte index"""
+        async def callback(current, total):
+            # pyrogram espera a este callback entre bloques: aquí se aplica el límite de subida
+            sent = current - self.current[index]
+            self.current[index] = current
+            await self.update()
+            await throttle('up', sent)
+        return callback
+
+    async def mark_sent(self, index: int):
+        self.current[index] = self.sizes[index]
+        self.sent += 1
+        await self.update()
+
+    async def update(self):
+        status_editor.push(self.progress_msg, self.render)
+
+    def render(self):
+        now = time.time()
+        total = sum(self.sizes)
+        current = sum(self.current)
+        in_flight = sum(1 for c, size in zip(self.current, self.sizes) if 0 < c < size)
+        elapsed = now - self.start_time
+        speed_mb = current / elapsed / (1024 * 1024) if elapsed > 0 else 0
+        percent = current * 100 / total if total else 0
+
+        return (
+            f"[{self.task_id}] ⬆️ Subiendo {len(self.sizes)} partes "
+            f"({in_flight} en curso, {self.sent} enviadas)\n"
+            f"📊 {percent:.1f}% - {current // (1024 * 1024)}MB/{total // (1024 * 1024)}MB "
+            f"- {speed_mb:.1f} MB/s"
         )
+
+async def with_upload_retries(action, task_id: str, label: str, retry_network: bool = True):
+    """Ejecuta una operación de subida reintentando ante FloodWait y errores de red.
+
+    Solo save_file (subir las partes de un archivo) es seguro de repetir tras un error de
+    red; el envío del mensaje se pasa con retry_network=False, porque un timeout después
+    de que Telegram lo aceptara publicaría el volumen dos veces. FloodWait sí se
+    reintenta siempre: Telegram rechazó la petición sin procesarla.
+    """
+    attempt = 0
+    while True:
         try:
-            await progress_msg.edit(message)
-        except Exception as e:
-            logger.error(f"Error actualizando progreso: {str(e)}")
+            result = await action()
+            if result is None:
+                # save_file registra el error y devuelve None en lugar de lanzarlo
+                raise ConnectionError("la subida no devolvió resultado")
+            return result
+        except FloodWait as e:
+            logger.warning(f"[{task_id}] FloodWait en {label}: esperando {e.value} segundos")
+            record_floodwait(e.value)
+            await asyncio.sleep(e.value)
+        except (OSError, asyncio.TimeoutError, InternalServerError) as e:
+            if not retry_network or attempt >= UPLOAD_RETRIES:
+                raise
+            attempt += 1
+            record_retry('upload')
+            delay = min(2 ** attempt, 60)
+            logger.warning(
+                f"[{task_id}] Error en {label} ({str(e)}), "
+                f"reintento {attempt}/{UPLOAD_RETRIES} en {delay}s"
+            )
+            await asyncio.sleep(delay)
+
+def sent_item(result):
+    """Resume un mensaje enviado como elemento reenviable por file_id (None si no hay file_id)"""
+    media = getattr(result, 'video', None) or getattr(result, 'document', None)
+    if not getattr(media, 'file_id', None):
+        # Telegram no devolvió el mensaje publicado: no se puede reenviar desde la caché
+        return None
+    return {
+        'type': 'video' if getattr(result, 'video', None) else 'document',
+        'file_id': media.file_id,
+        'caption': getattr(result, 'caption', None)
+    }
 
-async def split_and_upload(client: Client, message: Message, progress_msg: Message, file_path: str, task_id: str):
-    """Divide archivos grandes usando 7z (sin compresión) y sube a Telegram"""
+async def send_uploaded_document(client: Client, chat_id, file, part, caption: str = "", thumb=None,
+                                 video=None, disable_notification: bool = True):
+    """Publica en el chat un documento ya subido con save_file.
+
+    part es el FileRangeView o la ruta subida (se vuelve a leer si Telegram pide una
+    parte que falta); con video (dict con duration, width, height y supports_streaming)
+    se publica como video reproducible, con thumb como miniatura ya subida. Devuelve el
+    mensaje publicado, o True si la respuesta de Telegram no lo incluye.
+    """
+    name = part.name if isinstance(part, FileRangeView) else os.path.basename(part)
+    text = await utils.parse_text_entities(client, caption, None, None) if caption else {'message': ""}
+    attributes = [raw.types.DocumentAttributeFilename(file_name=name)]
+    if video is not None:
+        attributes.insert(0, raw.types.DocumentAttributeVideo(
+            supports_streaming=video.get('supports_streaming') or None,
+            duration=int(video.get('duration') or 0),
+            w=video.get('width') or 0,
+            h=video.get('height') or 0
+        ))
+    media = raw.types.InputMediaUploadedDocument(
+        mime_type=client.guess_mime_type(name) or ("video/mp4" if video is not None else "application/zip"),
+        file=file,
+        thumb=thumb,
+        attributes=attributes
+    )
+    while True:
+        try:
+            r = await client.invoke(
+                raw.functions.messages.SendMedia(
+                    peer=await client.resolve_peer(chat_id),
+                    media=media,
+                    silent=disable_notification or None,
+                    random_id=client.rnd_id(),
+                    **text
+                )
+            )
+        except FilePartMissing as e:
+            await client.save_file(part, file_id=file.id, file_part=e.value)
+        else:
+            for update in r.updates:
+                if isinstance(update, (raw.types.UpdateNewMessage, raw.types.UpdateNewChannelMessage)):
+                    return await types.Message._parse(
+                        client, update.message,
+                        {u.id: u for u in r.users},
+                        {c.id: c for c in r.chats}
+                    )
+            return True
+
+async def split_and_upload(client: Client, message: Message, progress_msg: Message, file_path: str, task_id: str,
+                           volume_hashes=None):
+    """Divide archivos grandes en volúmenes .001, .002, ... sin copiarlos y sube a Telegram.
+
+    Las partes se suben en paralelo (hasta PART_UPLOAD_CONCURRENCY) y se publican en orden.
+    volume_hashes(i), opcional, da el SHA-256 del volumen i para su descripción.
+    Devuelve la lista de documentos enviados ({'type', 'file_id', 'caption'}) o None si falla.
+    """
+    views = []
+    uploads = []
+    sent = []
     try:
-        # Crear directorio temporal
-        split_dir = "/tmp/split_files"
-        os.makedirs(split_dir, exist_ok=True)
-        
-        # Limpiar directorio
-        for f in os.listdir(split_dir):
-            file_path_to_remove = os.path.join(split_dir, f)
-            if os.path.isfile(file_path_to_remove):
-                os.remove(file_path_to_remove)
-        
-        # Nombre base para archivos divididos
         base_name = os.path.basename(file_path)
-        archive_path = os.path.join(split_dir, f"{base_name}.7z")
-        
-        # Crear archivo 7z sin compresión (modo almacenamiento)
-        await progress_msg.edit(f"[{task_id}] 🔪 Dividiendo archivo con 7z (sin compresión)...")
-        
-        # Usar binario 7z directamente
-        cmd = [
-            "7z",
-            "a",
-            f"-v{1990}m",  # Volúmenes de 1990MB
-            "-mx0",        # Sin compresión
-            archive_path,
-            file_path
-        ]
-        
-        logger.info(f"Ejecutando comando: {' '.join(cmd)}")
-        result = subprocess.run(cmd, capture_output=True, text=True)
+        with track_stage('split'):
+            views = split_file_views(file_path)
+        progress = UploadProgress(progress_msg, task_id, [part.length for part in views])
+        limit = asyncio.Semaphore(PART_UPLOAD_CONCURRENCY)
         
-        if result.returncode != 0:
-            logger.error(f"Error al dividir: {result.stderr}")
-            await progress_msg.edit(f"[{task_id}] ❌ Error al dividir el archivo")
-            return
+        status_editor.push(progress_msg, f"[{task_id}] 📦 Dividido en {len(views)} partes. Subiendo...")
         
-        # Obtener partes generadas
-        parts = sorted([f for f in os.listdir(split_dir) if f.startswith(f"{base_name}.7z.")])
-        
-        if not parts:
-            # Si no se generaron partes, usar el archivo único
-            if os.path.exists(archive_path):
-                parts = [os.path.basename(archive_path)]
-        
-        if not parts:
-            await progress_msg.edit(f"[{task_id}] ❌ No se generaron partes")
-            return
-        
-        await progress_msg.edit(f"[{task_id}] 📦 Dividido en {len(parts)} partes. Subiendo...")
-        
-        # Subir cada parte
-        for i, part in enumerate(parts):
-            part_path = os.path.join(split_dir, part)
-            
-            # Crear callback de progreso para esta parte
-            async def progress_callback(current, total):
-                await split_upload_progress(
-                    current, total, 
-                    progress_msg, task_id, 
-                    i+1, len(parts)
+        async def upload_part(i, part):
+            async with limit:
+                return await with_upload_retries(
+                    lambda: client.save_file(part, progress=progress.part_callback(i)),
+                    task_id, f"subida de {part.name}"
                 )
-            
-            await progress_msg.edit(f"[{task_id}] ⬆️ Subiendo parte {i+1}/{len(parts)} ({part})...")
-            
-            await client.send_document(
-                chat_id=message.chat.id,
-                document=part_path,
-                disable_notification=True,
-                progress=progress_callback
-            )
-            
-            os.remove(part_path)
         
-        await progress_msg.edit(f"[{task_id}] ✅ Todos los fragmentos subidos correctamente")
+        async with scheduler.stage('upload'):
+            with track_stage('upload') as stage:
+                uploads = [asyncio.create_task(upload_part(i, part)) for i, part in enumerate(views)]
+                
+                # Publicar en orden a medida que terminan las subidas
+                for i, part in enumerate(views):
+                    file = await uploads[i]
+                    sha256 = volume_hashes(i) if volume_hashes else None
+                    caption = caption_line(sha256) if sha256 else ""
+                    result = await with_upload_retries(
+                        lambda: send_uploaded_document(client, message.chat.id, file, part, caption),
+                        task_id, f"envío de {part.name}", retry_network=False
+                    )
+                    sent.append(sent_item(result))
+                    await progress.mark_sent(i)
+                stage.bytes = sum(progress.sizes)
+        
+        logger.info(f"[{task_id}] {base_name} subido en {len(views)} partes")
+        status_editor.push(progress_msg, f"[{task_id}] ✅ Todos los fragmentos subidos correctamente")
+        return sent
     
     except Exception as e:
         logger.error(f"Error en split_and_upload: {str(e)}", exc_info=True)
-        await progress_msg.edit(f"[{task_id}] ❌ Error: {str(e)}")
+        status_editor.push(progress_msg, f"[{task_id}] ❌ Error: {str(e)}")
+        return None
     finally:
+        for upload in uploads:
+            upload.cancel()
+        await asyncio.gather(*uploads, return_exceptions=True)
+        for part in views:
+            part.close()
         # Limpiar archivo original
         if os.path.exists(file_path):
             os.remove(file_path)
+
+async def upload_video_parts(client: Client, message: Message, progress_msg: Message, parts, base_name: str,
+                             task_id: str, sha256: str = None):
+    """Envía en orden las partes de un video dividido por tiempo, cada una como video reproducible.
+
+    Cada parte lleva su propia duración, resolución y miniatura; sha256 es el hash del video
+    original. Las partes se borran en cuanto se envían. Devuelve la lista de videos enviados
+    o None si falla.
+    """
+    sent = []
+    progress = UploadProgress(progress_msg, task_id, [os.path.getsize(part) for part in parts])
+    status_editor.push(progress_msg, f"[{task_id}] 🎬 Dividido en {len(parts)} partes reproducibles. Subiendo...")
+    try:
+        async with scheduler.stage('upload'):
+            with track_stage('upload') as stage:
+                for i, part in enumerate(parts):
+                    metadata = await prepare_video(part, f"{task_id}_{i + 1}")
+                    thumb = metadata['thumb'] if metadata else None
+                    caption = f"📹 {base_name} (parte {i + 1}/{len(parts)})"
+                    if sha256:
+                        caption += "\n" + caption_line(sha256, "SHA-256 del original")
+                    file = await with_upload_retries(
+                        lambda: client.save_file(part, progress=progress.part_callback(i)),
+                        task_id, f"subida de la parte {i + 1}"
+                    )
+                    thumb_file = await with_upload_retries(
+                        lambda: client.save_file(thumb), task_id, f"subida de la miniatura {i + 1}"
+                    ) if thumb else None
+                    result = await with_upload_retries(
+                        lambda: send_uploaded_document(
+                            client, message.chat.id, file, part, caption, thumb=thumb_file,
+                            video=metadata or {}, disable_notification=i > 0
+                        ),
+                        task_id, f"envío de la parte {i + 1}", retry_network=False
+                    )
+                    sent.append(sent_item(result))
+                    await progress.mark_sent(i)
+                    for path in (part, thumb):
+                        if path and os.path.exists(path):
+                            os.remove(path)
+                stage.bytes = sum(progress.sizes)
+        
+        logger.info(f"[{task_id}] {base_name} subido en {len(parts)} partes de video")
+        status_editor.push(progress_msg, f"[{task_id}] ✅ Todas las partes del video subidas correctamente")
+        return sent
+    except Exception as e:
+        logger.error(f"Error en upload_video_parts: {str(e)}", exc_info=True)
+        status_editor.push(progress_msg, f"[{task_id}] ❌ Error: {str(e)}")
+        return None
+
+async def pipelined_split_upload(client: Client, message: Message, progress_msg: Message, download_dir: str,
+                                 base_name: str, total_size: int, task_id: str, fetch_volume, volume_hashes=None):
+    """Descarga el archivo por volúmenes y sube cada uno en cuanto termina.
+
+    fetch_volume(offset, length, path) descarga un tramo del archivo remoto y devuelve
+    True si tuvo éxito; volume_hashes(i), opcional, da el SHA-256 del volumen i. Como máximo hay PIPELINE_VOLUMES_ON_DISK volúmenes en disco:
+    mientras se sube uno se descarga el siguiente. Devuelve la lista de documentos
+    enviados o None si falla.
+    """
+    total_parts = math.ceil(total_size / VOLUME_SIZE)
+    slots = asyncio.Semaphore(PIPELINE_VOLUMES_ON_DISK)
+    ready = asyncio.Queue()
+    paths = [os.path.join(download_dir, volume_name(base_name, i + 1)) for i in range(total_parts)]
+    progress = UploadProgress(
+        progress_msg, task_id,
+        [min(VOLUME_SIZE, total_size - i * VOLUME_SIZE) for i in range(total_parts)]
+    )
+
+    async def producer():
+        try:
+            for i, part_path in enumerate(paths):
+                await slots.acquire()
+                offset = i * VOLUME_SIZE
+                length = min(VOLUME_SIZE, total_size - offset)
+                if not await fetch_volume(offset, length, part_path):
+                    await ready.put(None)
+                    return
+                await ready.put(i)
+        except BaseException:
+            # Sin esto el consumidor esperaría para siempre el siguiente volumen
+            ready.put_nowait(None)
+            raise
+
+    async def consumer():
+        sent = []
+        for _ in range(total_parts):
+            i = await ready.get()
+            if i is None:
+                return None
+
+            sha256 = volume_hashes(i) if volume_hashes else None
+            async with scheduler.stage('upload'):
+                with track_stage('upload') as stage:
+                    file = await with_upload_retries(
+                        lambda: client.save_file(paths[i], progress=progress.part_callback(i)),
+                        task_id, f"subida de la parte {i + 1}"
+                    )
+                    result = await with_upload_retries(
+                        lambda: send_uploaded_document(
+                            client, message.chat.id, file, paths[i], caption_line(sha256) if sha256 else ""
+                        ),
+                        task_id, f"envío de la parte {i + 1}", retry_network=False
+                    )
+                    stage.bytes = progress.sizes[i]
+            sent.append(sent_item(result))
+            await progress.mark_sent(i)
+            os.remove(paths[i])
+            slots.release()
+        return sent
+
+    status_editor.push(
+        progress_msg,
+        f"[{task_id}] 📦 Archivo grande: se descargará y subirá en {total_parts} partes..."
+    )
+    producer_task = asyncio.create_task(producer())
+    try:
+        uploaded = await consumer()
+        await producer_task
+    except BaseException:
+        producer_task.cancel()
+        await asyncio.gather(producer_task, return_exceptions=True)
+        raise
+    finally:
+        # Eliminar volúmenes pendientes (y sus journals de descarga)
+        for part_path in paths:
+            for path in (part_path, part_path + ".journal"):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    if uploaded is not None:
+        status_editor.push(progress_msg, f"[{task_id}] ✅ Todos los fragmentos subidos correctamente")
+    else:
+        status_editor.push(progress_msg, f"[{task_id}] ❌ Error al descargar el contenido")
+    return uploaded
@@ -0,0 +1,196 @@
+import os
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from pyrogram.types import Message
+from pyrogram.errors import FloodWait, MessageNotModified
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Configuración
+EDIT_CHAT_INTERVAL = float(os.environ.get('EDIT_CHAT_INTERVAL', 5))  # segundos entre ediciones por chat
+EDIT_CHAT_BURST = int(os.environ.get('EDIT_CHAT_BURST', 2))
+EDIT_GLOBAL_RATE = float(os.environ.get('EDIT_GLOBAL_RATE', 20))  # ediciones por segundo en todo el bot
+EDIT_FLUSH_TIMEOUT = 10  # segundos para vaciar la cola al apagar
+
+
+class TokenBucket:
+    """Cubeta de tokens: rate tokens por segundo con capacidad burst"""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        """Segundos hasta que haya un token disponible (0 si ya lo hay)"""
+        self._refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+    @property
+    def full(self):
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+class LocalStatus:
+    """Estado que no se muestra en su propio mensaje de Telegram.
+
+    push() solo guarda el último texto; lo usa, por ejemplo, cada elemento de un lote,
+    cuyo progreso se resume en un único mensaje.
+    """
+
+    def __init__(self):
+        self._text = None
+        self.current = 0
+        self.total = 0
+
+    def set_text(self, text):
+        self._text = text
+
+    def set_progress(self, current, total, status):
+        self.current = current
+        self.total = total
+
+    @property
+    def text(self):
+        return self._text() if callable(self._text) else self._text
+
+
+class StatusEditor:
+    """Servicio en segundo plano que aplica las ediciones de mensajes de estado.
+
+    Las transferencias llaman a push() sin esperar: solo se guarda el último texto de
+    cada mensaje y un bucle aparte lo edita respetando una cubeta de tokens por chat y
+    otra global. Un FloodWait pausa el bucle, nunca la descarga o la subida.
+    """
+
+    def __init__(self, chat_interval=EDIT_CHAT_INTERVAL, chat_burst=EDIT_CHAT_BURST,
+                 global_rate=EDIT_GLOBAL_RATE):
+        self.chat_interval = chat_interval
+        self.chat_burst = chat_burst
+        self.pending = OrderedDict()  # (chat_id, message_id) -> (Message, texto)
+        self.chat_buckets = {}
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.blocked_until = 0
+        self.wakeup = None
+        self.task = None
+
+    def push(self, message: Message, text):
+        """Programa la edición de message con text, sustituyendo cualquier texto pendiente.
+
+        text puede ser una función sin argumentos: se evalúa solo al editar, así el
+        progreso no se formatea en cada bloque transferido.
+        """
+        if isinstance(message, LocalStatus):
+            message.set_text(text)
+            return
+        self.pending[(message.chat.id, message.id)] = (message, text)
+        self._ensure_running()
+        self.wakeup.set()
+
+    def _ensure_running(self):
+        if self.task is None or self.task.done():
+            self.wakeup = asyncio.Event()
+            self.task = asyncio.get_running_loop().create_task(self._run())
+
+    def _chat_bucket(self, chat_id):
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = TokenBucket(1 / self.chat_interval, self.chat_burst)
+        return bucket
+
+    def _next_ready(self):
+        """Primer mensaje pendiente cuyo chat tiene token, o el tiempo de espera hasta que lo haya"""
+        wait = None
+        for key in self.pending:
+            delay = self._chat_bucket(key[0]).delay()
+            if delay == 0:
+                return key, 0
+            wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    def _prune(self):
+        # Liberar cubetas de chats sin ediciones pendientes y ya recargadas
+        active_chats = {chat_id for chat_id, _ in self.pending}
+        for chat_id in [c for c, b in self.chat_buckets.items() if c not in active_chats and b.full]:
+            del self.chat_buckets[chat_id]
+
+    async def _sleep(self, seconds):
+        """Espera hasta seconds o hasta que llegue una edición nueva"""
+        self.wakeup.clear()
+        try:
+            await asyncio.wait_for(self.wakeup.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _run(self):
+        while True:
+            self._prune()
+            if not self.pending:
+                await self._sleep(None)
+                continue
+
+            blocked = self.blocked_until - time.monotonic()
+            if blocked > 0:
+                await asyncio.sleep(blocked)
+                continue
+
+            key, wait = self._next_ready()
+            if key is None:
+                await self._sleep(wait)
+                continue
+
+            global_wait = self.global_bucket.delay()
+            if global_wait:
+                await asyncio.sleep(global_wait)
+                continue
+
+            message, text = self.pending.pop(key)
+            self._chat_bucket(key[0]).take()
+            self.global_bucket.take()
+            try:
+                await message.edit(text() if callable(text) else text)
+            except FloodWait as e:
+                logger.warning(f"FloodWait: pausando ediciones {e.value} segundos")
+                self.blocked_until = time.monotonic() + e.value
+                # Solo en el contador global: el editor no pertenece a ninguna tarea
+                metrics.floodwait_seconds.inc(e.value)
+                # Reintentar después salvo que ya haya un texto más reciente
+                if key not in self.pending:
+                    self.pending[key] = (message, text)
+                    self.pending.move_to_end(key, last=False)
+            except MessageNotModified:
+                pass
+            except Exception as e:
+                logger.error(f"Error editando mensaje: {str(e)}")
+
+    async def stop(self):
+        """Intenta aplicar las ediciones pendientes y detiene el servicio"""
+        if self.task is None:
+            return
+        deadline = time.monotonic() + EDIT_FLUSH_TIMEOUT
+        while self.pending and time.monotonic() < deadline and not self.task.done():
+            await asyncio.sleep(0.1)
+        self.task.cancel()
+        await asyncio.gather(self.task, return_exceptions=True)
+        self.task = None
+        self.pending.clear()
+        self.chat_buckets.clear()
+
+
+status_editor = StatusEditor()
@@ -0,0 +1,286 @@
+import os
+import time
+import shutil
+import asyncio
+import hashlib
+import uuid
+import logging
+from collections import deque
+from downloader import JOURNAL_SUFFIX
+from file_cache import normalize_url
+
+logger = logging.getLogger(__name__)
+
+# Configuración
+STORAGE_DIR = os.environ.get('DOWNLOAD_DIR', '/tmp/downloads')
+STORAGE_LIMIT = int(os.environ.get('STORAGE_LIMIT', 0))  # bytes; 0 = espacio libre al arrancar
+STORAGE_MIN_FREE = int(os.environ.get('STORAGE_MIN_FREE', 512 * 1024 * 1024))  # bytes que nunca se reservan
+STORAGE_HEADROOM = float(os.environ.get('STORAGE_HEADROOM', 0.1))  # margen sobre el tamaño esperado
+STORAGE_UNKNOWN_SIZE = int(os.environ.get('STORAGE_UNKNOWN_SIZE', 2 * 1024 * 1024 * 1024))  # sin tamaño previo
+PARTIAL_MAX_AGE = int(os.environ.get('PARTIAL_MAX_AGE', 24 * 3600))  # segundos
+PARTIAL_SUFFIXES = (JOURNAL_SUFFIX, '.part')  # diario de segmentos y .part de yt-dlp interrumpido
+
+
+class Workspace:
+    """Directorio propio de una tarea con su reserva de disco"""
+
+    def __init__(self, key, path, reserved):
+        self.key = key
+        self.path = path
+        self.reserved = reserved
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def has_partials(self):
+        """Indica si quedan descargas parciales reanudables en el directorio"""
+        try:
+            return any(name.endswith(PARTIAL_SUFFIXES) for name in os.listdir(self.path))
+        except OSError:
+            return False
+
+
+def _dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+class StorageManager:
+    """Reparte el disco entre tareas: cada una tiene su directorio y reserva su tamaño antes de descargar.
+
+    Las reservas se conceden por orden de llegada; una tarea que no cabe espera (sin
+    adelantar a las demás) hasta que otras liberen espacio. Los directorios con descargas
+    parciales reanudables siguen ocupando disco, así que conservan una reserva de su
+    tamaño hasta que la tarea se reanuda, caducan a los PARTIAL_MAX_AGE segundos o hace
+    falta su espacio para otra tarea (se borran primero las más antiguas).
+    """
+
+    def __init__(self, base_dir=STORAGE_DIR, limit=STORAGE_LIMIT):
+        self.base_dir = base_dir
+        self.limit = limit
+        self.budget = None
+        self.reserved = 0
+        self.active = {}  # clave -> Workspace
+        self.retained = {}  # clave -> bytes de descargas parciales conservadas
+        self.waiters = deque()  # (bytes, future)
+        self.growing = set()  # futures de las ampliaciones en espera
+        self.max_age = PARTIAL_MAX_AGE
+
+    def start(self, max_age=PARTIAL_MAX_AGE):
+        """Elimina directorios huérfanos de ejecuciones anteriores y calcula el presupuesto de disco"""
+        os.makedirs(self.base_dir, exist_ok=True)
+        self.max_age = max_age
+        now = time.time()
+        kept = 0
+        retained = {}
+        for name in os.listdir(self.base_dir):
+            path = os.path.join(self.base_dir, name)
+            try:
+                if os.path.isdir(path):
+                    workspace = Workspace(name, path, 0)
+                    if workspace.has_partials() and now - os.path.getmtime(path) < max_age:
+                        # Descarga reanudable: se conserva hasta que el usuario reenvíe el enlace
+                        retained[name] = _dir_size(path)
+                        kept += retained[name]
+                        continue
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+                logger.info(f"Espacio de trabajo huérfano eliminado: {path}")
+            except OSError as e:
+                logger.error(f"Error eliminando {path}: {str(e)}")
+        self._compute_budget(kept)
+        self.retained = retained
+        self.reserved += kept
+
+    def _compute_budget(self, kept=0):
+        if self.limit:
+            self.budget = self.limit
+        else:
+            os.makedirs(self.base_dir, exist_ok=True)
+            self.budget = max(0, shutil.disk_usage(self.base_dir).free + kept - STORAGE_MIN_FREE)
+        logger.info(f"Presupuesto de disco para descargas: {self.budget / (1024 * 1024):.0f} MB")
+
+    @staticmethod
+    def workspace_key(user_id, url, filename):
+        """Clave estable por usuario, enlace y nombre: reenviar el enlace reanuda en el mismo directorio"""
+        raw = f"{user_id}|{normalize_url(url)}|{filename}"
+        return hashlib.sha1(raw.encode()).hexdigest()[:16]
+
+    @staticmethod
+    def reservation_for(expected_size):
+        """Bytes a reservar para un tamaño esperado (0 si se desconoce)"""
+        if not expected_size:
+            return STORAGE_UNKNOWN_SIZE
+        return int(expected_size * (1 + STORAGE_HEADROOM))
+
+    def split_budget(self, parts):
+        """Reparte el presupuesto entre parts procesos de trabajo; devuelve (y adopta) la parte de cada uno"""
+        if self.budget is None:
+            self._compute_budget()
+        self.budget //= max(parts, 1)
+        return self.budget
+
+    def fits(self, nbytes):
+        """Indica si la reserva podría concederse alguna vez"""
+        if self.budget is None:
+            self._compute_budget()
+        return nbytes <= self.budget
+
+    def _available(self):
+        return self.budget - self.reserved
+
+    def _make_room(self, nbytes):
+        """Borra descargas parciales conservadas, de la más antigua a la más reciente, hasta que quepa nbytes"""
+        def age(key):
+            try:
+                return os.path.getmtime(os.path.join(self.base_dir, key))
+            except OSError:
+                return 0
+        for key in sorted(self.retained, key=age):
+            if nbytes <= self._available():
+                break
+            path = os.path.join(self.base_dir, key)
+            shutil.rmtree(path, ignore_errors=True)
+            self._drop_retained(key)
+            logger.info(f"Descarga parcial eliminada para hacer sitio: {path}")
+
+    def _grant_waiters(self):
+        if self.waiters and self.retained:
+            self._make_room(self.waiters[0][0])
+        while self.waiters and self.waiters[0][0] <= self._available():
+            nbytes, future = self.waiters.popleft()
+            if not future.done():
+                self.reserved += nbytes
+                future.set_result(None)
+
+    def _retain(self, key, nbytes):
+        self.retained[key] = nbytes
+        self.reserved += nbytes
+
+    def _drop_retained(self, key):
+        self.reserved -= self.retained.pop(key, 0)
+
+    def expire_partials(self, now=None):
+        """Borra las descargas parciales conservadas más de max_age segundos y libera su reserva"""
+        now = now or time.time()
+        for key in list(self.retained):
+            path = os.path.join(self.base_dir, key)
+            try:
+                expired = now - os.path.getmtime(path) >= self.max_age
+            except OSError:
+                expired = True  # ya no existe
+            if expired:
+                shutil.rmtree(path, ignore_errors=True)
+                self._drop_retained(key)
+                logger.info(f"Descarga parcial caducada eliminada: {path}")
+        self._grant_waiters()
+
+    async def acquire(self, key, nbytes, on_wait=None):
+        """Reserva nbytes y crea el directorio de la tarea; espera en cola si no hay espacio"""
+        if self.budget is None:
+            self._compute_budget()
+        if key not in self.active:
+            # Al reanudar, la reserva de la tarea sustituye a la de sus datos parciales
+            self._drop_retained(key)
+        self.expire_partials()
+        nbytes = min(nbytes, self.budget)
+        if not self.waiters:
+            self._make_room(nbytes)
+        if not self.waiters and nbytes <= self._available():
+            self.reserved += nbytes
+        else:
+            await self._wait(nbytes, on_wait)
+
+        if key in self.active:
+            # Misma clave ya en uso (el mismo enlace enviado dos veces a la vez)
+            key = f"{key}-{uuid.uuid4().hex[:6]}"
+        path = os.path.join(self.base_dir, key)
+        os.makedirs(path, exist_ok=True)
+        workspace = Workspace(key, path, nbytes)
+        self.active[key] = workspace
+        return workspace
+
+    async def _wait(self, nbytes, on_wait=None, grow=False):
+        """Espera en cola a que se concedan nbytes; las ampliaciones pasan delante de las tareas nuevas"""
+        future = asyncio.get_running_loop().create_future()
+        if grow:
+            self.waiters.insert(sum(1 for _, f in self.waiters if f in self.growing), (nbytes, future))
+            self.growing.add(future)
+        else:
+            self.waiters.append((nbytes, future))
+        try:
+            if on_wait:
+                await on_wait()
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.reserved -= nbytes
+                self._grant_waiters()
+            else:
+                self.waiters = deque(w for w in self.waiters if w[1] is not future)
+            raise
+        finally:
+            self.growing.discard(future)
+
+    def resize(self, workspace, nbytes):
+        """Ajusta la reserva cuando se conoce el tamaño real (solo se permite reducirla)"""
+        if nbytes < workspace.reserved:
+            self.reserved -= workspace.reserved - nbytes
+            workspace.reserved = nbytes
+            self._grant_waiters()
+
+    async def grow(self, workspace, nbytes, on_wait=None):
+        """Amplía la reserva a nbytes, esperando si hace falta a que otras tareas liberen espacio.
+
+        Devuelve False si no cabría nunca o si todas las demás tareas activas esperan también
+        para ampliar (ninguna liberaría espacio); la tarea sigue entonces con su reserva actual.
+        """
+        extra = nbytes - workspace.reserved
+        if extra <= 0:
+            return True
+        if not self.fits(nbytes):
+            return False
+        self._make_room(extra)
+        if extra <= self._available():
+            self.reserved += extra
+        elif len(self.growing) >= len(self.active) - 1:
+            return False
+        else:
+            await self._wait(extra, on_wait, grow=True)
+        workspace.reserved = nbytes
+        return True
+
+    def release(self, workspace):
+        """Libera la reserva y borra el directorio salvo que tenga descargas parciales reanudables.
+
+        En ese caso el directorio conserva una reserva igual a lo que ocupa en disco.
+        """
+        if self.active.get(workspace.key) is not workspace:
+            return
+        del self.active[workspace.key]
+        self.reserved -= workspace.reserved
+        workspace.reserved = 0
+        if workspace.has_partials():
+            self._retain(workspace.key, _dir_size(workspace.path))
+        else:
+            shutil.rmtree(workspace.path, ignore_errors=True)
+        self._grant_waiters()
+
+    def stats(self):
+        return {
+            'budget': self.budget or 0,
+            'reserved': self.reserved,
+            'active': len(self.active),
+            'retained': len(self.retained),
+            'waiting': len(self.waiters)
+        }
+
+
+storage = StorageManager()
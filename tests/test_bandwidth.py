@@ -0,0 +1,98 @@
+import time
+import asyncio
+import bandwidth
+from bandwidth import FairLimiter, BandwidthManager, Flow
+
+CHUNK = 16 * 1024
+
+
+def test_limiter_enforces_the_rate():
+    async def main():
+        limiter = FairLimiter(1024 * 1024)
+        flow = Flow(1, 'down')
+        start = time.monotonic()
+        # La ráfaga inicial empieza vacía: 1 MB a 1 MB/s tarda ~1 s
+        for _ in range(64):
+            await limiter.acquire(flow, CHUNK)
+        elapsed = time.monotonic() - start
+        await limiter.stop()
+        return elapsed
+
+    assert 0.8 < asyncio.run(main()) < 1.5
+
+
+def test_weighted_flows_share_the_rate():
+    async def main():
+        limiter = FairLimiter(2 * 1024 * 1024)
+        small, big = Flow(1, 'down', weight=4), Flow(2, 'down', weight=1)
+        received = {small: 0, big: 0}
+
+        async def transfer(flow):
+            while True:
+                await limiter.acquire(flow, CHUNK)
+                received[flow] += CHUNK
+
+        # Varias conexiones del flujo grande no le dan más parte
+        tasks = [asyncio.create_task(transfer(small))] + [asyncio.create_task(transfer(big)) for _ in range(4)]
+        await asyncio.sleep(1)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await limiter.stop()
+        return received[small], received[big]
+
+    small, big = asyncio.run(main())
+    assert 3 < small / big < 5
+    assert small + big < 2 * 2 * 1024 * 1024
+
+
+def test_removing_the_limit_releases_waiters():
+    async def main():
+        limiter = FairLimiter(1024)
+        flow = Flow(1, 'up')
+        waiting = asyncio.create_task(limiter.acquire(flow, 1024 * 1024))
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+        limiter.set_rate(0)
+        await asyncio.wait_for(waiting, 1)
+        # Sin límite no se espera nunca
+        await asyncio.wait_for(limiter.acquire(flow, 10 ** 9), 0.1)
+        await limiter.stop()
+
+    asyncio.run(main())
+
+
+def test_manager_throttles_only_inside_a_task():
+    async def main():
+        manager = BandwidthManager()
+        manager.set_limit('down', 'global', 256 * 1024)
+        start = time.monotonic()
+        # Fuera de una tarea no hay flujo asociado: no se limita
+        await manager.throttle('down', 10 ** 9)
+        assert time.monotonic() - start < 0.1
+
+        async def task():
+            flows = manager.begin_task(7)
+            try:
+                for _ in range(16):
+                    await manager.throttle('down', CHUNK)
+            finally:
+                manager.finish_task(flows)
+
+        manager.set_limit('down', 7, 128 * 1024)
+        await task()
+        elapsed = time.monotonic() - start
+        assert manager.stats()['overrides'] == {(7, 'down'): 128 * 1024}
+        assert manager.stats()['active_users'] == 0 and not manager.user_limits
+        await manager.stop()
+        return elapsed
+
+    # 256 KB con el límite del usuario (128 KB/s), más estricto que el global
+    assert 1.6 < asyncio.run(main()) < 2.6
+
+
+def test_weight_for(monkeypatch):
+    monkeypatch.setattr(bandwidth, 'BW_SMALL_FILE_SIZE', 1000)
+    assert BandwidthManager.weight_for(500) == bandwidth.BW_SMALL_FILE_WEIGHT
+    assert BandwidthManager.weight_for(5000) == 1.0
+    assert BandwidthManager.weight_for(0) == 1.0
@@ -0,0 +1,71 @@
+import asyncio
+from batch import Batch, parse_links, BATCH_CONCURRENCY
+from scheduler import JobScheduler, Job
+from status_editor import LocalStatus
+
+SHA = "a" * 64
+
+
+def test_parse_links():
+    text = (
+        "# comentario\n"
+        "https://example.com/a.zip | Copia A.zip\n"
+        f"https://example.com/b.iso | sha256:{SHA} | b.iso\n"
+        "https://example.com/c https://example.com/d\n"
+        "https://example.com/a.zip | Copia A.zip\n"
+        "no es un enlace | nombre\n"
+    )
+    assert parse_links(text) == [
+        ("https://example.com/a.zip", "Copia A.zip", None),
+        ("https://example.com/b.iso", "b.iso", ('sha256', SHA)),
+        ("https://example.com/c", None, None),
+        ("https://example.com/d", None, None),
+    ]
+
+
+def test_batch_items_run_concurrently_under_the_default_limits():
+    async def main():
+        # MAX_WORKERS=6, USER_MAX_ACTIVE=1 y BATCH_CONCURRENCY=3 por defecto
+        scheduler = JobScheduler(stage_limits={})
+        entries = [(f"https://example.com/{i}", None, None) for i in range(6)]
+        batch = Batch("lote", entries, LocalStatus())
+        peak = [0]
+
+        async def process_item(item):
+            peak[0] = max(peak[0], scheduler.active_count('a'))
+            await asyncio.sleep(0.01)
+            return 'error' if item.url.endswith("3") else 'ok'
+
+        async def run():
+            # Como process_batch: el lote devuelve su hueco y cada elemento ocupa uno
+            scheduler.release(job)
+            await batch.run(process_item, slot=lambda: scheduler.slot('a'))
+
+        job = Job("lote", 'a', run)
+        scheduler.submit(job)
+        while scheduler.tasks:
+            await asyncio.sleep(0.001)
+        return batch, peak[0]
+
+    batch, peak = asyncio.run(main())
+    assert peak == BATCH_CONCURRENCY > 1
+    assert [item.outcome for item in batch.items] == ['ok', 'ok', 'ok', 'error', 'ok', 'ok']
+    assert "Correctos: 5/6 · Fallidos: 1" in batch.progress_msg.text
+
+
+def test_batch_items_respect_max_workers():
+    async def main():
+        scheduler = JobScheduler(workers=2, user_max_active=1, user_queue_depth=5, stage_limits={})
+        entries = [(f"https://example.com/{i}", None, None) for i in range(4)]
+        batch = Batch("lote", entries, LocalStatus())
+        peak = [0]
+
+        async def process_item(item):
+            peak[0] = max(peak[0], scheduler.active_count('a'))
+            await asyncio.sleep(0.01)
+            return 'ok'
+
+        await batch.run(process_item, concurrency=3, slot=lambda: scheduler.slot('a'))
+        return peak[0]
+
+    assert asyncio.run(main()) == 2
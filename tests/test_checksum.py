@@ -0,0 +1,105 @@
+import os
+import base64
+import asyncio
+import hashlib
+import pytest
+from multidict import CIMultiDict
+from checksum import (parse_checksum, digests_from_headers, StreamHasher, ChecksumMismatch, hash_file,
+                      find_mismatch)
+
+DATA = os.urandom(10 * 1024 * 1024 + 17)
+SHA = hashlib.sha256(DATA).hexdigest()
+MD5 = hashlib.md5(DATA).hexdigest()
+
+
+def _b64(hex_digest):
+    return base64.b64encode(bytes.fromhex(hex_digest)).decode()
+
+
+def test_parse_checksum():
+    assert parse_checksum(f"sha256:{SHA.upper()}") == ('sha256', SHA)
+    assert parse_checksum(f" md5={MD5} ") == ('md5', MD5)
+    assert parse_checksum(SHA) == ('sha256', SHA)
+    assert parse_checksum(MD5) == ('md5', MD5)
+    # El algoritmo no corresponde a la longitud
+    assert parse_checksum(f"md5:{SHA}") is None
+    assert parse_checksum("Mi video.mp4") is None
+
+
+def test_digests_from_headers():
+    headers = CIMultiDict([
+        ('x-goog-hash', f"crc32c=AAAAAA==,md5={_b64(MD5)}"),
+        ('Repr-Digest', f"sha-256=:{_b64(SHA)}:"),
+    ])
+    assert digests_from_headers(headers) == {'sha256': SHA, 'md5': MD5}
+    # Content-MD5 describe el cuerpo: no vale para respuestas parciales ni comprimidas
+    body_md5 = CIMultiDict([('Content-MD5', _b64(MD5))])
+    assert digests_from_headers(body_md5) == {'md5': MD5}
+    assert digests_from_headers(body_md5, partial=True) == {}
+    assert digests_from_headers(CIMultiDict([('Content-MD5', _b64(MD5)), ('Content-Encoding', 'gzip')])) == {}
+    assert digests_from_headers(CIMultiDict([('Digest', "sha-256=no es base64")])) == {}
+
+
+def test_find_mismatch():
+    digests = {'sha256': SHA, 'md5': MD5}
+    assert find_mismatch(digests, {'sha256': SHA.upper()}) is None
+    assert find_mismatch(digests, {'md5': "0" * 32}) == ('md5', "0" * 32, MD5)
+    assert find_mismatch(digests, None) is None
+
+
+def test_feed_matches_hashlib_with_volumes():
+    volume_size = 3 * 1024 * 1024
+
+    async def main():
+        hasher = StreamHasher(volume_size)
+        for offset in range(0, len(DATA), 1024 * 1024 + 7):
+            await hasher.feed(DATA[offset:offset + 1024 * 1024 + 7])
+        await hasher.wait()
+        return hasher
+
+    hasher = asyncio.run(main())
+    assert hasher.result() == {'sha256': SHA, 'md5': MD5}
+    assert hasher.position == len(DATA)
+    volumes = [hashlib.sha256(DATA[o:o + volume_size]).hexdigest() for o in range(0, len(DATA), volume_size)]
+    assert [hasher.volume(i) for i in range(len(volumes))] == volumes
+    assert hasher.volume(len(volumes)) is None
+
+
+def test_follow_and_catch_up_from_a_range_file(tmp_path):
+    path = tmp_path / "tramo.bin"
+    base = 5 * 1024 * 1024
+    path.write_bytes(DATA[base:])
+
+    async def main():
+        hasher = StreamHasher()
+        # Empieza en base como un tramo de download_range
+        hasher.position = base
+        hasher.follow(str(path), base + 4 * 1024 * 1024, base)
+        await hasher.catch_up(str(path), len(DATA), base)
+        return hasher
+
+    hasher = asyncio.run(main())
+    assert hasher.position == len(DATA)
+    assert hasher.result()['sha256'] == hashlib.sha256(DATA[base:]).hexdigest()
+
+
+def test_catch_up_reports_a_short_file(tmp_path):
+    path = tmp_path / "corto.bin"
+    path.write_bytes(DATA[:1000])
+    with pytest.raises(ChecksumMismatch):
+        asyncio.run(StreamHasher().catch_up(str(path), 2000))
+
+
+def test_hash_file_and_reset(tmp_path):
+    path = tmp_path / "archivo.bin"
+    path.write_bytes(DATA)
+
+    async def main():
+        hasher = await hash_file(str(path))
+        first = hasher.result()
+        await hasher.reset()
+        return first, hasher
+
+    first, hasher = asyncio.run(main())
+    assert first == {'sha256': SHA, 'md5': MD5}
+    assert hasher.position == 0 and hasher.result()['sha256'] == hashlib.sha256().hexdigest()
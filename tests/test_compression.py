@@ -0,0 +1,97 @@
+import os
+import asyncio
+from aiohttp import web
+import compression
+import media_tools
+from compression import is_precompressed, compressibility, choose_level, plan_for_file, plan_for_url
+from http_session import close_session
+
+TEXT = b"fecha,usuario,bytes\n" + b"".join(f"2024-01-{i % 28 + 1:02d},user{i % 50},{i * 37}\n".encode()
+                                          for i in range(200_000))
+
+
+def test_precompressed_by_type_and_signature():
+    assert is_precompressed("video.mp4")
+    assert is_precompressed("archivo.zip")
+    assert is_precompressed("sin_extension", head=b"\x1f\x8b\x08\x00")
+    assert is_precompressed("sin_extension", head=b"\0\0\0\x18ftypisom")
+    assert not is_precompressed("datos.csv", head=TEXT[:16])
+
+
+def test_levels_follow_compressibility():
+    size = 1024 ** 3
+    assert compressibility([b""]) == 1.0
+    assert choose_level(size, 1.0) is None
+    # Muy comprimible con subida lenta: compensa el nivel máximo
+    assert choose_level(size, 0.1, upload_rate=10 * 1024, threads=4)[0] == 'máxima'
+    # Con subida rápida solo compensa el rápido
+    assert choose_level(size, 0.3, upload_rate=50 * 1024 * 1024, threads=4)[0] == 'rápida'
+
+
+def test_plan_for_file(tmp_path):
+    text = tmp_path / "datos.csv"
+    text.write_bytes(TEXT)
+    noise = tmp_path / "datos.bin"
+    noise.write_bytes(os.urandom(4 * 1024 * 1024))
+
+    async def main():
+        plan = await plan_for_file(str(text))
+        assert plan and plan['ratio'] < 0.5 and plan['estimated'] < len(TEXT)
+        assert await plan_for_file(str(noise)) is None
+
+    asyncio.run(main())
+
+
+def test_url_samples_are_full_blocks(monkeypatch):
+    blocks = []
+    real_plan = compression._plan
+
+    def recording_plan(name, mime_type, size, samples):
+        blocks.extend(samples)
+        return real_plan(name, mime_type, size, samples)
+
+    monkeypatch.setattr(compression, '_plan', recording_plan)
+
+    async def ranged(request):
+        # Responde el rango en trozos pequeños, como una red lenta
+        start, end = (int(v) for v in request.headers['Range'].split('=')[1].split('-'))
+        body = TEXT[start:end + 1]
+        response = web.StreamResponse(status=206)
+        await response.prepare(request)
+        for offset in range(0, len(body), 1000):
+            await response.write(body[offset:offset + 1000])
+            await asyncio.sleep(0)
+        return response
+
+    async def main():
+        app = web.Application()
+        app.router.add_get('/datos.csv', ranged)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        try:
+            return await plan_for_url(f"http://127.0.0.1:{port}/datos.csv", "datos.csv", "text/csv", len(TEXT))
+        finally:
+            await close_session()
+            await runner.cleanup()
+
+    plan = asyncio.run(main())
+    assert plan is not None
+    assert len(blocks) == compression.SAMPLE_BLOCKS
+    assert all(len(block) == compression.SAMPLE_BLOCK_SIZE for block in blocks)
+
+
+def test_compression_does_not_take_media_tool_slots():
+    async def main():
+        # Con todos los turnos de media_tools ocupados, una llamada con sus propios turnos sigue
+        for _ in range(media_tools.MEDIA_TOOL_CONCURRENCY):
+            await media_tools._process_slots.acquire()
+        try:
+            await asyncio.wait_for(media_tools.run_tool(['true'], slots=compression._compress_slots), 10)
+        finally:
+            for _ in range(media_tools.MEDIA_TOOL_CONCURRENCY):
+                media_tools._process_slots.release()
+
+    asyncio.run(main())
@@ -0,0 +1,162 @@
+import os
+import errno
+import asyncio
+import threading
+import pytest
+import disk_writer
+from disk_writer import DiskWriter, preallocate
+
+
+def _open(tmp_path):
+    return os.open(tmp_path / "data", os.O_RDWR | os.O_CREAT, 0o644)
+
+
+def test_short_pwrite_is_completed(tmp_path, monkeypatch):
+    real_pwrite = os.pwrite
+
+    def short_pwrite(fd, data, offset):
+        # Como un disco que solo acepta 3 bytes por llamada
+        return real_pwrite(fd, bytes(data[:3]), offset)
+
+    monkeypatch.setattr(os, 'pwrite', short_pwrite)
+    fd = _open(tmp_path)
+
+    async def main():
+        writer = DiskWriter(fd)
+        written = []
+        await writer.write(b"0123456789", 5, written.append)
+        await writer.write(b"abcde", 0, written.append)
+        await writer.close()
+        return written
+
+    try:
+        assert asyncio.run(main()) == [10, 5]
+    finally:
+        os.close(fd)
+    assert (tmp_path / "data").read_bytes() == b"abcde0123456789"
+
+
+def test_error_is_raised_on_next_call(tmp_path, monkeypatch):
+    def failing_pwrite(fd, data, offset):
+        raise OSError(errno.EIO, "I/O error")
+
+    monkeypatch.setattr(os, 'pwrite', failing_pwrite)
+    fd = _open(tmp_path)
+
+    async def main():
+        writer = DiskWriter(fd)
+        written = []
+        await writer.write(b"data", 0, written.append)
+        with pytest.raises(OSError):
+            await writer.flush()
+        with pytest.raises(OSError):
+            await writer.write(b"more", 4, written.append)
+        with pytest.raises(OSError):
+            await writer.close()
+        return written
+
+    try:
+        # Nada se da por escrito tras el error
+        assert asyncio.run(main()) == []
+    finally:
+        os.close(fd)
+
+
+def test_flush_waits_for_previous_writes(tmp_path, monkeypatch):
+    real_pwrite = os.pwrite
+    gate = threading.Event()
+
+    def slow_pwrite(fd, data, offset):
+        gate.wait()
+        return real_pwrite(fd, data, offset)
+
+    monkeypatch.setattr(os, 'pwrite', slow_pwrite)
+    fd = _open(tmp_path)
+
+    async def main():
+        writer = DiskWriter(fd)
+        written = []
+        for i in range(4):
+            await writer.write(bytes([65 + i]), i, written.append)
+        flushed = asyncio.ensure_future(writer.flush())
+        await asyncio.sleep(0.05)
+        assert not flushed.done() and written == []
+        gate.set()
+        await flushed
+        # Cuando flush() vuelve, todos los bloques anteriores ya están escritos y notificados
+        assert written == [1, 1, 1, 1]
+        await writer.close()
+
+    try:
+        asyncio.run(main())
+    finally:
+        os.close(fd)
+    assert (tmp_path / "data").read_bytes() == b"ABCD"
+
+
+def test_backpressure_limits_queued_blocks(tmp_path, monkeypatch):
+    real_pwrite = os.pwrite
+    gate = threading.Event()
+
+    def slow_pwrite(fd, data, offset):
+        gate.wait()
+        return real_pwrite(fd, data, offset)
+
+    monkeypatch.setattr(os, 'pwrite', slow_pwrite)
+    monkeypatch.setattr(disk_writer, 'WRITE_BUFFERS_PER_FILE', 2)
+    fd = _open(tmp_path)
+
+    async def main():
+        writer = DiskWriter(fd)
+        await writer.write(b"a", 0)
+        await writer.write(b"b", 1)
+        third = asyncio.ensure_future(writer.write(b"c", 2))
+        await asyncio.sleep(0.05)
+        assert not third.done()
+        gate.set()
+        await third
+        await writer.close()
+
+    try:
+        asyncio.run(main())
+    finally:
+        os.close(fd)
+    assert (tmp_path / "data").read_bytes() == b"abc"
+
+
+def test_preallocate_sets_size(tmp_path):
+    fd = _open(tmp_path)
+    try:
+        preallocate(fd, 4096)
+        assert os.fstat(fd).st_size == 4096
+    finally:
+        os.close(fd)
+
+
+def test_preallocate_falls_back_to_ftruncate(tmp_path, monkeypatch):
+    def unsupported(fd, offset, size):
+        raise OSError(errno.EOPNOTSUPP, "not supported")
+
+    monkeypatch.setattr(os, 'posix_fallocate', unsupported)
+    fd = _open(tmp_path)
+    try:
+        preallocate(fd, 1000)
+        assert os.fstat(fd).st_size == 1000
+    finally:
+        os.close(fd)
+
+
+def test_preallocate_propagates_enospc(tmp_path, monkeypatch):
+    def full(fd, offset, size):
+        raise OSError(errno.ENOSPC, "No space left on device")
+
+    monkeypatch.setattr(os, 'posix_fallocate', full)
+    fd = _open(tmp_path)
+    try:
+        with pytest.raises(OSError) as error:
+            preallocate(fd, 1000)
+        assert error.value.errno == errno.ENOSPC
+        # No se recurre a ftruncate: el archivo no aparenta tener el espacio
+        assert os.fstat(fd).st_size == 0
+    finally:
+        os.close(fd)
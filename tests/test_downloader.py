@@ -0,0 +1,316 @@
+import os
+import re
+import sys
+import json
+import socket
+import subprocess
+import hashlib
+import asyncio
+import pytest
+from aiohttp import web
+import downloader
+from downloader import (split_ranges, contiguous_end, backoff_delay, TransferJournal, has_journal,
+                        download_direct, JOURNAL_SUFFIX, MAX_BACKOFF)
+import checksum
+from checksum import StreamHasher
+from http_session import close_session
+
+DATA = os.urandom(3 * 1024 * 1024 + 123)
+INFO = {'size': 1000, 'etag': '"v1"', 'last_modified': None}
+
+
+def test_split_ranges(monkeypatch):
+    mb = downloader.MIN_SEGMENT_SIZE
+    assert split_ranges(10) == [(0, 9)]
+    ranges = split_ranges(5 * mb + 1, offset=100)
+    # Segmentos de MIN_SEGMENT_SIZE, contiguos y cubriendo todo
+    assert len(ranges) == 6 and ranges[-1] == (100 + 5 * mb, 100 + 5 * mb)
+    assert ranges[0][0] == 100
+    assert all(end + 1 == start for (_, end), (start, _) in zip(ranges, ranges[1:]))
+    # Archivos enormes: segmentos más grandes para no pasar de MAX_SEGMENTS
+    monkeypatch.setattr(downloader, 'MAX_SEGMENTS', 4)
+    assert len(split_ranges(10 * mb)) == 4
+
+
+def test_contiguous_end_and_backoff():
+    assert contiguous_end([[0, 9, 10], [10, 19, 15], [20, 29, 29]]) == 15
+    assert contiguous_end([[0, 9, 10], [10, 19, 20]]) == 20
+    assert contiguous_end([]) == 0
+    assert [backoff_delay(n) for n in range(3)] == [1, 2, 4]
+    assert backoff_delay(20) == MAX_BACKOFF
+
+
+def test_journal_roundtrip_and_matching(tmp_path):
+    path = str(tmp_path / "file.bin")
+    journal = TransferJournal(path)
+    asyncio.run(journal.start("https://example.com/f", INFO, [(0, 499), (500, 999)]))
+    assert has_journal(path)
+    journal.data['segments'][0][2] = 200
+    asyncio.run(journal.save())
+
+    loaded = TransferJournal(path)
+    assert loaded.load()['segments'] == [[0, 499, 200], [500, 999, 500]]
+    assert loaded.downloaded == 200 and loaded.validator == '"v1"'
+    assert loaded.matches("https://example.com/f", INFO)
+    assert not loaded.matches("https://example.com/f", dict(INFO, etag='"v2"'))
+    assert not loaded.matches("https://example.com/f", dict(INFO, size=999))
+    assert not loaded.matches("https://example.com/f", INFO, offset=10)
+    # Sin validadores no se puede saber si el archivo es el mismo
+    loaded.data['etag'] = None
+    assert not loaded.matches("https://example.com/f", dict(INFO, etag=None))
+
+    loaded.remove()
+    loaded.remove()
+    assert not has_journal(path)
+
+
+def test_journal_never_writes_an_older_snapshot(tmp_path):
+    journal = TransferJournal(str(tmp_path / "file.bin"))
+    journal._write(None, 2, json.dumps({'seq': 2}))
+    journal._write(None, 1, json.dumps({'seq': 1}))
+    assert journal.load() == {'seq': 2}
+    assert not os.path.exists(journal.path + ".tmp")
+
+
+class Origin:
+    """Servidor local con rangos, If-Range y cortes de conexión opcionales"""
+
+    def __init__(self):
+        self.etag = '"v1"'
+        self.data = DATA
+        self.fail_once = set()  # inicios de rango que se cortan a la mitad la primera vez
+        self.honor_ranges = True  # False: anuncia Accept-Ranges pero responde 200 a todo
+        self.requests = []
+
+    async def handler(self, request):
+        headers = {'ETag': self.etag, 'Accept-Ranges': 'bytes'}
+        match = re.fullmatch(r'bytes=(\d+)-(\d*)', request.headers.get('Range', ''))
+        if_range = request.headers.get('If-Range')
+        if not match or not self.honor_ranges or (if_range and if_range != self.etag):
+            self.requests.append((0, len(self.data) - 1))
+            return web.Response(body=self.data, headers=headers)
+        start = int(match.group(1))
+        end = int(match.group(2)) if match.group(2) else len(self.data) - 1
+        self.requests.append((start, end))
+        headers['Content-Range'] = f'bytes {start}-{end}/{len(self.data)}'
+        body = self.data[start:end + 1]
+        response = web.StreamResponse(status=206, headers=headers)
+        response.content_length = len(body)
+        await response.prepare(request)
+        if start in self.fail_once and len(body) > 1:
+            self.fail_once.discard(start)
+            await response.write(body[:len(body) // 2])
+            request.transport.close()
+            return response
+        await response.write(body)
+        return response
+
+    async def serve(self, body, port=0):
+        app = web.Application()
+        app.router.add_get('/file.bin', self.handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        try:
+            return await body(f"http://127.0.0.1:{port}/file.bin")
+        finally:
+            await close_session()
+            await runner.cleanup()
+
+
+@pytest.fixture
+def small_segments(monkeypatch):
+    monkeypatch.setattr(downloader, 'MIN_SEGMENT_SIZE', 256 * 1024)
+    monkeypatch.setattr(downloader, 'CHUNK_SIZE', 64 * 1024)
+    monkeypatch.setattr(downloader, 'backoff_delay', lambda attempt: 0)
+
+
+async def _nothing(current, total):
+    pass
+
+
+def test_segmented_download_retries_a_cut_segment(tmp_path, small_segments):
+    path = str(tmp_path / "file.bin")
+    origin = Origin()
+    ranges = split_ranges(len(DATA))
+    origin.fail_once = {ranges[1][0]}
+    hasher = StreamHasher()
+
+    async def body(url):
+        return await download_direct(url, path, _nothing, lambda: False, connections=4, hasher=hasher)
+
+    assert asyncio.run(origin.serve(body))
+    with open(path, 'rb') as f:
+        assert f.read() == DATA
+    assert not has_journal(path)
+    # El segmento cortado se reanuda desde lo ya escrito, no desde su inicio
+    retry = [start for start, _ in origin.requests[1:] if ranges[1][0] < start < ranges[2][0]]
+    assert len(retry) == 1
+    assert hasher.result()['sha256'] == hashlib.sha256(DATA).hexdigest()
+
+
+def test_cancelled_download_resumes_from_the_journal(tmp_path, small_segments):
+    path = str(tmp_path / "file.bin")
+    origin = Origin()
+    received = [0]
+
+    async def count(current, total):
+        received[0] = current
+
+    async def body(url):
+        assert not await download_direct(url, path, count, lambda: received[0] > len(DATA) // 2, connections=4)
+        assert has_journal(path)
+        journal = TransferJournal(path)
+        done = journal.load() and journal.downloaded
+        assert 0 < done < len(DATA)
+        origin.requests.clear()
+        assert await download_direct(url, path, _nothing, lambda: False, connections=4)
+        return done
+
+    done = asyncio.run(origin.serve(body))
+    with open(path, 'rb') as f:
+        assert f.read() == DATA
+    assert not os.path.exists(path + JOURNAL_SUFFIX)
+    # Solo se vuelve a pedir lo que faltaba (más la consulta inicial de un byte)
+    fetched = sum(end - start + 1 for start, end in origin.requests)
+    assert fetched == len(DATA) - done + 1
+
+
+def test_changed_remote_restarts_the_download(tmp_path, small_segments):
+    path = str(tmp_path / "file.bin")
+    origin = Origin()
+    received = [0]
+
+    async def count(current, total):
+        received[0] = current
+
+    async def body(url):
+        assert not await download_direct(url, path, count, lambda: received[0] > len(DATA) // 2, connections=4)
+        # El archivo cambia en el servidor con el mismo tamaño después de la consulta previa
+        info = {'size': len(DATA), 'ranges': True, 'etag': origin.etag, 'last_modified': None}
+        origin.etag = '"v2"'
+        origin.data = DATA[::-1]
+        return await download_direct(url, path, _nothing, lambda: False, connections=4, info=info)
+
+    assert asyncio.run(origin.serve(body))
+    with open(path, 'rb') as f:
+        assert f.read() == DATA[::-1]
+    # If-Range detectó el cambio: hubo una respuesta completa (200) antes de reiniciar
+    assert (0, len(DATA) - 1) in origin.requests
+
+
+def test_origin_ignoring_ranges_falls_back_to_streaming(tmp_path, small_segments):
+    path = str(tmp_path / "file.bin")
+    origin = Origin()
+    origin.honor_ranges = False
+
+    async def body(url):
+        # Información de un HEAD que anuncia Accept-Ranges
+        info = {'size': len(DATA), 'ranges': True, 'etag': origin.etag, 'last_modified': None}
+        return await download_direct(url, path, _nothing, lambda: False, connections=4, info=info)
+
+    assert asyncio.run(origin.serve(body))
+    with open(path, 'rb') as f:
+        assert f.read() == DATA
+    assert not has_journal(path)
+
+
+def test_changed_remote_without_ranges_falls_back_to_streaming(tmp_path, small_segments):
+    path = str(tmp_path / "file.bin")
+    origin = Origin()
+    received = [0]
+
+    async def count(current, total):
+        received[0] = current
+
+    async def body(url):
+        assert not await download_direct(url, path, count, lambda: received[0] > len(DATA) // 2, connections=4)
+        info = {'size': len(DATA), 'ranges': True, 'etag': origin.etag, 'last_modified': None}
+        # La versión nueva se sirve desde un origen que ya no respeta Range
+        origin.etag = '"v2"'
+        origin.data = DATA[::-1]
+        origin.honor_ranges = False
+        return await download_direct(url, path, _nothing, lambda: False, connections=4, info=info)
+
+    assert asyncio.run(origin.serve(body))
+    with open(path, 'rb') as f:
+        assert f.read() == DATA[::-1]
+
+
+# Proceso que descarga con un solo segmento y muere sin limpiar a mitad de la descarga
+CRASHING_DOWNLOAD = """
+import os, sys, asyncio
+import downloader
+from test_downloader import Origin
+
+path, source, port = sys.argv[1], sys.argv[2], int(sys.argv[3])
+downloader.JOURNAL_SAVE_INTERVAL = 0
+downloader.CHUNK_SIZE = 64 * 1024
+origin = Origin()
+origin.data = open(source, 'rb').read()
+
+async def crash(current, total):
+    if current > total // 2:
+        os._exit(9)
+
+async def body(url):
+    await downloader.download_direct(url, path, crash, lambda: False, connections=1)
+
+asyncio.run(origin.serve(body, port))
+"""
+
+
+def test_killed_download_resumes_mid_segment(tmp_path):
+    path = str(tmp_path / "file.bin")
+    source = tmp_path / "source.bin"
+    source.write_bytes(DATA)
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    tests_dir = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.dirname(tests_dir), tests_dir]))
+    child = subprocess.run([sys.executable, '-c', CRASHING_DOWNLOAD, path, str(source), str(port)],
+                           env=env, capture_output=True, text=True, timeout=60)
+    assert child.returncode == 9, child.stderr
+
+    # El journal guardado durante la descarga apunta a la mitad del único segmento
+    journal = TransferJournal(path)
+    [(start, end, pos)] = journal.load()['segments']
+    assert start == 0 and end == len(DATA) - 1 and 0 < pos < end
+
+    origin = Origin()
+
+    async def body(url):
+        return await download_direct(url, path, _nothing, lambda: False, connections=1)
+
+    assert asyncio.run(origin.serve(body, port))
+    with open(path, 'rb') as f:
+        assert f.read() == DATA
+    # La consulta inicial y un único rango desde donde se quedó
+    assert origin.requests == [(0, 0), (pos, len(DATA) - 1)]
+
+
+def test_segments_are_hashed_while_downloading(tmp_path, small_segments, monkeypatch):
+    monkeypatch.setattr(checksum, 'HASH_CHUNK', 128 * 1024)
+    path = str(tmp_path / "file.bin")
+    hasher = StreamHasher()
+    inline = []
+    real_catch_up = hasher.catch_up
+
+    async def catch_up(*args):
+        # Lo calculado antes de terminar la descarga
+        await hasher.wait()
+        inline.append(hasher.position)
+        await real_catch_up(*args)
+
+    hasher.catch_up = catch_up
+
+    async def body(url):
+        return await download_direct(url, path, _nothing, lambda: False, connections=4, hasher=hasher)
+
+    assert asyncio.run(Origin().serve(body))
+    assert hasher.result()['sha256'] == hashlib.sha256(DATA).hexdigest()
+    # Las conexiones toman los segmentos en orden: al final solo falta la cola
+    assert inline[0] >= len(DATA) - 4 * downloader.MIN_SEGMENT_SIZE - checksum.HASH_CHUNK
@@ -0,0 +1,69 @@
+import asyncio
+import file_cache
+from file_cache import FileCache, normalize_url
+
+ITEMS = [{'type': 'document', 'file_id': "AbC", 'caption': ""}]
+INFO = {'size': 100, 'etag': '"v1"', 'last_modified': None}
+
+
+def test_normalize_url():
+    assert normalize_url(" HTTPS://Example.COM:443/a?b=2&a=1#frag") == "https://example.com/a?a=1&b=2"
+    assert normalize_url("http://example.com:8080") == "http://example.com:8080/"
+
+
+def test_hits_and_revalidation(tmp_path):
+    async def main():
+        cache = FileCache(str(tmp_path / "cache.db"))
+        url = "https://example.com/f.zip"
+        await cache.put(url, "f.zip", INFO, ITEMS, "h" * 64)
+        assert await cache.get("https://EXAMPLE.com/f.zip#x", "f.zip", INFO) == ITEMS
+        assert await cache.get(url, "otro.zip", INFO) is None
+        # yt-dlp no da validadores: vale la entrada por URL y nombre
+        assert await cache.get(url, "f.zip") == ITEMS
+        assert await cache.find_by_hash("h" * 64) == ITEMS
+        # El archivo cambió en el servidor: la entrada se descarta
+        assert await cache.get(url, "f.zip", dict(INFO, etag='"v2"')) is None
+        assert await cache.get(url, "f.zip", INFO) is None
+        stats = await cache.stats()
+        cache.close()
+        return stats
+
+    stats = asyncio.run(main())
+    assert stats['entries'] == 0 and stats['hits'] == 2 and stats['misses'] == 3 and stats['stale'] == 1
+
+
+def test_ttl_and_max_entries(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(file_cache.time, 'time', lambda: now[0])
+
+    async def main():
+        cache = FileCache(str(tmp_path / "cache.db"), ttl=100, max_entries=2)
+        for name in ("a", "b"):
+            await cache.put(f"https://example.com/{name}", name, INFO, ITEMS)
+            now[0] += 1
+        # "a" se usó hace menos: al llenarse se descarta "b"
+        assert await cache.get("https://example.com/a", "a", INFO)
+        await cache.put("https://example.com/c", "c", INFO, ITEMS)
+        assert await cache.get("https://example.com/b", "b", INFO) is None
+        assert await cache.get("https://example.com/a", "a", INFO)
+        now[0] += 200
+        assert await cache.get("https://example.com/c", "c", INFO) is None
+        cache.close()
+
+    asyncio.run(main())
+
+
+def test_items_without_file_id_are_not_cached(tmp_path):
+    async def main():
+        cache = FileCache(str(tmp_path / "cache.db"))
+        url = "https://example.com/f.zip"
+        # Una parte publicada sin que Telegram devolviera el mensaje
+        await cache.put(url, "f.zip", INFO, ITEMS + [None], "h" * 64)
+        await cache.put(url, "g.zip", INFO, [{'type': 'document', 'file_id': None, 'caption': ""}])
+        assert await cache.get(url, "f.zip", INFO) is None
+        assert await cache.find_by_hash("h" * 64) is None
+        stats = await cache.stats()
+        cache.close()
+        return stats
+
+    assert asyncio.run(main())['entries'] == 0
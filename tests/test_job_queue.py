@@ -0,0 +1,153 @@
+import asyncio
+from job_queue import JobQueue
+
+
+def _queue(tmp_path, **kwargs):
+    return JobQueue(str(tmp_path / "jobs.db"), **kwargs)
+
+
+async def _submit(queue, job_id, user_id):
+    await queue.submit(job_id, user_id, user_id, 1, 2, 'link', {'url': f"https://example.com/{job_id}"})
+
+
+def test_claims_alternate_between_users(tmp_path):
+    queue = _queue(tmp_path, user_max_active=5)
+
+    async def main():
+        for job_id, user_id in (("a1", 1), ("a2", 1), ("a3", 1), ("b1", 2)):
+            await _submit(queue, job_id, user_id)
+        claimed = []
+        for _ in range(4):
+            job = await queue.claim("w")
+            claimed.append(job['id'])
+            await asyncio.sleep(0.01)  # claimed distinto para cada reclamo
+        return claimed
+
+    try:
+        # Tras atender a un usuario pasa al que lleva más tiempo sin atender
+        assert asyncio.run(main()) == ["a1", "b1", "a2", "a3"]
+    finally:
+        queue.close()
+
+
+def test_user_max_active_limits_claims(tmp_path):
+    queue = _queue(tmp_path, user_max_active=1)
+
+    async def main():
+        await _submit(queue, "a1", 1)
+        await _submit(queue, "a2", 1)
+        first = await queue.claim("w")
+        assert first['payload'] == {'url': "https://example.com/a1"}
+        assert await queue.claim("w") is None
+        await queue.complete("a1", "w", 'done')
+        assert (await queue.claim("w"))['id'] == "a2"
+
+    try:
+        asyncio.run(main())
+    finally:
+        queue.close()
+
+
+def test_release_and_handed_back_count(tmp_path):
+    queue = _queue(tmp_path, user_max_active=5)
+
+    async def main():
+        for job_id in ("a1", "a2", "a3"):
+            await _submit(queue, job_id, 1)
+        for _ in range(3):
+            await queue.claim("w1")
+        job_ids = await queue.running_jobs("w1")
+        assert sorted(job_ids) == ["a1", "a2", "a3"]
+        await queue.complete("a1", "w1", 'done')
+        await queue.release("a2", "w1")
+        await queue.release("a3", "w1")
+        # Otro proceso ya reclamó una de las devueltas: sigue sin terminar
+        retaken = await queue.claim("w2")
+        assert retaken['attempts'] == 1
+        assert await queue.unfinished(job_ids) == 2
+
+    try:
+        asyncio.run(main())
+    finally:
+        queue.close()
+
+
+def test_stalled_jobs_are_requeued_then_abandoned(tmp_path):
+    queue = _queue(tmp_path)
+
+    async def main():
+        await _submit(queue, "a1", 1)
+        await queue.claim("w1")
+        assert await queue.reclaim_stalled(stall_timeout=-1, max_attempts=2) == 1
+        job = await queue.claim("w2")
+        assert job['attempts'] == 2
+        # La tarea ya no es de w1: sus latidos no la renuevan
+        assert not await queue.heartbeat("a1", "w1")
+        assert await queue.heartbeat("a1", "w2")
+        await queue.reclaim_stalled(stall_timeout=-1, max_attempts=2)
+        stats = await queue.stats()
+        assert stats['failed'] == 1 and stats['queued'] == 0
+        texts = [row['text'] for row in await queue.statuses()]
+        assert "vuelve a la cola" in texts[0] and "se abandonó" in texts[1]
+
+    try:
+        asyncio.run(main())
+    finally:
+        queue.close()
+
+
+WORKER_STUB = '''
+import sys
+import signal
+import asyncio
+sys.path.insert(0, {root!r})
+from job_queue import job_queue, worker_name
+
+
+async def main(index):
+    stop = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, stop.set)
+    job = await job_queue.claim(worker_name(index))
+    open({ready!r}, 'a').write("x")
+    await stop.wait()
+    await job_queue.release(job['id'], worker_name(index))
+    job_queue.close()
+    # Un código de salida cualquiera no debe contarse como tareas devueltas
+    sys.exit(7)
+
+asyncio.run(main(int(sys.argv[1])))
+'''
+
+
+def test_rolling_restart_counts_jobs_from_the_queue(tmp_path, monkeypatch):
+    import os
+    import worker_pool
+    from job_queue import job_queue
+
+    ready = tmp_path / "ready"
+    script = tmp_path / "worker_stub.py"
+    script.write_text(WORKER_STUB.format(root=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                         ready=str(ready)))
+    monkeypatch.setattr(worker_pool, 'WORKER_SCRIPT', str(script))
+    monkeypatch.setattr(worker_pool, 'JOB_POLL_INTERVAL', 0.05)
+    monkeypatch.setenv('JOB_QUEUE_DB', str(tmp_path / "jobs.db"))
+    monkeypatch.setattr(job_queue, 'path', str(tmp_path / "jobs.db"))
+
+    async def wait_ready(count):
+        while not ready.exists() or len(ready.read_text()) < count:
+            await asyncio.sleep(0.05)
+
+    async def main():
+        await _submit(job_queue, "a1", 1)
+        pool = worker_pool.WorkerPool(None, processes=1)
+        pool.supervisors = [asyncio.create_task(pool._supervise(0, dict(os.environ)))]
+        try:
+            await asyncio.wait_for(wait_ready(1), 20)
+            handed_back = await asyncio.wait_for(pool.rolling_restart(5), 20)
+            # El proceso relanzado vuelve a reclamar la tarea devuelta
+            await asyncio.wait_for(wait_ready(2), 20)
+            return handed_back
+        finally:
+            await pool.stop()
+
+    assert asyncio.run(main()) == 1
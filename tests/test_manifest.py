@@ -0,0 +1,247 @@
+import os
+import shutil
+import asyncio
+import subprocess
+import aiohttp
+import pytest
+from aiohttp import web
+import manifest
+from manifest import (ManifestUnsupported, choose_variant, parse_hls_master, parse_hls_media, parse_dash,
+                      download_manifest)
+from yt_dlp.aes import aes_cbc_encrypt_bytes
+from http_session import close_session
+
+MASTER = """#EXTM3U
+#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="aud",NAME="en",DEFAULT=NO,URI="audio/en.m3u8"
+#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="aud",NAME="es",DEFAULT=YES,URI="audio/es.m3u8"
+#EXT-X-STREAM-INF:BANDWIDTH=800000,RESOLUTION=640x360,AUDIO="aud"
+360p.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=2400000,RESOLUTION=1280x720,AUDIO="aud"
+720p.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=6000000,RESOLUTION=1920x1080,AUDIO="aud"
+https://cdn.example.com/1080p.m3u8
+"""
+
+MEDIA = """#EXTM3U
+#EXT-X-TARGETDURATION:4
+#EXT-X-MEDIA-SEQUENCE:7
+#EXT-X-MAP:URI="init.mp4"
+#EXTINF:4.0,
+seg7.m4s
+#EXT-X-KEY:METHOD=AES-128,URI="key.bin"
+#EXTINF:4.0,
+seg8.m4s
+#EXT-X-KEY:METHOD=AES-128,URI="key.bin",IV=0x000102030405060708090a0b0c0d0e0f
+#EXTINF:4.0,
+seg9.m4s
+#EXT-X-KEY:METHOD=NONE
+#EXT-X-BYTERANGE:1000@0
+#EXTINF:4.0,
+all.ts
+#EXT-X-BYTERANGE:500
+#EXTINF:4.0,
+all.ts
+#EXT-X-ENDLIST
+"""
+
+DASH_TEMPLATE = """<?xml version="1.0"?>
+<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="static" mediaPresentationDuration="PT10S">
+  <BaseURL>media/</BaseURL>
+  <Period>
+    <AdaptationSet contentType="video">
+      <SegmentTemplate initialization="$RepresentationID$/init.mp4" media="$RepresentationID$/$Number%03d$.m4s"
+                       startNumber="1" timescale="1000" duration="4000"/>
+      <Representation id="v480" bandwidth="1000000" height="480"/>
+      <Representation id="v720" bandwidth="3000000" height="720"/>
+      <Representation id="v1080" bandwidth="6000000" height="1080"/>
+    </AdaptationSet>
+    <AdaptationSet contentType="audio">
+      <Representation id="a64" bandwidth="64000">
+        <SegmentTemplate initialization="a64-init.mp4" media="a64-$Time$.m4s" timescale="100">
+          <SegmentTimeline>
+            <S t="0" d="400" r="1"/>
+            <S d="200"/>
+          </SegmentTimeline>
+        </SegmentTemplate>
+      </Representation>
+      <Representation id="a128" bandwidth="128000">
+        <ContentProtection schemeIdUri="urn:mpeg:dash:mp4protection:2011"/>
+      </Representation>
+    </AdaptationSet>
+  </Period>
+</MPD>
+"""
+
+DASH_LIST = """<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="static" mediaPresentationDuration="PT8S">
+  <Period>
+    <AdaptationSet mimeType="video/mp4">
+      <Representation id="v" bandwidth="1" height="360">
+        <BaseURL>video.mp4</BaseURL>
+        <SegmentList>
+          <Initialization range="0-99"/>
+          <SegmentURL mediaRange="100-999"/>
+          <SegmentURL mediaRange="1000-1999"/>
+        </SegmentList>
+      </Representation>
+    </AdaptationSet>
+  </Period>
+</MPD>
+"""
+
+BASE = "https://example.com/hls/master.m3u8"
+
+
+def test_hls_master_variants_and_default_audio():
+    variants, audio = parse_hls_master(MASTER, BASE)
+    assert [v['height'] for v in variants] == [360, 720, 1080]
+    assert variants[2]['url'] == "https://cdn.example.com/1080p.m3u8"
+    assert audio == {'aud': "https://example.com/hls/audio/es.m3u8"}
+    chosen = choose_variant(variants, 720)
+    assert chosen['url'] == "https://example.com/hls/720p.m3u8"
+
+
+def test_choose_variant_falls_back_to_best():
+    variants = [{'height': 1080, 'bandwidth': 5}, {'height': 1440, 'bandwidth': 9}, {'height': None, 'bandwidth': 1}]
+    assert choose_variant(variants, 720)['height'] == 1440
+
+
+def test_hls_media_segments_keys_and_byteranges():
+    segments = parse_hls_media(MEDIA, BASE)
+    assert [s.url.rsplit('/', 1)[1] for s in segments] == ["init.mp4", "seg7.m4s", "seg8.m4s", "seg9.m4s",
+                                                           "all.ts", "all.ts"]
+    init, plain, keyed, explicit_iv, first_range, second_range = segments
+    assert init.key is None and plain.key is None
+    # Sin IV se usa el número de secuencia
+    assert keyed.key == "https://example.com/hls/key.bin"
+    assert keyed.iv == (8).to_bytes(16, 'big')
+    assert explicit_iv.iv == bytes(range(16))
+    assert first_range.byterange == (0, 1000) and first_range.key is None
+    # Sin offset, el rango sigue al anterior del mismo archivo
+    assert second_range.byterange == (1000, 500)
+
+
+def test_hls_live_and_sample_aes_are_unsupported():
+    with pytest.raises(ManifestUnsupported):
+        parse_hls_media(MEDIA.replace("#EXT-X-ENDLIST\n", ""), BASE)
+    with pytest.raises(ManifestUnsupported):
+        parse_hls_media(MEDIA.replace("METHOD=AES-128", "METHOD=SAMPLE-AES"), BASE)
+
+
+def test_dash_segment_template():
+    video, audio = parse_dash(DASH_TEMPLATE, "https://example.com/dash/manifest.mpd", max_height=720)
+    assert [s.url for s in video] == [
+        "https://example.com/dash/media/v720/init.mp4",
+        "https://example.com/dash/media/v720/001.m4s",
+        "https://example.com/dash/media/v720/002.m4s",
+        "https://example.com/dash/media/v720/003.m4s",
+    ]
+    # SegmentTimeline con repeticiones; la representación con DRM se descarta
+    assert [s.url.rsplit('/', 1)[1] for s in audio] == ["a64-init.mp4", "a64-0.m4s", "a64-400.m4s", "a64-800.m4s"]
+
+
+def test_dash_segment_list_with_ranges():
+    [video] = parse_dash(DASH_LIST, "https://example.com/dash/manifest.mpd")
+    assert {s.url for s in video} == {"https://example.com/dash/video.mp4"}
+    assert [s.byterange for s in video] == [(0, 100), (100, 900), (1000, 1000)]
+
+
+def test_dash_live_is_unsupported():
+    with pytest.raises(ManifestUnsupported):
+        parse_dash(DASH_TEMPLATE.replace('type="static"', 'type="dynamic"'), "https://example.com/")
+
+
+async def _serve(app):
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
+
+
+def test_manifest_text_is_read_to_the_end(monkeypatch):
+    body = MEDIA.encode() * 50
+
+    async def slow_playlist(request):
+        response = web.StreamResponse()
+        await response.prepare(request)
+        for start in range(0, len(body), 1000):
+            await response.write(body[start:start + 1000])
+            await asyncio.sleep(0.001)
+        return response
+
+    async def main():
+        app = web.Application()
+        app.router.add_get('/index.m3u8', slow_playlist)
+        runner, base = await _serve(app)
+        try:
+            async with aiohttp.ClientSession() as session:
+                text, _ = await manifest._get_text(session, f"{base}/index.m3u8")
+                assert text.encode() == body
+                monkeypatch.setattr(manifest, 'MANIFEST_MAX_BYTES', 4096)
+                with pytest.raises(ManifestUnsupported):
+                    await manifest._get_text(session, f"{base}/index.m3u8")
+        finally:
+            await runner.cleanup()
+
+    asyncio.run(main())
+
+
+def _probe(path):
+    output = subprocess.run(
+        ['ffprobe', '-v', 'error', '-show_entries', 'format=duration:stream=codec_type', '-of', 'json', path],
+        check=True, capture_output=True, text=True
+    ).stdout
+    return output
+
+
+@pytest.mark.skipif(not shutil.which('ffmpeg') or not shutil.which('ffprobe'), reason="ffmpeg no disponible")
+@pytest.mark.parametrize('encrypted', [False, True])
+def test_download_hls_and_remux(tmp_path, encrypted):
+    source = tmp_path / "source"
+    source.mkdir()
+    subprocess.run(
+        ['ffmpeg', '-v', 'error', '-f', 'lavfi', '-i', 'testsrc=duration=6:size=320x240:rate=25',
+         '-f', 'lavfi', '-i', 'sine=duration=6', '-c:v', 'libx264', '-g', '25', '-c:a', 'aac',
+         '-f', 'hls', '-hls_time', '1', '-hls_playlist_type', 'vod', '-hls_segment_type', 'fmp4',
+         str(source / "index.m3u8")],
+        check=True
+    )
+    if encrypted:
+        # ffmpeg no cifra fMP4: se cifran los segmentos aquí con AES-128 (IV = número de secuencia)
+        key = os.urandom(16)
+        (source / "key.bin").write_bytes(key)
+        playlist = (source / "index.m3u8").read_text()
+        segments = sorted(source.glob("*.m4s"), key=lambda p: int(p.stem.replace("index", "")))
+        for sequence, segment in enumerate(segments):
+            segment.write_bytes(aes_cbc_encrypt_bytes(segment.read_bytes(), key, sequence.to_bytes(16, 'big'),
+                                                      padding_mode='pkcs7'))
+        playlist = playlist.replace('#EXT-X-MAP:URI="init.mp4"',
+                                    '#EXT-X-MAP:URI="init.mp4"\n#EXT-X-KEY:METHOD=AES-128,URI="key.bin"')
+        assert "#EXT-X-KEY" in playlist and "#EXT-X-MEDIA-SEQUENCE:0" in playlist
+        (source / "index.m3u8").write_text(playlist)
+    output = str(tmp_path / "video.mp4")
+    updates = []
+
+    async def on_progress(current, total, done, count):
+        updates.append((done, count))
+
+    async def main():
+        app = web.Application()
+        app.router.add_static('/', str(source))
+        runner, base = await _serve(app)
+        try:
+            return await download_manifest(f"{base}/index.m3u8", output, on_progress, lambda: False)
+        finally:
+            await close_session()
+            await runner.cleanup()
+
+    assert asyncio.run(main()) is True
+    # Segmentos más el de inicio (EXT-X-MAP)
+    count = len(list(source.glob("*.m4s"))) + 1
+    assert updates[-1] == (count, count)
+    probe = _probe(output)
+    assert '"video"' in probe and '"audio"' in probe
+    duration = float(probe.split('"duration": "')[1].split('"')[0])
+    assert abs(duration - 6) < 0.5
+    assert not list(tmp_path.glob("video.mp4.track*"))
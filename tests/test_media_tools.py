@@ -0,0 +1,154 @@
+import os
+import shutil
+import asyncio
+import json
+import subprocess
+import pytest
+import media_tools
+from media_tools import parse_ffmpeg_input, prepare_video, get_video_metadata, is_faststart, split_video_by_time
+
+HAS_FFMPEG = bool(shutil.which('ffmpeg') and shutil.which('ffprobe'))
+needs_ffmpeg = pytest.mark.skipif(not HAS_FFMPEG, reason="ffmpeg no disponible")
+
+BANNER = """Input #0, mov,mp4,m4a,3gp,3g2,mj2, from 'clip.mp4':
+  Metadata:
+    major_brand     : isom
+  Duration: 01:02:03.50, start: 0.000000, bitrate: 1234 kb/s
+  Stream #0:0[0x1](und): Video: h264 (High) (avc1 / 0x31637661), yuv420p(progressive), 1280x720 [SAR 1:1 DAR 16:9], 1100 kb/s, 25 fps (default)
+  Stream #0:1[0x2](und): Audio: aac (LC) (mp4a / 0x6134706D), 44100 Hz, stereo, fltp, 128 kb/s (default)
+Stream mapping:
+  Stream #0:0 -> #0:0 (h264 (native) -> mjpeg (native))
+Output #0, image2, to 'thumb.jpg':
+  Stream #0:0(und): Video: mjpeg, yuvj420p(pc), 320x180, q=2-31, 200 kb/s, 25 fps
+"""
+
+AUDIO_WITH_COVER = """Input #0, mp3, from 'song.mp3':
+  Duration: 00:03:00.00, start: 0.025057, bitrate: 320 kb/s
+  Stream #0:0: Audio: mp3, 44100 Hz, stereo, fltp, 320 kb/s
+  Stream #0:1: Video: mjpeg (Baseline), yuvj420p(pc, bt470bg/unknown/unknown), 500x500, 90k tbr (attached pic)
+"""
+
+
+def test_parse_ffmpeg_input():
+    assert parse_ffmpeg_input(BANNER.encode()) == {
+        'width': 1280, 'height': 720, 'duration': 3723.5, 'bit_rate': 1234000,
+        'format_name': "mov,mp4,m4a,3gp,3g2,mj2"
+    }
+    assert parse_ffmpeg_input(AUDIO_WITH_COVER) is None
+    assert parse_ffmpeg_input(b"") is None
+
+
+def test_is_faststart(tmp_path):
+    def box(kind, payload=b""):
+        return (8 + len(payload)).to_bytes(4, 'big') + kind + payload
+
+    streaming = tmp_path / "a.mp4"
+    streaming.write_bytes(box(b"ftyp", b"isom") + box(b"moov", b"x" * 10) + box(b"mdat", b"y" * 10))
+    plain = tmp_path / "b.mp4"
+    plain.write_bytes(box(b"ftyp", b"isom") + box(b"mdat", b"y" * 10) + box(b"moov", b"x" * 10))
+    assert is_faststart(str(streaming))
+    assert not is_faststart(str(plain))
+    assert not is_faststart(str(tmp_path / "missing.mp4"))
+
+
+def _make_video(path, seconds, audio_only=False, extra=()):
+    inputs = [] if audio_only else ['-f', 'lavfi', '-i', f'testsrc=duration={seconds}:size=320x240:rate=25']
+    subprocess.run(['ffmpeg', '-v', 'error', '-y', *inputs, '-f', 'lavfi', '-i', f'sine=duration={seconds}',
+                    *([] if audio_only else ['-c:v', 'libx264']), '-c:a', 'aac', *extra, str(path)], check=True)
+
+
+@needs_ffmpeg
+def test_prepare_video_uses_one_ffmpeg_run(tmp_path, monkeypatch):
+    video = tmp_path / "clip.mp4"
+    _make_video(video, 8, extra=['-movflags', '+faststart'])
+    calls = []
+    real_run_tool = media_tools.run_tool
+
+    async def counting_run_tool(cmd, **kwargs):
+        calls.append(cmd[0])
+        return await real_run_tool(cmd, **kwargs)
+
+    monkeypatch.setattr(media_tools, 'run_tool', counting_run_tool)
+    metadata = asyncio.run(prepare_video(str(video), "t1"))
+    assert calls == ['ffmpeg']
+    assert os.path.getsize(metadata.pop('thumb')) > 0
+    reference = asyncio.run(get_video_metadata(str(video)))
+    assert metadata['resolution'] == reference['resolution'] == "320x240"
+    assert abs(metadata['duration'] - reference['duration']) < 0.05
+    assert metadata['size'] == reference['size']
+    assert metadata['supports_streaming'] is reference['supports_streaming'] is True
+    assert abs(metadata['bit_rate'] - reference['bit_rate']) <= 1000
+
+
+@needs_ffmpeg
+def test_prepare_short_video_and_audio(tmp_path):
+    short = tmp_path / "short.mp4"
+    _make_video(short, 2)
+    audio = tmp_path / "audio.m4a"
+    _make_video(audio, 2, audio_only=True)
+    metadata = asyncio.run(prepare_video(str(short), "t2"))
+    # Más corto que THUMBNAIL_OFFSET: la miniatura sale de la mitad del video
+    assert metadata['thumb'] and os.path.getsize(metadata['thumb']) > 0
+    assert metadata['supports_streaming'] is False
+    assert asyncio.run(prepare_video(str(audio), "t3")) is None
+    assert not os.path.exists(tmp_path / "thumb_t3.jpg")
+
+
+def _part_info(path):
+    """Duración de la parte y si su primer fotograma de video es clave"""
+    out = subprocess.run(['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-read_intervals', '%+#1',
+                          '-show_entries', 'format=duration:frame=key_frame', '-of', 'json',
+                          str(path)], capture_output=True, text=True, check=True).stdout
+    info = json.loads(out)
+    return float(info['format']['duration']), info['frames'][0]['key_frame'] == 1
+
+
+@needs_ffmpeg
+@pytest.mark.parametrize('name', ["clip.mp4", "clip.mkv"])
+def test_split_video_by_time(tmp_path, monkeypatch, name):
+    video = tmp_path / name
+    # Bitrate variable: el ruido final ocupa mucho más que la media, así la primera
+    # pasada se pasa del límite y se repite con tramos más cortos
+    _make_video(video, 20, extra=['-g', '25', '-vf', "noise=alls=60:allf=t:enable='gte(t,14)'"])
+    max_size = os.path.getsize(video) // 3
+    calls = []
+    real_segment = media_tools._segment_video
+
+    async def counting_segment(*args):
+        calls.append(args[2])
+        await real_segment(*args)
+
+    monkeypatch.setattr(media_tools, '_segment_video', counting_segment)
+    metadata = asyncio.run(get_video_metadata(str(video)))
+    parts = asyncio.run(split_video_by_time(str(video), str(tmp_path), metadata, max_size))
+
+    assert len(calls) > 1 and calls[-1] < calls[0]
+    assert parts == sorted(str(p) for p in tmp_path.glob("clip.part*"))
+    assert all(os.path.getsize(part) <= max_size for part in parts)
+    infos = [_part_info(part) for part in parts]
+    # Cada parte empieza en un fotograma clave y juntas cubren todo el video
+    assert all(keyframe for _, keyframe in infos)
+    # (cada parte puede sumar el retardo inicial del audio, < 0.1 s)
+    assert abs(sum(duration for duration, _ in infos) - metadata['duration']) < 0.1 * len(parts)
+
+
+@needs_ffmpeg
+def test_split_ignores_stale_parts(tmp_path):
+    video = tmp_path / "clip.mp4"
+    _make_video(video, 12, extra=['-g', '25'])
+    # Restos de una división anterior interrumpida en el mismo directorio de la tarea
+    stale = tmp_path / "clip.part099.mp4"
+    stale.write_bytes(b"x")
+    metadata = asyncio.run(get_video_metadata(str(video)))
+    parts = asyncio.run(split_video_by_time(str(video), str(tmp_path), metadata, os.path.getsize(video) * 7 // 10))
+    assert parts and len(parts) == 2 and str(stale) not in parts
+    assert not stale.exists()
+
+
+@needs_ffmpeg
+def test_split_audio_only_fails_cleanly(tmp_path):
+    audio = tmp_path / "audio.m4a"
+    _make_video(audio, 4, audio_only=True)
+    metadata = {'size': os.path.getsize(audio), 'duration': 4.0, 'bit_rate': 0}
+    assert asyncio.run(split_video_by_time(str(audio), str(tmp_path), metadata, 1000)) is None
+    assert os.listdir(tmp_path) == ["audio.m4a"]
@@ -0,0 +1,91 @@
+import asyncio
+from aiohttp import web
+import probe
+from probe import ProbeCache, probe_url, probe_cache, get_filename_from_url, manifest_filename, safe_filename
+from http_session import close_session
+
+
+def test_probe_cache_is_lru_with_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(probe.time, 'monotonic', lambda: now[0])
+    cache = ProbeCache(max_entries=2, ttl=10)
+    cache.put("a", {'size': 1})
+    cache.put("b", {'size': 2})
+    assert cache.get("a") == {'size': 1}
+    cache.put("c", {'size': 3})
+    # "b" era la menos usada
+    assert cache.get("b") is None and cache.get("a") is not None
+    # Se devuelve una copia: modificarla no altera la caché
+    cache.get("a")['size'] = 99
+    assert cache.get("a") == {'size': 1}
+    now[0] += 11
+    assert cache.get("a") is None
+
+
+def test_filenames():
+    assert get_filename_from_url("https://example.com/files/Informe%20final.pdf?x=1") == "Informe final.pdf"
+    assert get_filename_from_url("https://example.com/get?file=datos.zip") == "datos.zip"
+    assert get_filename_from_url("https://example.com/d", "application/pdf").endswith(".pdf")
+    assert safe_filename("../../etc/passwd") == "passwd"
+    assert safe_filename("..") is None
+    assert manifest_filename("index.m3u8") == "index.mp4"
+    assert manifest_filename("clip.mkv") == "clip.mkv"
+
+
+def test_fresh_probe_skips_the_cache():
+    state = {'etag': '"v1"'}
+
+    async def handler(request):
+        headers = {'ETag': state['etag'], 'Accept-Ranges': 'bytes'}
+        if request.headers.get('Range') == 'bytes=0-0':
+            headers['Content-Range'] = 'bytes 0-0/1000'
+            return web.Response(status=206, body=b"x", headers=headers, content_type='application/octet-stream')
+        return web.Response(body=b"x" * 1000, headers=headers, content_type='application/octet-stream')
+
+    async def main():
+        app = web.Application()
+        app.router.add_route('*', '/file.bin', handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/file.bin"
+        try:
+            first = await probe_url(url)
+            assert first['etag'] == '"v1"' and first['size'] == 1000 and first['engine'] == 'segmented'
+            state['etag'] = '"v2"'
+            assert (await probe_url(url))['etag'] == '"v1"'
+            assert (await probe_url(url, fresh=True))['etag'] == '"v2"'
+            # La consulta nueva también actualiza la caché
+            assert (await probe_url(url))['etag'] == '"v2"'
+        finally:
+            probe_cache.invalidate(url)
+            await close_session()
+            await runner.cleanup()
+
+    asyncio.run(main())
+
+
+def test_advertised_ranges_are_confirmed():
+    async def handler(request):
+        # Anuncia rangos pero siempre responde 200 con el archivo completo
+        return web.Response(body=b"x" * 1000, headers={'Accept-Ranges': 'bytes'},
+                            content_type='application/octet-stream')
+
+    async def main():
+        app = web.Application()
+        app.router.add_route('*', '/file.bin', handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/file.bin"
+        try:
+            info = await probe_url(url, fresh=True)
+            assert info['size'] == 1000 and not info['ranges'] and info['engine'] == 'direct'
+        finally:
+            probe_cache.invalidate(url)
+            await close_session()
+            await runner.cleanup()
+
+    asyncio.run(main())
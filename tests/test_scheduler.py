@@ -0,0 +1,161 @@
+import asyncio
+import pytest
+from scheduler import JobScheduler, Job, QueueFull
+
+
+def _job(task_id, user_id, log, gate=None):
+    async def run():
+        log.append(task_id)
+        if gate is not None:
+            await gate.wait()
+    return Job(task_id, user_id, run)
+
+
+def test_round_robin_between_users():
+    async def main():
+        scheduler = JobScheduler(workers=1, user_max_active=1, user_queue_depth=10, stage_limits={})
+        log = []
+        gate = asyncio.Event()
+        scheduler.submit(_job("a1", 'a', log, gate))
+        for task_id in ("a2", "a3"):
+            scheduler.submit(_job(task_id, 'a', log))
+        for task_id in ("b1", "b2"):
+            scheduler.submit(_job(task_id, 'b', log))
+        assert scheduler.queued_count('a') == 2 and scheduler.active_count('a') == 1
+        gate.set()
+        while scheduler.tasks or scheduler.queues:
+            await asyncio.sleep(0)
+        return log
+
+    # b no espera a que terminen todas las de a
+    assert asyncio.run(main()) == ["a1", "b1", "a2", "b2", "a3"]
+
+
+def test_queue_depth_and_user_limit():
+    async def main():
+        scheduler = JobScheduler(workers=4, user_max_active=1, user_queue_depth=1, stage_limits={})
+        log = []
+        gate = asyncio.Event()
+        scheduler.submit(_job("a1", 'a', log, gate))
+        assert scheduler.submit(_job("a2", 'a', log)) == 1
+        with pytest.raises(QueueFull):
+            scheduler.submit(_job("a3", 'a', log))
+        await asyncio.sleep(0)
+        # Hay trabajadores libres, pero a ya tiene una en curso
+        assert log == ["a1"] and scheduler.active == 1
+        gate.set()
+        while scheduler.tasks or scheduler.queues:
+            await asyncio.sleep(0)
+        assert log == ["a1", "a2"] and scheduler.active == 0 and not scheduler.running
+
+    asyncio.run(main())
+
+
+def test_slot_takes_turns_and_is_released():
+    async def main():
+        scheduler = JobScheduler(workers=2, user_max_active=1, user_queue_depth=1, stage_limits={})
+        log = []
+        gate = asyncio.Event()
+        scheduler.submit(_job("b1", 'b', log, gate))
+
+        async def item(name):
+            async with scheduler.slot('a'):
+                log.append(name)
+                await asyncio.sleep(0.01)
+                log.append(name + " fin")
+
+        # Los huecos no cuentan para la profundidad de la cola del usuario
+        items = [asyncio.create_task(item(f"a{i}")) for i in range(3)]
+        await asyncio.sleep(0.005)
+        assert scheduler.active == 2 and scheduler.active_count('a') == 1
+        assert scheduler.queued_count('a') == 0
+        await asyncio.gather(*items)
+        gate.set()
+        while scheduler.tasks:
+            await asyncio.sleep(0)
+        assert scheduler.active == 0 and not scheduler.running
+        return log
+
+    log = asyncio.run(main())
+    # b1 ocupa uno de los dos trabajadores: nunca dos elementos de a a la vez
+    assert [entry for entry in log if entry.startswith("a")] == [
+        "a0", "a0 fin", "a1", "a1 fin", "a2", "a2 fin"
+    ]
+
+
+def test_cancelled_slot_leaves_the_queue():
+    async def main():
+        scheduler = JobScheduler(workers=1, user_max_active=1, user_queue_depth=1, stage_limits={})
+        gate = asyncio.Event()
+        scheduler.submit(_job("b1", 'b', [], gate))
+
+        async def item():
+            async with scheduler.slot('a'):
+                pass
+
+        waiting = asyncio.create_task(item())
+        await asyncio.sleep(0)
+        assert 'a' in scheduler.queues
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        assert 'a' not in scheduler.queues
+        gate.set()
+        while scheduler.tasks:
+            await asyncio.sleep(0)
+        assert scheduler.active == 0
+
+    asyncio.run(main())
+
+
+def test_released_job_frees_its_slot():
+    async def main():
+        scheduler = JobScheduler(workers=1, user_max_active=1, user_queue_depth=5, stage_limits={})
+        log = []
+        gate = asyncio.Event()
+
+        async def run():
+            scheduler.release(job)
+            async with scheduler.slot('a'):
+                log.append("elemento")
+            await gate.wait()
+
+        job = Job("lote", 'a', run)
+        scheduler.submit(job)
+        scheduler.submit(_job("b1", 'b', log))
+        await asyncio.sleep(0.01)
+        # El lote sigue esperando, pero ya no ocupa el único trabajador
+        assert sorted(log) == ["b1", "elemento"]
+        gate.set()
+        while scheduler.tasks:
+            await asyncio.sleep(0)
+        assert scheduler.active == 0 and not scheduler.running
+
+    asyncio.run(main())
+
+
+def test_slots_skip_the_user_limit_but_hold_back_other_tasks():
+    async def main():
+        scheduler = JobScheduler(workers=4, user_max_active=1, user_queue_depth=5, stage_limits={})
+        log = []
+        gate = asyncio.Event()
+
+        async def item(name):
+            async with scheduler.slot('a'):
+                log.append(name)
+                await gate.wait()
+
+        items = [asyncio.create_task(item(f"a{i}")) for i in range(2)]
+        await asyncio.sleep(0.005)
+        # Dos huecos del mismo usuario a la vez pese a USER_MAX_ACTIVE=1
+        assert scheduler.active_count('a') == 2
+        scheduler.submit(_job("a-suelta", 'a', log))
+        await asyncio.sleep(0.005)
+        assert "a-suelta" not in log
+        gate.set()
+        await asyncio.gather(*items)
+        while scheduler.tasks:
+            await asyncio.sleep(0)
+        assert scheduler.active == 0 and not scheduler.running
+        return log
+
+    assert asyncio.run(main()) == ["a0", "a1", "a-suelta"]
@@ -0,0 +1,225 @@
+import os
+import asyncio
+import sys
+import subprocess
+from types import SimpleNamespace
+import pytest
+import split_upload
+from pyrogram.errors import FloodWait
+from split_upload import (pipelined_split_upload, with_upload_retries, split_and_upload, split_file_views,
+                          FileRangeView, volume_name, sent_item, UPLOAD_TRANSMISSIONS, PART_UPLOAD_CONCURRENCY)
+from status_editor import LocalStatus
+
+
+class StubParser:
+    async def parse(self, text, mode=None):
+        return {'message': text, 'entities': None}
+
+
+class StubClient:
+    """Registra lo subido con save_file y los mensajes publicados.
+
+    Como pyrogram, save_file ocupa uno de max_concurrent_transmissions huecos.
+    """
+
+    def __init__(self, max_concurrent_transmissions=UPLOAD_TRANSMISSIONS):
+        self.uploaded = {}
+        self.sent = []
+        self.captions = []
+        self.parser = StubParser()
+        self.save_file_semaphore = asyncio.Semaphore(max_concurrent_transmissions)
+        self.uploading = 0
+        self.peak_uploads = 0
+
+    def rnd_id(self):
+        return len(self.sent)
+
+    def guess_mime_type(self, name):
+        return None
+
+    async def resolve_peer(self, chat_id):
+        return chat_id
+
+    async def save_file(self, path, progress=None, **kwargs):
+        async with self.save_file_semaphore:
+            self.uploading += 1
+            self.peak_uploads = max(self.peak_uploads, self.uploading)
+            try:
+                # Tiempo de subida: deja que las demás partes empiecen si hay hueco
+                await asyncio.sleep(0.01)
+                return await self._save(path, progress)
+            finally:
+                self.uploading -= 1
+
+    async def _save(self, path, progress):
+        if hasattr(path, 'read'):
+            # FileRangeView: como pyrogram, se recorre desde el principio
+            path.seek(0)
+            data = path.read()
+        else:
+            with open(path, 'rb') as f:
+                data = f.read()
+        if progress:
+            await progress(len(data), len(data))
+        file = SimpleNamespace(id=len(self.uploaded))
+        self.uploaded[file.id] = data
+        return file
+
+    async def invoke(self, rpc):
+        self.sent.append(self.uploaded[rpc.media.file.id])
+        self.captions.append(rpc.message)
+        return SimpleNamespace(updates=[], users=[], chats=[])
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MESSAGE = SimpleNamespace(chat=SimpleNamespace(id=1))
+DATA = os.urandom(10_000)
+
+
+def _run(tmp_path, fetch_volume, client):
+    return asyncio.run(asyncio.wait_for(pipelined_split_upload(
+        client, MESSAGE, LocalStatus(), str(tmp_path), "data.bin", len(DATA), "t1", fetch_volume
+    ), 10))
+
+
+def test_pipeline_uploads_volumes_in_order(tmp_path, monkeypatch):
+    monkeypatch.setattr(split_upload, 'VOLUME_SIZE', 4000)
+
+    async def fetch_volume(offset, length, path):
+        with open(path, 'wb') as f:
+            f.write(DATA[offset:offset + length])
+        return True
+
+    client = StubClient()
+    assert len(_run(tmp_path, fetch_volume, client)) == 3
+    assert b"".join(client.sent) == DATA
+    assert os.listdir(tmp_path) == []
+
+
+def test_pipeline_stops_when_a_volume_fails(tmp_path, monkeypatch):
+    monkeypatch.setattr(split_upload, 'VOLUME_SIZE', 4000)
+
+    async def fetch_volume(offset, length, path):
+        return offset == 0 and open(path, 'wb').write(DATA[:length]) > 0
+
+    assert _run(tmp_path, fetch_volume, StubClient()) is None
+    assert os.listdir(tmp_path) == []
+
+
+def test_pipeline_propagates_producer_errors(tmp_path, monkeypatch):
+    monkeypatch.setattr(split_upload, 'VOLUME_SIZE', 4000)
+
+    async def fetch_volume(offset, length, path):
+        if offset:
+            raise RuntimeError("fallo al descargar")
+        with open(path, 'wb') as f:
+            f.write(DATA[:length])
+        return True
+
+    # El consumidor no se queda esperando: el error llega al llamador
+    with pytest.raises(RuntimeError):
+        _run(tmp_path, fetch_volume, StubClient())
+    assert os.listdir(tmp_path) == []
+
+
+def test_only_idempotent_uploads_retry_network_errors(monkeypatch):
+    real_sleep = asyncio.sleep
+    monkeypatch.setattr(split_upload.asyncio, 'sleep', lambda delay: real_sleep(0))
+
+    def flaky(errors):
+        calls = []
+
+        async def action():
+            calls.append(1)
+            if len(calls) <= len(errors):
+                raise errors[len(calls) - 1]
+            return "ok"
+        return action, calls
+
+    async def main():
+        upload, calls = flaky([ConnectionResetError(), asyncio.TimeoutError()])
+        assert await with_upload_retries(upload, "t", "subida") == "ok" and len(calls) == 3
+        send, calls = flaky([asyncio.TimeoutError()])
+        # El mensaje pudo publicarse: no se repite
+        with pytest.raises(asyncio.TimeoutError):
+            await with_upload_retries(send, "t", "envío", retry_network=False)
+        assert len(calls) == 1
+        # FloodWait significa que Telegram no lo procesó: se reintenta
+        send, calls = flaky([FloodWait(value=0)])
+        assert await with_upload_retries(send, "t", "envío", retry_network=False) == "ok" and len(calls) == 2
+
+    asyncio.run(main())
+
+
+def test_file_range_view(tmp_path):
+    path = tmp_path / "data.bin"
+    path.write_bytes(DATA)
+    with FileRangeView(str(path), 1000, 3000, "data.bin.002") as view:
+        assert view.read(10) == DATA[1000:1010] and view.tell() == 10
+        assert view.seek(0, os.SEEK_END) == 3000 and view.read() == b""
+        view.seek(-100, os.SEEK_CUR)
+        assert view.read() == DATA[3900:4000]
+        # Los desplazamientos fuera del tramo se ajustan a sus límites
+        assert view.seek(-5) == 0 and view.seek(10 ** 6) == 3000
+        view.seek(0)
+        buffer = bytearray(5000)
+        assert view.readinto(buffer) == 3000 and bytes(buffer[:3000]) == DATA[1000:4000]
+    assert view.closed
+
+
+def test_split_file_views(tmp_path, monkeypatch):
+    path = tmp_path / "data.bin"
+    path.write_bytes(DATA)
+    views = split_file_views(str(path), 4000)
+    try:
+        assert [view.name for view in views] == ["data.bin.001", "data.bin.002", "data.bin.003"]
+        assert [view.length for view in views] == [4000, 4000, 2000]
+        assert b"".join(view.read() for view in views) == DATA
+    finally:
+        for view in views:
+            view.close()
+    assert volume_name("a.iso", 12) == "a.iso.012"
+
+
+def test_split_and_upload_sends_every_volume(tmp_path, monkeypatch):
+    monkeypatch.setattr(split_upload, 'VOLUME_SIZE', 3000)
+    path = tmp_path / "data.bin"
+    path.write_bytes(DATA)
+    client = StubClient()
+    sent = asyncio.run(split_and_upload(client, MESSAGE, LocalStatus(), str(path), "t1",
+                                        lambda i: f"{i:064x}"))
+    # La respuesta del stub no incluye el mensaje: no hay file_id que guardar en caché
+    assert sent == [None] * 4
+    assert [f"{i:064x}" in caption for i, caption in enumerate(client.captions)] == [True] * 4
+    # Publicados en orden aunque las subidas vayan en paralelo; el original se borra
+    assert b"".join(client.sent) == DATA
+    assert not path.exists()
+
+
+def test_sent_item_needs_a_file_id():
+    document = SimpleNamespace(video=None, document=SimpleNamespace(file_id="AbC"), caption="c")
+    assert sent_item(document) == {'type': 'document', 'file_id': "AbC", 'caption': "c"}
+    # send_uploaded_document devuelve True si Telegram no incluye el mensaje publicado
+    assert sent_item(True) is None
+    assert sent_item(SimpleNamespace(video=SimpleNamespace(file_id=None), document=None)) is None
+
+
+@pytest.mark.parametrize('transmissions, expected', [(1, 1), (UPLOAD_TRANSMISSIONS, PART_UPLOAD_CONCURRENCY)])
+def test_parts_upload_in_parallel_only_with_enough_transmissions(tmp_path, monkeypatch, transmissions, expected):
+    monkeypatch.setattr(split_upload, 'VOLUME_SIZE', 1000)
+    path = tmp_path / "data.bin"
+    path.write_bytes(DATA)
+    client = StubClient(transmissions)
+    assert asyncio.run(split_and_upload(client, MESSAGE, LocalStatus(), str(path), "t1"))
+    assert client.peak_uploads == expected
+
+
+def test_bot_client_allows_parallel_part_uploads(tmp_path):
+    # En otro proceso: importar bot registra sus handlers en el event loop de pyrogram
+    code = "import bot; print(bot.app.max_concurrent_transmissions, bot.app.save_file_semaphore._value)"
+    env = dict(os.environ, API_ID='1', PYTHONPATH=ROOT)
+    out = subprocess.run([sys.executable, '-c', code], cwd=tmp_path, env=env, capture_output=True, text=True,
+                         check=True).stdout.split()
+    # Con el valor por defecto de pyrogram (1) las partes se subirían de una en una
+    assert [int(value) for value in out] == [UPLOAD_TRANSMISSIONS] * 2
+    assert UPLOAD_TRANSMISSIONS >= PART_UPLOAD_CONCURRENCY
@@ -0,0 +1,71 @@
+import asyncio
+from types import SimpleNamespace
+from pyrogram.errors import FloodWait
+from status_editor import StatusEditor, TokenBucket, LocalStatus
+
+
+class StubMessage:
+    def __init__(self, chat_id, message_id, flood=0):
+        self.chat = SimpleNamespace(id=chat_id)
+        self.id = message_id
+        self.edits = []
+        self.flood = flood
+
+    async def edit(self, text):
+        if self.flood:
+            self.flood -= 1
+            raise FloodWait(value=0)
+        self.edits.append(text)
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=10, burst=2)
+    assert bucket.full and bucket.delay() == 0
+    bucket.take()
+    bucket.take()
+    assert 0 < bucket.delay() <= 0.1 and not bucket.full
+
+
+def test_only_the_latest_text_is_applied():
+    async def main():
+        editor = StatusEditor(chat_interval=0.2, chat_burst=1, global_rate=100)
+        message = StubMessage(1, 1)
+        editor.push(message, "1")
+        await asyncio.sleep(0.05)
+        # Dentro del intervalo del chat: solo se aplica el último texto, evaluado al editar
+        for text in ("2", "3"):
+            editor.push(message, text)
+        counter = iter(range(10))
+        editor.push(message, lambda: f"4 ({next(counter)})")
+        await asyncio.sleep(0.4)
+        await editor.stop()
+        return message.edits
+
+    assert asyncio.run(main()) == ["1", "4 (0)"]
+
+
+def test_chats_do_not_wait_for_each_other_and_floodwait_retries():
+    async def main():
+        editor = StatusEditor(chat_interval=0.3, chat_burst=1, global_rate=100)
+        slow, other = StubMessage(1, 1, flood=1), StubMessage(2, 1)
+        editor.push(slow, "a")
+        editor.push(other, "b")
+        await asyncio.sleep(0.1)
+        # El chat con FloodWait espera su turno sin retrasar al otro
+        assert (slow.edits, other.edits) == ([], ["b"])
+        await asyncio.sleep(0.4)
+        await editor.stop()
+        return slow.edits
+
+    # La edición no se pierde: se repite cuando el chat vuelve a tener turno
+    assert asyncio.run(main()) == ["a"]
+
+
+def test_local_status_keeps_the_text():
+    async def main():
+        editor = StatusEditor()
+        status = LocalStatus()
+        editor.push(status, lambda: "hola")
+        return status.text, editor.task
+
+    assert asyncio.run(main()) == ("hola", None)
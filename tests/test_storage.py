@@ -0,0 +1,150 @@
+import os
+import asyncio
+from storage import StorageManager
+
+
+def _partial(workspace, size):
+    with open(workspace.file("video.mp4.journal"), 'w') as f:
+        f.write("{}")
+    with open(workspace.file("video.mp4"), 'wb') as f:
+        f.write(b"\0" * size)
+
+
+def test_released_partials_keep_their_reservation(tmp_path):
+    storage = StorageManager(str(tmp_path), limit=10_000)
+
+    async def main():
+        workspace = await storage.acquire("a", 6000)
+        _partial(workspace, 4000)
+        storage.release(workspace)
+        assert os.path.isdir(workspace.path)
+        assert storage.reserved == os.path.getsize(workspace.file("video.mp4")) + 2
+        assert storage.stats()['retained'] == 1
+
+    asyncio.run(main())
+
+
+def test_resuming_replaces_the_retained_reservation(tmp_path):
+    storage = StorageManager(str(tmp_path), limit=10_000)
+
+    async def main():
+        workspace = await storage.acquire("a", 6000)
+        _partial(workspace, 4000)
+        storage.release(workspace)
+        resumed = await storage.acquire("a", 6000)
+        assert resumed.path == workspace.path
+        assert os.path.exists(resumed.file("video.mp4"))
+        assert storage.reserved == 6000
+        storage.release(resumed)
+
+    asyncio.run(main())
+
+
+def test_new_tasks_evict_the_oldest_partials(tmp_path):
+    storage = StorageManager(str(tmp_path), limit=10_000)
+
+    async def main():
+        old = await storage.acquire("old", 4000)
+        _partial(old, 4000)
+        storage.release(old)
+        os.utime(old.path, (1, 1))
+        recent = await storage.acquire("recent", 4000)
+        _partial(recent, 4000)
+        storage.release(recent)
+        # 8004 bytes conservados: para 5000 más hay que borrar la más antigua
+        workspace = await storage.acquire("new", 5000)
+        assert not os.path.exists(old.path)
+        assert os.path.exists(recent.path)
+        assert storage.reserved == 5000 + 4002
+        storage.release(workspace)
+
+    asyncio.run(main())
+
+
+def test_start_reserves_kept_partials(tmp_path):
+    kept = tmp_path / "kept"
+    kept.mkdir()
+    (kept / "file.bin.journal").write_text("{}")
+    (kept / "file.bin").write_bytes(b"\0" * 1000)
+    orphan = tmp_path / "orphan"
+    orphan.mkdir()
+    (orphan / "file.bin").write_bytes(b"\0" * 1000)
+
+    storage = StorageManager(str(tmp_path), limit=10_000)
+    storage.start()
+    assert not orphan.exists()
+    assert storage.reserved == 1002
+    assert storage.retained == {"kept": 1002}
+
+
+def test_expired_partials_are_removed(tmp_path):
+    storage = StorageManager(str(tmp_path), limit=10_000)
+
+    async def main():
+        workspace = await storage.acquire("a", 1000)
+        _partial(workspace, 1000)
+        storage.release(workspace)
+        storage.expire_partials(now=os.path.getmtime(workspace.path) + storage.max_age)
+        assert not os.path.exists(workspace.path)
+        assert storage.reserved == 0
+
+    asyncio.run(main())
+
+
+def test_reservations_wait_in_order(tmp_path):
+    storage = StorageManager(str(tmp_path), limit=1000)
+
+    async def main():
+        first = await storage.acquire("first", 800)
+        second = asyncio.ensure_future(storage.acquire("second", 500))
+        third = asyncio.ensure_future(storage.acquire("third", 100))
+        await asyncio.sleep(0)
+        # third cabría, pero no adelanta a second
+        assert not second.done() and not third.done()
+        storage.release(first)
+        await asyncio.gather(second, third)
+        assert storage.reserved == 600
+
+    asyncio.run(main())
+
+
+def test_grow_waits_for_space_ahead_of_new_tasks(tmp_path):
+    storage = StorageManager(str(tmp_path), limit=1000)
+
+    async def main():
+        first = await storage.acquire("first", 600)
+        second = await storage.acquire("second", 300)
+        newcomer = asyncio.ensure_future(storage.acquire("newcomer", 400))
+        await asyncio.sleep(0)
+        # Una tarea de yt-dlp necesita sitio para las partes después de descargar
+        growing = asyncio.ensure_future(storage.grow(second, 700))
+        await asyncio.sleep(0)
+        assert not growing.done() and not newcomer.done()
+        storage.release(first)
+        assert await growing
+        assert second.reserved == 700 and not newcomer.done()
+        storage.resize(second, 300)
+        await newcomer
+        assert storage.reserved == 700
+
+    asyncio.run(main())
+
+
+def test_grow_gives_up_when_nobody_can_free_space(tmp_path):
+    storage = StorageManager(str(tmp_path), limit=1000)
+
+    async def main():
+        alone = await storage.acquire("alone", 600)
+        assert not await storage.grow(alone, 2000)
+        # Nadie más liberará espacio: esperar bloquearía la tarea para siempre
+        await storage.acquire("other", 300)
+        other = storage.active["other"]
+        waiting = asyncio.ensure_future(storage.grow(alone, 800))
+        await asyncio.sleep(0)
+        assert not waiting.done()
+        # Las dos esperando a ampliar se bloquearían entre sí
+        assert not await storage.grow(other, 500)
+        storage.release(other)
+        assert await waiting and alone.reserved == 800
+
+    asyncio.run(main())
@@ -0,0 +1,68 @@
+import os
+import asyncio
+from aiohttp import web
+from ytdlp_engine import YtdlpEngine
+
+BODY = b"\x1aE\xdf\xa3" + b"x" * 50000
+
+
+def test_download_keeps_the_real_extension(tmp_path):
+    async def handler(request):
+        return web.Response(body=BODY, content_type='video/webm')
+
+    async def main():
+        app = web.Application()
+        app.router.add_get('/videos/clip.webm', handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        engine = YtdlpEngine(workers=1)
+        progress = []
+
+        async def on_progress(downloaded, total):
+            progress.append(downloaded)
+
+        try:
+            # Nombre provisional como el de las listas de reproducción
+            return await engine.download(f"http://127.0.0.1:{port}/videos/clip.webm",
+                                         str(tmp_path / "Mi video 1.5.mp4"), on_progress, lambda: False)
+        finally:
+            engine.shutdown()
+            await runner.cleanup()
+
+    result = asyncio.run(main())
+    assert result == str(tmp_path / "Mi video 1.5.webm")
+    with open(result, 'rb') as f:
+        assert f.read() == BODY
+    assert os.listdir(tmp_path) == ["Mi video 1.5.webm"]
+
+
+def test_failed_download_removes_leftovers(tmp_path):
+    async def handler(request):
+        return web.Response(status=404)
+
+    async def main():
+        app = web.Application()
+        app.router.add_get('/videos/clip.webm', handler)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        engine = YtdlpEngine(workers=1)
+
+        async def on_progress(downloaded, total):
+            pass
+
+        try:
+            return await engine.download(f"http://127.0.0.1:{port}/videos/clip.webm",
+                                         str(tmp_path / "clip.mp4"), on_progress, lambda: False)
+        finally:
+            engine.shutdown()
+            await runner.cleanup()
+
+    (tmp_path / "clip.webm.part").write_bytes(b"x")
+    assert asyncio.run(main()) is False
+    assert os.listdir(tmp_path) == []
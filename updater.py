@@ -0,0 +1,154 @@
+import os
+import sys
+import time
+import shutil
+import asyncio
+import logging
+from ytdlp_engine import ytdlp_engine, YTDLP_DIR
+
+logger = logging.getLogger(__name__)
+
+# Configuración
+UPDATE_DRAIN_TIMEOUT = int(os.environ.get('UPDATE_DRAIN_TIMEOUT', 600))  # segundos esperando a las descargas
+UPDATE_INSTALL_TIMEOUT = 600  # segundos para pip
+
+
+class UpdateError(Exception):
+    """La nueva versión no se pudo instalar o cargar"""
+
+
+async def _run(*args, env=None, timeout=UPDATE_INSTALL_TIMEOUT):
+    """Ejecuta un comando sin bloquear el event loop; devuelve (código, salida)"""
+    process = await asyncio.create_subprocess_exec(
+        *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT, env=env
+    )
+    try:
+        output, _ = await asyncio.wait_for(process.communicate(), timeout)
+    except asyncio.TimeoutError:
+        process.kill()
+        await process.wait()
+        raise UpdateError(f"{args[0]} no terminó en {timeout}s")
+    return process.returncode, output.decode(errors='replace')
+
+
+async def install_ytdlp():
+    """Instala la última yt-dlp en un directorio nuevo de YTDLP_DIR sin tocar la cargada.
+
+    Devuelve (directorio, versión).
+    """
+    os.makedirs(YTDLP_DIR, exist_ok=True)
+    path = os.path.join(YTDLP_DIR, f"yt-dlp-{int(time.time())}")
+    # yt-dlp no tiene dependencias obligatorias: el directorio solo contiene el paquete
+    code, output = await _run(
+        sys.executable, "-m", "pip", "install", "--upgrade", "--no-deps", "--target", path, "yt-dlp"
+    )
+    if code == 0:
+        code, version = await _run(
+            sys.executable, "-c", "import yt_dlp.version; print(yt_dlp.version.__version__)",
+            env=dict(os.environ, PYTHONPATH=path)
+        )
+        if code == 0:
+            return path, version.strip()
+        output = version
+    shutil.rmtree(path, ignore_errors=True)
+    raise UpdateError(f"Error actualizando: {output}")
+
+
+def activate(path):
+    """Marca path como la versión que cargan los procesos al arrancar"""
+    marker = os.path.join(YTDLP_DIR, 'current')
+    with open(marker + '.tmp', 'w') as f:
+        f.write(os.path.basename(path))
+    os.replace(marker + '.tmp', marker)
+
+
+def prune_installs(keep):
+    """Borra las versiones instaladas que ya no usa ningún proceso"""
+    for name in os.listdir(YTDLP_DIR):
+        path = os.path.join(YTDLP_DIR, name)
+        if os.path.isdir(path) and path != keep:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+class Updater:
+    """Actualiza yt-dlp sin reiniciar el bot ni perder las transferencias en curso.
+
+    La versión nueva se instala aparte mientras todo sigue funcionando. Después las
+    tareas nuevas esperan, las descargas con yt-dlp en curso tienen UPDATE_DRAIN_TIMEOUT
+    para terminar (las que no, se detienen conservando sus .part y se reanudan con la
+    versión nueva) y se carga la nueva versión en el proceso. Las descargas directas y
+    las subidas no usan yt-dlp y continúan sin interrupción. En modo cola, en cambio,
+    se reinician los procesos de trabajo de uno en uno.
+    """
+
+    def __init__(self):
+        self.resumed = asyncio.Event()
+        self.resumed.set()
+        self.running = False
+
+    @property
+    def paused(self):
+        return not self.resumed.is_set()
+
+    async def wait_resumed(self, on_pause=None):
+        """Espera mientras la actualización tiene en pausa las tareas nuevas"""
+        if self.paused:
+            if on_pause:
+                await on_pause()
+            await self.resumed.wait()
+
+    async def update(self, on_status, pool=None):
+        """Instala y carga la última yt-dlp; devuelve (versión anterior, versión nueva, descargas interrumpidas)"""
+        if self.running:
+            raise UpdateError("Ya hay una actualización en curso")
+        self.running = True
+        try:
+            previous = ytdlp_engine.version
+            await on_status("🔄 Instalando yt-dlp en segundo plano, las tareas continúan...")
+            path, version = await install_ytdlp()
+            if version == previous:
+                shutil.rmtree(path, ignore_errors=True)
+                return previous, version, 0
+            if pool:
+                # Los procesos relanzados cargan la versión marcada como activa
+                activate(path)
+                await on_status(
+                    f"♻️ yt-dlp {version} instalado. Reiniciando procesos de trabajo de uno en uno "
+                    f"(máx. {UPDATE_DRAIN_TIMEOUT}s cada uno)..."
+                )
+                interrupted = await pool.rolling_restart(UPDATE_DRAIN_TIMEOUT)
+                try:
+                    # El bot no descarga en este modo: solo para informar de la versión real
+                    ytdlp_engine.reload(path)
+                except Exception as e:
+                    logger.warning(f"No se pudo cargar yt-dlp {version} en el bot: {str(e)}")
+            else:
+                interrupted = await self._swap(path, version, on_status)
+            prune_installs(path)
+            logger.info(f"yt-dlp actualizado de {previous} a {version}")
+            return previous, version, interrupted
+        finally:
+            self.running = False
+
+    async def _swap(self, path, version, on_status):
+        self.resumed.clear()
+        ytdlp_engine.hold()
+        try:
+            await on_status(
+                f"⏸️ yt-dlp {version} instalado. Tareas nuevas en pausa; esperando a "
+                f"{ytdlp_engine.active} descargas con yt-dlp (máx. {UPDATE_DRAIN_TIMEOUT}s)..."
+            )
+            interrupted = await ytdlp_engine.drain(UPDATE_DRAIN_TIMEOUT)
+            try:
+                ytdlp_engine.reload(path)
+            except Exception as e:
+                shutil.rmtree(path, ignore_errors=True)
+                raise UpdateError(f"No se pudo cargar yt-dlp {version}: {str(e)}")
+            activate(path)
+        finally:
+            ytdlp_engine.resume()
+            self.resumed.set()
+        return interrupted
+
+
+updater = Updater()
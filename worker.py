@@ -0,0 +1,228 @@
+"""Proceso de trabajo: reclama tareas de la cola compartida y las ejecuta.
+
+El bot lo lanza con QUEUE_WORKERS > 0; en otras máquinas que compartan la base de
+datos de la cola (JOB_QUEUE_DB) y la caché se puede lanzar a mano:
+
+    python worker.py <índice>
+"""
+import os
+import sys
+import time
+import signal
+import asyncio
+import logging
+from types import SimpleNamespace
+from pyrogram import Client
+import bot
+from job_queue import job_queue, worker_name, JOB_HEARTBEAT_INTERVAL
+from status_editor import status_editor, LocalStatus
+from storage import storage, STORAGE_DIR
+from http_session import get_session, close_session
+from file_cache import file_cache
+from bandwidth import bandwidth
+from ytdlp_engine import ytdlp_engine
+from updater import UPDATE_DRAIN_TIMEOUT
+from split_upload import UPLOAD_TRANSMISSIONS
+from metrics import start_metrics_server
+
+logger = logging.getLogger(__name__)
+
+# Configuración
+WORKER_JOBS = int(os.environ.get('WORKER_JOBS', 2))  # tareas a la vez en cada proceso
+WORKER_POLL_INTERVAL = 2  # segundos entre intentos de reclamar cuando la cola está vacía
+STATUS_FLUSH_INTERVAL = 1  # segundos entre envíos del estado de cada tarea al bot
+
+
+class RemoteStatus(LocalStatus):
+    """Estado de una tarea de este proceso: el último texto se envía al bot por la cola"""
+
+    def __init__(self, job_id):
+        super().__init__()
+        self.job_id = job_id
+        self.dirty = False
+        self.sent = None
+
+    def set_text(self, text):
+        super().set_text(text)
+        self.dirty = True
+
+    async def flush(self):
+        if not self.dirty:
+            return
+        self.dirty = False
+        text = self.text
+        if text and text != self.sent:
+            self.sent = text
+            await job_queue.post_status(self.job_id, text)
+
+
+class Worker:
+    """Reclama tareas mientras tenga hueco, envía latidos y las completa o las devuelve al parar"""
+
+    def __init__(self, client, worker_id, concurrency=WORKER_JOBS):
+        self.client = client
+        self.worker_id = worker_id
+        self.concurrency = concurrency
+        self.running = {}  # id de tarea -> asyncio.Task
+        self.lost = set()  # tareas reasignadas a otro proceso por falta de latidos
+        self.stopping = False
+        self.wakeup = asyncio.Event()
+
+    async def run(self):
+        while not self.stopping:
+            try:
+                while len(self.running) < self.concurrency and not self.stopping:
+                    job = await job_queue.claim(self.worker_id)
+                    if job is None:
+                        break
+                    logger.info(f"[{job['id']}] Tarea reclamada (intento {job['attempts']})")
+                    task = asyncio.create_task(self._execute(job))
+                    self.running[job['id']] = task
+                    task.add_done_callback(lambda _: self.wakeup.set())
+                await job_queue.reclaim_stalled()
+            except Exception as e:
+                logger.error(f"Error reclamando tareas: {str(e)}")
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), WORKER_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _execute(self, job):
+        job_id = job['id']
+        status = RemoteStatus(job_id)
+        message = SimpleNamespace(
+            id=job['message_id'],
+            chat=SimpleNamespace(id=job['chat_id']),
+            from_user=SimpleNamespace(id=job['user_id'])
+        )
+        run = asyncio.create_task(bot.run_job(
+            self.client, message, status, job_id, job['kind'], job['payload'], job['claimed'] - job['created']
+        ))
+        keepalive = asyncio.create_task(self._keepalive(job_id, status, run))
+        outcome = None
+        try:
+            outcome = await run
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"[{job_id}] Error en tarea: {str(e)}", exc_info=True)
+            status.set_text(f"[{job_id}] ❌ Error: {str(e)}")
+            outcome = 'error'
+        finally:
+            keepalive.cancel()
+            await asyncio.gather(keepalive, return_exceptions=True)
+            del self.running[job_id]
+
+        try:
+            if job_id in self.lost:
+                # Otro proceso ya la tiene: no tocar su estado
+                self.lost.discard(job_id)
+            elif outcome is None:
+                await status.flush()
+                await job_queue.release(job_id, self.worker_id)
+                await job_queue.post_status(job_id, f"[{job_id}] ♻️ Proceso detenido, la tarea vuelve a la cola...")
+            else:
+                await status.flush()
+                await job_queue.complete(job_id, self.worker_id, outcome)
+        except Exception as e:
+            logger.error(f"[{job_id}] Error actualizando la cola: {str(e)}")
+
+    async def _keepalive(self, job_id, status, run):
+        """Envía el estado al bot y latidos a la cola; cancela la tarea si se reasignó"""
+        last_beat = time.monotonic()
+        while True:
+            await asyncio.sleep(STATUS_FLUSH_INTERVAL)
+            try:
+                await status.flush()
+                if time.monotonic() - last_beat >= JOB_HEARTBEAT_INTERVAL:
+                    last_beat = time.monotonic()
+                    if not await job_queue.heartbeat(job_id, self.worker_id):
+                        logger.warning(f"[{job_id}] La tarea se reasignó a otro proceso, cancelando")
+                        self.lost.add(job_id)
+                        run.cancel()
+                        return
+            except Exception as e:
+                # La base de datos ocupada no debe tumbar la tarea; el siguiente latido lo reintenta
+                logger.error(f"[{job_id}] Error enviando latido: {str(e)}")
+
+    async def drain(self, timeout, stop):
+        """Deja de reclamar y espera a las tareas en curso hasta timeout (o hasta stop).
+
+        Las que siguen en marcha se devuelven a la cola; antes se detiene yt-dlp de forma
+        que conserve los .part para continuar donde iba. Devuelve cuántas se devolvieron.
+        """
+        self.stopping = True
+        self.wakeup.set()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while self.running and loop.time() < deadline and not stop.is_set():
+            await asyncio.sleep(1)
+        handed_back = len(self.running)
+        if handed_back:
+            ytdlp_engine.hold()
+            await ytdlp_engine.drain(0)
+            await self.stop()
+        return handed_back
+
+    async def stop(self):
+        """Deja de reclamar y devuelve a la cola las tareas en curso"""
+        self.stopping = True
+        self.wakeup.set()
+        tasks = list(self.running.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def main(index):
+    # Directorio propio: la recolección de huérfanos no debe tocar el de otros procesos
+    storage.base_dir = os.path.join(STORAGE_DIR, f"worker-{index}")
+    storage.start()
+    get_session()
+    metrics_runner = await start_metrics_server()
+    worker_id = worker_name(index)
+    client = Client(
+        f"worker-{index}",
+        api_id=bot.API_ID,
+        api_hash=bot.API_HASH,
+        bot_token=bot.BOT_TOKEN,
+        no_updates=True,
+        max_concurrent_transmissions=UPLOAD_TRANSMISSIONS
+    )
+    try:
+        async with client:
+            worker = Worker(client, worker_id)
+            loop = asyncio.get_running_loop()
+            runner = asyncio.create_task(worker.run())
+            stop = asyncio.Event()
+            drain = asyncio.Event()
+            for sig in (signal.SIGTERM, signal.SIGINT):
+                loop.add_signal_handler(sig, stop.set)
+            # SIGUSR1: reinicio por actualización, terminando antes lo que está en curso
+            loop.add_signal_handler(signal.SIGUSR1, drain.set)
+            logger.info(f"Proceso de trabajo {worker_id} iniciado")
+            waiters = [asyncio.create_task(stop.wait()), asyncio.create_task(drain.wait())]
+            await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+            for waiter in waiters:
+                waiter.cancel()
+            if drain.is_set() and not stop.is_set():
+                logger.info(f"Proceso de trabajo {worker_id} terminando sus tareas para reiniciarse")
+                handed_back = await worker.drain(UPDATE_DRAIN_TIMEOUT, stop)
+                logger.info(f"Proceso de trabajo {worker_id}: {handed_back} tareas devueltas a la cola")
+            else:
+                await worker.stop()
+            await runner
+    finally:
+        await status_editor.stop()
+        await bandwidth.stop()
+        await close_session()
+        file_cache.close()
+        job_queue.close()
+        ytdlp_engine.shutdown()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 0))
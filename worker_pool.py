@@ -0,0 +1,180 @@
+import os
+import sys
+import signal
+import asyncio
+import logging
+from types import SimpleNamespace
+from job_queue import job_queue, worker_name
+from status_editor import status_editor
+from metrics import METRICS_PORT
+from ytdlp_engine import INTERRUPT_GRACE
+
+logger = logging.getLogger(__name__)
+
+# Configuración
+QUEUE_WORKERS = int(os.environ.get('QUEUE_WORKERS', 0))  # procesos de trabajo locales; 0 = todo en el bot
+JOB_POLL_INTERVAL = 1  # segundos entre lecturas de estados y posiciones
+WORKER_RESTART_DELAY = 5  # segundos antes de relanzar un proceso que terminó
+WORKER_STOP_TIMEOUT = 30  # segundos para que un proceso devuelva sus tareas al apagar
+PRUNE_INTERVAL = 3600  # segundos entre limpiezas de tareas terminadas
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'worker.py')
+
+
+class RoutedMessage:
+    """Mensaje de estado identificado solo por chat e id, editable sin el Message original"""
+
+    def __init__(self, client, chat_id, message_id):
+        self._client = client
+        self.chat = SimpleNamespace(id=chat_id)
+        self.id = message_id
+
+    async def edit(self, text):
+        return await self._client.edit_message_text(self.chat.id, self.id, text)
+
+
+def queued_text(task_id, position, label=None):
+    return f"[{task_id}] 🕐 {label + ' en cola' if label else 'En cola'}: posición {position}"
+
+
+class WorkerPool:
+    """Lado del bot en el modo con procesos de trabajo.
+
+    Lanza y vigila QUEUE_WORKERS procesos worker.py locales (se pueden añadir más en
+    otras máquinas que compartan la base de datos de la cola), reasigna las tareas sin
+    latido y aplica a los mensajes de Telegram los estados que escriben los procesos.
+    """
+
+    def __init__(self, client, processes=QUEUE_WORKERS):
+        self.client = client
+        self.processes = processes
+        self.children = {}  # índice -> proceso
+        self.supervisors = []
+        self.router = None
+        self.positions = {}  # id de tarea -> última posición mostrada
+        self.restarting = set()  # índices reiniciados a propósito (actualización)
+        self.stopping = False
+
+    def _worker_env(self, index, storage_share):
+        env = dict(os.environ)
+        # Cada proceso gestiona su parte del disco y expone sus propias métricas
+        env['STORAGE_LIMIT'] = str(storage_share)
+        env['METRICS_PORT'] = str(METRICS_PORT + 1 + index if METRICS_PORT else 0)
+        return env
+
+    async def start(self, storage_share):
+        self.supervisors = [
+            asyncio.create_task(self._supervise(index, self._worker_env(index, storage_share)))
+            for index in range(self.processes)
+        ]
+        self.router = asyncio.create_task(self._route())
+        logger.info(f"Modo cola: {self.processes} procesos de trabajo")
+
+    async def _supervise(self, index, env):
+        """Mantiene vivo el proceso index, relanzándolo si termina"""
+        while not self.stopping:
+            process = await asyncio.create_subprocess_exec(sys.executable, WORKER_SCRIPT, str(index), env=env)
+            self.children[index] = process
+            code = await process.wait()
+            del self.children[index]
+            if self.stopping:
+                return
+            if index in self.restarting:
+                self.restarting.discard(index)
+                if code:
+                    logger.error(f"El proceso de trabajo {index} terminó con código {code} al reiniciarse")
+                continue
+            logger.error(f"El proceso de trabajo {index} terminó (código {code}), relanzando en {WORKER_RESTART_DELAY}s")
+            await asyncio.sleep(WORKER_RESTART_DELAY)
+
+    async def _route(self):
+        """Reasigna tareas sin latido y lleva estados y posiciones en cola a los mensajes"""
+        last_prune = 0
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                await job_queue.reclaim_stalled()
+                await self._apply_statuses()
+                await self._update_positions()
+                if loop.time() - last_prune > PRUNE_INTERVAL:
+                    last_prune = loop.time()
+                    await job_queue.prune()
+            except Exception as e:
+                logger.error(f"Error leyendo la cola de tareas: {str(e)}")
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+
+    async def _apply_statuses(self):
+        latest = {}
+        for row in await job_queue.statuses():
+            latest[(row['chat_id'], row['status_message_id'])] = row['text']
+            self.positions.pop(row['id'], None)
+        for (chat_id, message_id), text in latest.items():
+            status_editor.push(RoutedMessage(self.client, chat_id, message_id), text)
+
+    async def _update_positions(self):
+        queued = await job_queue.positions()
+        waiting = set()
+        for position, row in queued:
+            waiting.add(row['id'])
+            if self.positions.get(row['id']) == position:
+                continue
+            self.positions[row['id']] = position
+            status_editor.push(
+                RoutedMessage(self.client, row['chat_id'], row['status_message_id']),
+                queued_text(row['id'], position, row['label'])
+            )
+        for job_id in set(self.positions) - waiting:
+            del self.positions[job_id]
+
+    async def rolling_restart(self, drain_timeout):
+        """Reinicia los procesos de uno en uno para que carguen otra versión de yt-dlp.
+
+        Cada proceso deja de reclamar, termina sus tareas y sale; las que no terminan en
+        drain_timeout vuelven a la cola conservando lo descargado. El siguiente no se
+        detiene hasta que el anterior vuelve a estar en marcha. Devuelve cuántas tareas
+        se devolvieron a la cola.
+        """
+        handed_back = 0
+        for index in range(self.processes):
+            process = self.children.get(index)
+            if process is None or self.stopping:
+                continue
+            # Lo que no termine antes de salir se habrá devuelto a la cola
+            job_ids = await job_queue.running_jobs(worker_name(index, process.pid))
+            self.restarting.add(index)
+            process.send_signal(signal.SIGUSR1)
+            try:
+                await asyncio.wait_for(process.wait(), drain_timeout + INTERRUPT_GRACE + WORKER_STOP_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning(f"El proceso de trabajo {index} no terminó a tiempo, forzando cierre")
+                process.kill()
+                await process.wait()
+            returned = await job_queue.unfinished(job_ids)
+            logger.info(f"Proceso de trabajo {index} reiniciado para actualizar ({returned} tareas devueltas)")
+            handed_back += returned
+            while self.children.get(index) in (None, process) and not self.stopping:
+                await asyncio.sleep(JOB_POLL_INTERVAL)
+        return handed_back
+
+    async def stop(self):
+        """Detiene los procesos: cada uno devuelve a la cola las tareas que tenía en curso"""
+        self.stopping = True
+        processes = list(self.children.values())
+        for process in processes:
+            process.send_signal(signal.SIGTERM)
+        try:
+            await asyncio.wait_for(asyncio.gather(*(p.wait() for p in processes)), WORKER_STOP_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("Procesos de trabajo sin terminar, forzando cierre")
+            for process in processes:
+                if process.returncode is None:
+                    process.kill()
+        tasks = self.supervisors + ([self.router] if self.router else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        try:
+            # Últimos estados escritos por los procesos al devolver sus tareas
+            await self._apply_statuses()
+        except Exception as e:
+            logger.error(f"Error leyendo la cola de tareas: {str(e)}")
+        job_queue.close()
@@ -0,0 +1,336 @@
+import os
+import sys
+import glob
+import time
+import asyncio
+import logging
+import importlib
+import threading
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Configuración
+YTDLP_WORKERS = int(os.environ.get('YTDLP_WORKERS', 3))
+YTDLP_FRAGMENTS = int(os.environ.get('YTDLP_FRAGMENTS', 5))
+YTDLP_FORMAT = os.environ.get('YTDLP_FORMAT', "bestvideo[height<=720]+bestaudio/best[height<=720]/best")
+YTDLP_DIR = os.path.abspath(os.environ.get('YTDLP_DIR', 'ytdlp_versions'))  # versiones instaladas con /update
+PROGRESS_INTERVAL = 0.5  # segundos entre avisos de progreso al event loop
+PLAYLIST_MAX_DEPTH = 3  # redirecciones/listas anidadas que se siguen al expandir
+INTERRUPT_GRACE = 30  # segundos para que las descargas interrumpidas se detengan
+
+
+def active_install():
+    """Directorio de la versión de yt-dlp instalada con /update, o None para usar la del sistema"""
+    try:
+        with open(os.path.join(YTDLP_DIR, 'current')) as f:
+            path = os.path.join(YTDLP_DIR, f.read().strip())
+    except OSError:
+        return None
+    return path if os.path.isdir(os.path.join(path, 'yt_dlp')) else None
+
+
+# La versión actualizada tiene prioridad sobre la instalada con pip (también tras reiniciar)
+if active_install():
+    sys.path.insert(0, active_install())
+import yt_dlp  # noqa: E402
+
+
+class YtdlpCancelled(Exception):
+    """La tarea se canceló durante la descarga con yt-dlp"""
+
+
+class YtdlpInterrupted(Exception):
+    """La descarga se detuvo para actualizar yt-dlp; los .part se conservan para reanudarla"""
+
+
+class _YtdlpLogger:
+    """Redirige los mensajes de yt-dlp al logging del bot"""
+
+    def debug(self, msg):
+        pass
+
+    def info(self, msg):
+        pass
+
+    def warning(self, msg):
+        logger.warning(f"yt-dlp: {msg}")
+
+    def error(self, msg):
+        logger.error(f"yt-dlp: {msg}")
+
+
+class _Job:
+    """Estado de una descarga: progreso acumulado entre formatos y cancelación"""
+
+    def __init__(self, engine, loop, progress_callback, is_cancelled):
+        self.engine = engine
+        self.loop = loop
+        self.progress_callback = progress_callback
+        self.is_cancelled = is_cancelled
+        self.finished_bytes = 0
+        self.expected_total = 0
+        self.last_report = 0
+
+    def on_progress(self, d):
+        if self.engine.interrupting:
+            raise YtdlpInterrupted()
+        if self.is_cancelled():
+            raise YtdlpCancelled()
+
+        info = d.get('info_dict') or {}
+        if not self.expected_total:
+            # Con video+audio separados el total es la suma de ambos formatos
+            formats = info.get('requested_formats') or [info]
+            self.expected_total = sum(f.get('filesize') or f.get('filesize_approx') or 0 for f in formats)
+
+        current_total = d.get('total_bytes') or d.get('total_bytes_estimate') or 0
+        if d['status'] == 'finished':
+            self.finished_bytes += d.get('downloaded_bytes') or current_total
+            downloaded = total = self.finished_bytes
+        elif d['status'] == 'downloading':
+            downloaded = self.finished_bytes + (d.get('downloaded_bytes') or 0)
+            total = self.finished_bytes + current_total
+        else:
+            return
+
+        total = max(self.expected_total, total, downloaded)
+        now = time.monotonic()
+        if d['status'] != 'finished' and now - self.last_report < PROGRESS_INTERVAL:
+            return
+        self.last_report = now
+        self.loop.call_soon_threadsafe(self._report, downloaded, total)
+
+    def _report(self, downloaded, total):
+        # Ejecutado en el event loop
+        asyncio.ensure_future(self.progress_callback(downloaded, total))
+
+
+def _remove_leftovers(filepath):
+    """Borra los .part, .ytdl y formatos intermedios (.fNNN) de una descarga fallida"""
+    for path in glob.glob(glob.escape(os.path.splitext(filepath)[0]) + ".*"):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def _import_from(path, replaced):
+    """Importa yt_dlp desde path (None: la instalación del sistema) olvidando la cargada"""
+    if replaced in sys.path:
+        sys.path.remove(replaced)
+    if path and path not in sys.path:
+        sys.path.insert(0, path)
+    for name in [name for name in sys.modules if name == 'yt_dlp' or name.startswith('yt_dlp.')]:
+        del sys.modules[name]
+    importlib.invalidate_caches()
+    return importlib.import_module('yt_dlp')
+
+
+def _flat_entries(ydl, result, depth=0):
+    """Recorre una extracción plana (process=False) y devuelve (url, título) de cada video"""
+    kind = result.get('_type', 'video')
+    if kind in ('url', 'url_transparent') and depth < PLAYLIST_MAX_DEPTH and 'entries' not in result:
+        if depth == 0:
+            # La URL inicial redirige (p. ej. un canal a su pestaña de videos)
+            yield from _flat_entries(ydl, ydl.extract_info(result['url'], download=False, process=False), depth + 1)
+        else:
+            yield result['url'], result.get('title')
+    elif kind in ('playlist', 'multi_video'):
+        for entry in result.get('entries') or []:
+            if entry is None:
+                continue
+            if entry.get('_type') == 'playlist' and depth < PLAYLIST_MAX_DEPTH:
+                yield from _flat_entries(ydl, entry, depth + 1)
+            else:
+                url = entry.get('webpage_url') or entry.get('url')
+                if url:
+                    yield url, entry.get('title')
+    else:
+        yield result.get('webpage_url') or result.get('original_url'), result.get('title')
+
+
+class YtdlpEngine:
+    """Descargas con la API de yt_dlp en hilos propios, reutilizando una instancia por hilo"""
+
+    def __init__(self, workers=YTDLP_WORKERS):
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ytdlp")
+        self._local = threading.local()
+        self.generation = 0  # cambia al cargar otra versión: las instancias por hilo se recrean
+        self.active = 0  # descargas y expansiones en curso
+        self.interrupting = False
+        self.available = asyncio.Event()  # sin marcar mientras se cambia de versión
+        self.available.set()
+
+    @property
+    def version(self):
+        return yt_dlp.version.__version__
+
+    def _base_params(self):
+        return {
+            'format': YTDLP_FORMAT,
+            'noplaylist': True,
+            'quiet': True,
+            'no_warnings': True,
+            'noprogress': True,
+            'logger': _YtdlpLogger(),
+            'concurrent_fragment_downloads': YTDLP_FRAGMENTS,
+        }
+
+    def _instance(self):
+        """Instancia de YoutubeDL del hilo actual (los extractores quedan inicializados entre tareas)"""
+        ydl = getattr(self._local, 'ydl', None)
+        if ydl is None or self._local.generation != self.generation:
+            ydl = yt_dlp.YoutubeDL(self._base_params())
+            ydl.add_progress_hook(lambda d: self._local.job.on_progress(d))
+            self._local.ydl = ydl
+            self._local.generation = self.generation
+        return ydl
+
+    def _download(self, url, filepath, job, fragments):
+        ydl = self._instance()
+        self._local.job = job
+        # La extensión la decide yt-dlp según el formato elegido (mp4, webm, mkv...)
+        stem = os.path.splitext(filepath)[0]
+        ydl.params['outtmpl']['default'] = stem.replace('%', '%%') + ".%(ext)s"
+        ydl.params['concurrent_fragment_downloads'] = fragments
+        try:
+            info = ydl.extract_info(url)
+            download = (info.get('requested_downloads') or [info])[-1]
+            return download.get('filepath') or ydl.prepare_filename(info)
+        finally:
+            self._local.job = None
+
+    async def download(self, url, filepath, progress_callback, is_cancelled, fragments=YTDLP_FRAGMENTS):
+        """Descarga url junto a filepath; progress_callback(descargado, total) recibe bytes reales.
+
+        Devuelve la ruta final, con la extensión real del formato descargado en lugar de
+        la de filepath, o False si la descarga falla.
+        Mientras se actualiza yt-dlp espera a la nueva versión; si la actualización
+        interrumpe la descarga lanza YtdlpInterrupted dejando los .part para reanudar.
+        """
+        await self.available.wait()
+        loop = asyncio.get_running_loop()
+        job = _Job(self, loop, progress_callback, is_cancelled)
+        self.active += 1
+        try:
+            return await loop.run_in_executor(self.executor, self._download, url, filepath, job, fragments)
+        except YtdlpInterrupted:
+            raise
+        except YtdlpCancelled:
+            logger.info(f"Descarga yt-dlp cancelada: {url}")
+        except Exception as e:
+            # yt-dlp envuelve las excepciones de los hooks en DownloadError
+            cause = getattr(e, 'exc_info', (None, None))[1]
+            if isinstance(cause, YtdlpInterrupted):
+                logger.info(f"Descarga yt-dlp interrumpida por actualización: {url}")
+                raise cause
+            if isinstance(cause, YtdlpCancelled):
+                logger.info(f"Descarga yt-dlp cancelada: {url}")
+            else:
+                logger.error(f"Error yt-dlp: {str(e)}")
+        finally:
+            self.active -= 1
+        _remove_leftovers(filepath)
+        return False
+
+    def _expand(self, url, start, end, limit, emit):
+        params = self._base_params()
+        params.update({'noplaylist': False, 'extract_flat': 'in_playlist', 'lazy_playlist': True})
+        with yt_dlp.YoutubeDL(params) as ydl:
+            result = ydl.extract_info(url, download=False, process=False)
+            entries = itertools.islice(_flat_entries(ydl, result), max(start - 1, 0), end)
+            for entry in itertools.islice(entries, limit):
+                emit(entry)
+
+    async def iter_playlist(self, url, start=1, end=None, limit=None):
+        """Expande una lista o canal con extracción plana y entrega (url, título) según se obtienen.
+
+        start/end son posiciones 1..N de la lista (end incluido) y limit el número máximo
+        de elementos. Las páginas siguientes se extraen mientras se procesan las primeras.
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        done = object()
+        stopped = threading.Event()
+
+        def emit(item):
+            if stopped.is_set():
+                # El consumidor ya no quiere más elementos: cortar la extracción
+                raise YtdlpCancelled()
+            if self.interrupting:
+                raise YtdlpInterrupted("extracción interrumpida por una actualización de yt-dlp")
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+
+        async def extract():
+            # Hilo propio: no ocupa los hilos de descarga, que pueden estar todos en uso
+            await self.available.wait()
+            self.active += 1
+            try:
+                await asyncio.to_thread(self._expand, url, start, end, limit, emit)
+            finally:
+                self.active -= 1
+                queue.put_nowait(done)
+
+        extraction = loop.create_task(extract())
+        try:
+            while True:
+                item = await queue.get()
+                if item is done:
+                    break
+                yield item
+            # Propagar el error de extracción, si lo hubo
+            await extraction
+        finally:
+            stopped.set()
+            if not extraction.done():
+                extraction.cancel()
+
+    def hold(self):
+        """Las descargas nuevas esperan hasta resume()"""
+        self.available.clear()
+
+    async def drain(self, timeout):
+        """Espera a que terminen las descargas en curso; pasado timeout las interrumpe.
+
+        Devuelve el número de descargas interrumpidas.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while self.active and loop.time() < deadline:
+            await asyncio.sleep(0.5)
+        interrupted = self.active
+        if interrupted:
+            logger.warning(f"Interrumpiendo {interrupted} descargas yt-dlp para actualizar")
+            self.interrupting = True
+            deadline = loop.time() + INTERRUPT_GRACE
+            while self.active and loop.time() < deadline:
+                await asyncio.sleep(0.5)
+        return interrupted
+
+    def reload(self, path):
+        """Carga yt-dlp desde path para las descargas siguientes; llamar sin descargas en curso.
+
+        Si la nueva versión no se puede importar se vuelve a cargar la anterior.
+        """
+        global yt_dlp
+        previous = active_install()
+        try:
+            yt_dlp = _import_from(path, previous)
+        except Exception:
+            yt_dlp = _import_from(previous, path)
+            raise
+        finally:
+            self.generation += 1
+        return self.version
+
+    def resume(self):
+        self.interrupting = False
+        self.available.set()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+ytdlp_engine = YtdlpEngine()